@@ -1,13 +1,18 @@
 import json
 import math
+import os
+from math import cos, sin, atan2, floor
+
+import numpy as np
 
 import lin_al
 import skeleton
-from typing import List, Dict
+from typing import List
 
 from clock import GAME_CLOCK
 from global_access import clamp
-from lin_al import Matrix33, Vec2, lerp
+from memory import ASSETS, asset_key
+from profiling import span
 
 
 class FramePose:
@@ -21,24 +26,190 @@ class FramePose:
         self.joint_poses: List[lin_al.RotTrans] = joint_poses
         meta_data = None
 
+    def to_array(self):
+        """
+        :return: a (joints, 4) array of each joint's rotation unit vector and translation. [cos, sin, tx, ty]
+        """
+        frame_data = np.empty((len(self.joint_poses), 4), dtype=np.float32)
+        for index, joint_pose in enumerate(self.joint_poses):
+            frame_data[index] = (cos(joint_pose.angle), sin(joint_pose.angle),
+                                 joint_pose.translation.x, joint_pose.translation.y)
+        return frame_data
+
+    def copy(self):
+        return FramePose([lin_al.RotTrans(joint_pose.angle, joint_pose.translation.x, joint_pose.translation.y)
+                          for joint_pose in self.joint_poses])
+
+
+class FramePoseView(FramePose):
+    """
+    A read-only FramePose over one frame of a clip's data. The RotTrans are rebuilt from the array each time they are
+    read so editing them does not change the clip. The animator copies a view, edits the copy, and writes it back with
+    Clip.set_frame.
+    """
+
+    def __init__(self, frame_data):
+        self.frame_data: np.ndarray = frame_data
+
+    @property
+    def joint_poses(self):
+        return tuple(lin_al.RotTrans(atan2(rot_sin, rot_cos), trans_x, trans_y)
+                     for rot_cos, rot_sin, trans_x, trans_y in self.frame_data.tolist())
+
+    def to_array(self):
+        return self.frame_data
+
+
+def normalise_rotations(pose_data):
+    """
+    Renormalises the rotation unit vectors of lerped pose data in place. A vector that lerped to zero becomes
+    an angle of 0, the same as atan2(0, 0).
+    """
+    length = np.hypot(pose_data[..., 0], pose_data[..., 1])
+    degenerate = length == 0
+    length[degenerate] = 1
+    pose_data[..., 0] = np.where(degenerate, 1, pose_data[..., 0] / length)
+    pose_data[..., 1] /= length
+    return pose_data
+
 
 class Clip:
     """
-    A collection of FramePoses with information on the run speed.
+    A collection of frames with information on the run speed. The frames are stored as one contiguous float32 array
+    of shape (frames, joints, 4) holding each joint's rotation unit vector and translation. [cos, sin, tx, ty]
 
-    Once loaded into memory clips do not change.
+    Once loaded into memory clips do not change. Only the animator edits them, and it does so through insert_frame,
+    remove_frame, and set_frame which replace the array.
     """
 
-    def __init__(self, target_skeleton, frames, fps, is_looping):
+    def __init__(self, target_skeleton, frame_data, fps, is_looping):
         self.skeleton: skeleton.Skeleton = target_skeleton
-        self.frames: List[FramePose] = frames
-        self.frame_count = len(frames)
+        self.frame_data: np.ndarray = frame_data
+        self.frame_data.flags.writeable = False
         self.frames_per_second = fps
-        self.duration: float = fps * self.frame_count
         self.is_looping: bool = is_looping
+        self.is_additive: bool = False  # the frames are offsets from a reference pose, see make_additive_clip
+        self.is_baked: bool = False  # see palette_cache.BakedClip
+
+    @staticmethod
+    def from_frames(target_skeleton, frames: List[FramePose], fps, is_looping):
+        if frames:
+            frame_data = np.stack([frame.to_array() for frame in frames])
+        else:
+            frame_data = np.zeros((0, target_skeleton.joint_count, 4), dtype=np.float32)
+        return Clip(target_skeleton, frame_data, fps, is_looping)
+
+    @property
+    def frame_count(self):
+        return len(self.frame_data)
+
+    @property
+    def duration(self):
+        return self.frames_per_second * self.frame_count
+
+    @property
+    def frames(self):
+        return tuple(FramePoseView(frame_data) for frame_data in self.frame_data)
+
+    @property
+    def nbytes(self):
+        return self.frame_data.nbytes
+
+    @span('sampling')
+    def sample(self, frame_t, joints=None):
+        """
+        Lerps between the two frames either side of frame_t for every joint at once.
+        :param frame_t: how far through the clip to sample, 0-1.
+        :param joints: optional indices of the only joints to sample.
+        :return: a (joints, 4) array of the sampled pose.
+        """
+        sample = frame_t * self.frame_count
+        last_frame = floor(sample) % self.frame_count
+        next_frame = (last_frame + 1) % self.frame_count
+        next_weight = sample % 1
+
+        last_data, next_data = self.frame_data[last_frame], self.frame_data[next_frame]
+        if joints is not None:
+            last_data, next_data = last_data[joints], next_data[joints]
+
+        return normalise_rotations(last_data * (1 - next_weight) + next_data * next_weight)
+
+    @span('sampling')
+    def sample_many(self, frame_ts, joints=None):
+        """
+        The same as sample but for an array of frame_ts.
+        :return: a (len(frame_ts), joints, 4) array of sampled poses.
+        """
+        sample = np.asarray(frame_ts) * self.frame_count
+        last_frame = np.floor(sample).astype(int) % self.frame_count
+        next_frame = (last_frame + 1) % self.frame_count
+        next_weight = (sample % 1).astype(np.float32)[:, None, None]
+
+        if joints is None:
+            last_data, next_data = self.frame_data[last_frame], self.frame_data[next_frame]
+        else:
+            last_data = self.frame_data[last_frame[:, None], joints]
+            next_data = self.frame_data[next_frame[:, None], joints]
+
+        return normalise_rotations(last_data * (1 - next_weight) + next_data * next_weight)
+
+    # -- EDITING --
+
+    def set_frame(self, index, pose: FramePose):
+        frame_data = self.frame_data.copy()
+        frame_data[index] = pose.to_array()
+        self.frame_data = frame_data
+        self.frame_data.flags.writeable = False
+
+    def insert_frame(self, index, pose: FramePose):
+        self.frame_data = np.insert(self.frame_data, index, pose.to_array(), axis=0)
+        self.frame_data.flags.writeable = False
+
+    def remove_frame(self, index):
+        self.frame_data = np.delete(self.frame_data, index, axis=0)
+        self.frame_data.flags.writeable = False
+
+
+def library_name(file):
+    """
+    The name a clip library's clips are registered under, its file name without the folder or extension.
+    """
+    return os.path.splitext(os.path.basename(file))[0]
+
+
+def clip_key(library, clip_id):
+    return asset_key('clip', f"{library}/{clip_id}")
 
 
-clip_cache: Dict[str, Clip] = {}
+def make_additive_clip(clip, reference=None):
+    """
+    Makes the clip of an additive layer, where every frame is stored as its offset from a reference pose. Layering it
+    adds its motion on top of whatever the character is already doing, e.g. a breathing or recoil clip.
+    :param clip: the clip to take the motion from.
+    :param reference: (joints, 4) the pose the motion is relative to, defaults to the clip's first frame.
+    :return: a new unregistered Clip.
+    """
+    frame_data = clip.frame_data
+    reference = frame_data[0] if reference is None else np.asarray(reference, dtype=np.float32)
+
+    # The rotation offset is the frame's rotation unit vector times the conjugate of the reference's.
+    offsets = np.empty(frame_data.shape, dtype=np.float32)
+    offsets[..., 0] = frame_data[..., 0] * reference[:, 0] + frame_data[..., 1] * reference[:, 1]
+    offsets[..., 1] = frame_data[..., 1] * reference[:, 0] - frame_data[..., 0] * reference[:, 1]
+    offsets[..., 2:] = frame_data[..., 2:] - reference[:, 2:]
+
+    additive_clip = Clip(clip.skeleton, offsets, clip.frames_per_second, clip.is_looping)
+    additive_clip.is_additive = True
+    return additive_clip
+
+
+def local_matrices(pose_data: np.ndarray):
+    """
+    :param pose_data: (..., joints, 4) pose data.
+    :return: (..., joints, 3, 3) local joint matrices.
+    """
+    return lin_al.Matrix33Array.from_rot_trans(pose_data[..., 0], pose_data[..., 1],
+                                               pose_data[..., 2], pose_data[..., 3]).values
 
 
 def generate_frame(frame_data: List[List[float]]):
@@ -50,24 +221,49 @@ def generate_frame(frame_data: List[List[float]]):
     return FramePose(frame_poses)
 
 
-def generate_clip(clip_data: dict, target_skeleton):
-    frames = []
-    for frame in clip_data['frames']:
-        frames.append(generate_frame(frame))
+def generate_clip_data(frames: List[List[List[float]]]):
+    """
+    Converts json frames of [angle, x, y] per joint into clip frame data.
+    """
+    raw_data = np.asarray(frames, dtype=float).reshape(len(frames), -1, 3)
+    frame_data = np.empty((*raw_data.shape[:2], 4), dtype=np.float32)
+    frame_data[..., 0] = np.cos(raw_data[..., 0])
+    frame_data[..., 1] = np.sin(raw_data[..., 0])
+    frame_data[..., 2:] = raw_data[..., 1:]
+    return frame_data
+
 
-    clip = Clip(target_skeleton, frames, clip_data['fps'], clip_data['loop'])
-    clip_cache[clip_data['id']] = clip
-    return clip
+def generate_clip(clip_data: dict, target_skeleton, library=None):
+    """
+    :param library: the library to register the clip under, the clip is not registered without one. A clip that is
+    already registered is kept, so characters holding it keep their references.
+    :return: the registered clip.
+    """
+    def load():
+        return Clip(target_skeleton, generate_clip_data(clip_data['frames']), clip_data['fps'], clip_data['loop'])
 
+    if library is None:
+        return load()
+    return ASSETS.get(clip_key(library, clip_data['id']), load)
 
+
+@span('loading')
 def generate_clips(file, target):
+    """
+    Registers the clips of a json library with the asset registry, as library_name(file)/clip id.
+    :return: the target clip, or None if target is None.
+    """
+    library = library_name(file)
+    if target is not None and clip_key(library, target) in ASSETS:
+        return ASSETS.get(clip_key(library, target))
+
     json_data = json.load(open(file))
     target_skeleton = skeleton.create_skeleton(json_data['target'])
     for clip in json_data['clips']:
-        generate_clip(clip, target_skeleton)
+        generate_clip(clip, target_skeleton, library)
 
     if target is not None:
-        return clip_cache[target]
+        return ASSETS.get(clip_key(library, target))
 
 
 class Animation:
@@ -78,9 +274,10 @@ class Animation:
     not stop until told too with smooth_stop.
     """
 
-    def __init__(self, clip, weight, start_time, loop_num, playback):
+    def __init__(self, clip, weight, start_time, loop_num, playback, mask=None):
         self.clip: Clip = clip
         self.weight: float = weight
+        self.mask: skeleton.JointMask = mask
         self.start_time: float = start_time
         self.current_time: float = (GAME_CLOCK.run_time - start_time) * playback / clip.duration
         self.loop_num: int = loop_num
@@ -90,42 +287,32 @@ class Animation:
         self.current_time = (GAME_CLOCK.run_time - self.start_time) * self.playback / self.clip.duration
         self.loop_num = math.floor(self.current_time) + 1
 
-    def frame_t(self):
+    def frame_t(self, run_time=None):
+        """
+        :param run_time: the GAME_CLOCK run time to sample at, defaults to now. current_time always follows now.
+        :return: how far through the clip the animation is, 0-1.
+        """
         self.current_time = (GAME_CLOCK.run_time - self.start_time) * self.playback / self.clip.duration
+        if run_time is None:
+            current_time = self.current_time
+        else:
+            current_time = (run_time - self.start_time) * self.playback / self.clip.duration
+
         if self.loop_num >= 0:
-            return clamp(self.current_time, 0, self.loop_num) % 1
-        return self.current_time % 1
+            return clamp(current_time, 0, self.loop_num) % 1
+        return current_time % 1
 
+    @span('animation')
     def get_pose(self):
-        sample = self.frame_t() * self.clip.frame_count
-        last_frame = math.floor(sample)
-        next_frame = (last_frame + 1) % self.clip.frame_count
-
-        next_weight = sample % 1
-        last_weight = 1 - next_weight
-
-        poses = []
-        model_poses = []
-        for index, last_pose in enumerate(self.clip.frames[last_frame].joint_poses):
-            next_pose = self.clip.frames[next_frame].joint_poses[index]
-
-            last_vec, next_vec = Vec2(last_pose.angle, 1, True), Vec2(next_pose.angle, 1, True)
+        pose_data = self.clip.sample(self.frame_t())
+        return lin_al.Matrix33Array(self.clip.skeleton.compose(local_matrices(pose_data)))
 
-            true_angle = lerp(last_vec, next_vec, next_weight).theta
-            true_translation = last_pose.translation * last_weight + next_pose.translation * next_weight
-
-            true_pose = lin_al.RotTrans(true_angle, true_translation.x, true_translation.y)
-            poses.append(true_pose)
-
-            joint_parent = self.clip.skeleton.joints[index].parent
-            if joint_parent != -1:
-                last_matrix = model_poses[joint_parent]
-            else:
-                last_matrix = Matrix33()
-
-            model_poses.append(true_pose.to_matrix() * last_matrix)
-
-        return model_poses
+    @property
+    def is_layer(self):
+        """
+        A layer is applied over the blend of a set's other animations, rather than being blended with them.
+        """
+        return self.mask is not None or self.clip.is_additive
 
     def is_done(self):
         if self.loop_num != -1 and self.current_time >= self.loop_num:
@@ -138,26 +325,331 @@ def solve_weights(weights):
     return tuple(map(lambda weight: weight/weight_sum, weights))
 
 
+@span('blending')
+def blend_poses(pose_data, weights, characters):
+    """
+    Blends each character's sampled poses in local space, before the hierarchy pass. The rotation unit vectors are
+    weighted, summed, and renormalised (a normalised lerp of the angles) and the translations are weighted and summed.
+    :param pose_data: (animations, joints, 4) sampled poses.
+    :param weights: (animations,) weight of each animation, already solved within its character.
+    :param characters: (animations,) the character of each animation. The animations of a character must be next to
+    each other.
+    :return: (blended characters, joints, 4) one pose per character, and the character of each.
+    """
+    characters = np.asarray(characters)
+    starts = np.flatnonzero(np.diff(characters, prepend=-1))
+    if len(starts) == len(characters):
+        return pose_data, characters  # nothing to blend, every solved weight is 1
+
+    weighted = pose_data * np.asarray(weights, dtype=pose_data.dtype)[:, None, None]
+    return normalise_rotations(np.add.reduceat(weighted, starts, axis=0)), characters[starts]
+
+
+def find_layer_joints(target_skeleton, mask, skeleton_lod=None):
+    """
+    :param mask: the layer's JointMask, None for the whole skeleton.
+    :param skeleton_lod: the active SkeletonLOD, None for the full skeleton.
+    :return: the joints the layer samples (None for all of them), and their indices into the pose data.
+    """
+    if mask is not None:
+        return mask.find_joints(skeleton_lod)
+    if skeleton_lod is None:
+        return None, np.arange(target_skeleton.joint_count)
+    return skeleton_lod.joints, np.arange(len(skeleton_lod.joints))
+
+
+@span('blending')
+def apply_layer(pose_data, layer_data, weights, is_additive):
+    """
+    Layers sampled poses over pose data. An override layer is lerped towards, and an additive layer's offset is
+    scaled by the weight and added on, its angle and translation to the pose's.
+    :param pose_data: (..., joints, 4) the poses being layered over, for the same joints as layer_data.
+    :param layer_data: (..., joints, 4) the sampled layer.
+    :param weights: how much of the layer to apply, 0-1. Broadcast against the pose data.
+    :return: the layered pose data.
+    """
+    if not is_additive:
+        return normalise_rotations(pose_data * (1 - weights) + layer_data * weights)
+
+    offsets = layer_data * weights
+    offsets[..., :1] += 1 - weights  # lerped from no offset, [1, 0, 0, 0]
+    offsets = normalise_rotations(offsets)
+
+    layered = np.empty(np.broadcast(pose_data, offsets).shape, dtype=np.float32)
+    layered[..., 0] = pose_data[..., 0] * offsets[..., 0] - pose_data[..., 1] * offsets[..., 1]
+    layered[..., 1] = pose_data[..., 1] * offsets[..., 0] + pose_data[..., 0] * offsets[..., 1]
+    layered[..., 2:] = pose_data[..., 2:] + offsets[..., 2:]
+    return layered
+
+
+def find_offsets(pose_data, target_data):
+    """
+    :return: (..., joints, 3) the angle and translation each joint of pose_data is away from target_data's.
+    """
+    offsets = np.empty((*pose_data.shape[:-1], 3), dtype=np.float32)
+    offsets[..., 0] = np.arctan2(pose_data[..., 1] * target_data[..., 0] - pose_data[..., 0] * target_data[..., 1],
+                                 pose_data[..., 0] * target_data[..., 0] + pose_data[..., 1] * target_data[..., 1])
+    offsets[..., 1:] = pose_data[..., 2:] - target_data[..., 2:]
+    return offsets
+
+
+def add_offsets(pose_data, offsets):
+    """
+    Turns each joint by its offset angle and moves it by its offset translation.
+    :param pose_data: (..., joints, 4) pose data.
+    :param offsets: (..., joints, 3) angle and translation offsets, see find_offsets.
+    :return: the offset pose data.
+    """
+    rot_cos, rot_sin = np.cos(offsets[..., 0]), np.sin(offsets[..., 0])
+    offset_data = np.empty(np.broadcast(pose_data[..., 0], rot_cos).shape + (4,), dtype=np.float32)
+    offset_data[..., 0] = pose_data[..., 0] * rot_cos - pose_data[..., 1] * rot_sin
+    offset_data[..., 1] = pose_data[..., 1] * rot_cos + pose_data[..., 0] * rot_sin
+    offset_data[..., 2:] = pose_data[..., 2:] + offsets[..., 1:]
+    return offset_data
+
+
+INERTIALIZATION_STEP = 1 / 60  # the seconds between the two poses a transition's velocities are measured from
+
+
+class Inertialization:
+    """
+    The offset between the pose a character was in when it switched animations and the pose of its new animation.
+    Only the new animation is sampled, and the offset is added on while it decays to nothing over blend_time.
+
+    Every channel (each joint's angle, x, and y) decays along its own quintic, which starts from the channel's offset
+    and velocity and comes to rest at zero with no velocity or acceleration. A velocity that would carry the offset
+    away from zero is dropped, and a fast one shortens the channel's blend so the offset never overshoots.
+    """
+
+    def __init__(self, offsets, velocities, start_time, blend_time):
+        self.start_time: float = start_time
+        self.blend_time: float = blend_time
+
+        offsets = np.where(np.abs(offsets) < 1e-6, 0.0, offsets)
+        velocities = np.where(offsets * velocities < 0, velocities, 0.0)
+        blend_times = np.full(offsets.shape, max(blend_time, 1e-6))
+        closing = velocities != 0
+        blend_times[closing] = np.minimum(blend_times[closing], -5 * offsets[closing] / velocities[closing])
+        self.blend_times: np.ndarray = blend_times
+
+        # The quintic's coefficients, highest power first.
+        t1 = blend_times
+        acceleration = (-8 * velocities * t1 - 20 * offsets) / t1 ** 2
+        self.coefficients: np.ndarray = np.stack([
+            -(acceleration * t1 ** 2 + 6 * velocities * t1 + 12 * offsets) / (2 * t1 ** 5),
+            (3 * acceleration * t1 ** 2 + 16 * velocities * t1 + 30 * offsets) / (2 * t1 ** 4),
+            -(3 * acceleration * t1 ** 2 + 12 * velocities * t1 + 20 * offsets) / (2 * t1 ** 3),
+            acceleration / 2, velocities, offsets])
+
+    @staticmethod
+    def between(outgoing, incoming, start_time, blend_time):
+        """
+        :param outgoing: (2, joints, 4) the pose being left, INERTIALIZATION_STEP before start_time and at it.
+        :param incoming: (2, joints, 4) the new animation's pose at the same two times.
+        """
+        offsets = find_offsets(outgoing, incoming).astype(float)
+        steps = offsets[1] - offsets[0]
+        steps[..., 0] = (steps[..., 0] + np.pi) % (2 * np.pi) - np.pi
+        return Inertialization(offsets[1], steps / INERTIALIZATION_STEP, start_time, blend_time)
+
+    def find_offsets(self, run_time=None):
+        """
+        :param run_time: the GAME_CLOCK run time to evaluate at, defaults to now.
+        :return: (joints, 3) the decayed offsets.
+        """
+        run_time = GAME_CLOCK.run_time if run_time is None else run_time
+        elapsed = np.minimum(max(run_time - self.start_time, 0), self.blend_times)
+        offsets = self.coefficients[0] * elapsed
+        for coefficient in self.coefficients[1:-1]:
+            offsets = (offsets + coefficient) * elapsed
+        return (offsets + self.coefficients[-1]).astype(np.float32)
+
+    def is_done(self, run_time=None):
+        run_time = GAME_CLOCK.run_time if run_time is None else run_time
+        return run_time - self.start_time >= self.blend_time
+
+
+def blend_palettes(target_skeleton, pose_data, weights, characters, palettes, lod=None):
+    """
+    Turns a batch of sampled poses into skinning palettes. The poses of each character are blended in local space,
+    so every character goes through the hierarchy pass once however many animations it is playing.
+    :param target_skeleton: the skeleton all of the poses are for.
+    :param pose_data: (animations, joints, 4) sampled poses. With a joint lod only the lod's joints are sampled.
+    :param weights: (animations,) weight of each animation, already solved within its character.
+    :param characters: (animations,) the index into palettes of each animation's character. The animations of a
+    character must be next to each other.
+    :param palettes: (characters, joints, 3, 3) the palettes to write into. Only the characters given are changed.
+    :param lod: the active joint lod.
+    """
+    poses, slots = blend_poses(pose_data, weights, characters)
+    palettes[slots] = skin_poses(target_skeleton, poses, lod)
+
+
+@span('skinning')
+def skin_poses(target_skeleton, pose_data, lod=None):
+    """
+    Runs poses through the hierarchy pass together.
+    :param target_skeleton: the skeleton all of the poses are for.
+    :param pose_data: (poses, joints, 4) local poses. With a joint lod only the lod's joints are given.
+    :param lod: the active joint lod.
+    :return: (poses, joints, 3, 3) inverse bind pose * model matrices.
+    """
+    skeleton_lod = target_skeleton.get_lod(lod)
+    if skeleton_lod is None:
+        pose_matrices = local_matrices(pose_data)
+    else:
+        pose_matrices = np.empty((len(pose_data), target_skeleton.joint_count, 3, 3))
+        pose_matrices[:, skeleton_lod.joints] = local_matrices(pose_data)
+
+    return target_skeleton.inv_bind_poses.values @ target_skeleton.compose(pose_matrices, lod=lod)
+
+
 class AnimationSet:
 
     def __init__(self):
         self.animations: List[Animation] = []
-
-    def add_animation(self, clip, weight, start_time, loop_num, playback):
-        new_anim = Animation(clip, weight, start_time, loop_num, playback)
+        self.palette_cache = None  # an optional palette_cache.PaletteCache to look palettes up from
+        self.inertialization: Inertialization = None  # the transition in progress, see transition
+
+    def add_animation(self, clip, weight, start_time, loop_num, playback, mask=None):
+        """
+        Animations without a mask or an additive clip are blended together by their weights. The others are layers,
+        applied over that blend in the order they were added, and a layer's weight is how much of it shows, 0-1.
+        :param mask: a skeleton.JointMask from Skeleton.get_mask, the animation is then a layer over only those joints
+        and samples nothing else.
+        :raises ValueError: if a palette_cache.BakedClip would be played with any other animation.
+        """
+        if clip.is_baked or any(anim.clip.is_baked for anim in self.active_animations()):
+            if mask is not None or self.animations or self.inertialization is not None:
+                raise ValueError("a baked clip can only be played on its own, not layered or with other animations")
+
+        new_anim = Animation(clip, weight, start_time, loop_num, playback, mask)
         self.animations.append(new_anim)
         return new_anim
 
-    def get_poses(self):
-        poses, weights = [], []
+    def active_animations(self):
+        """
+        Drops any finished animations, and the transition once it is over.
+        :return: the animations still running.
+        """
         protected_copy = tuple(self.animations)
         for anim in protected_copy:
             if anim.is_done():
                 self.animations.remove(anim)
-                continue
+        if self.inertialization is not None and self.inertialization.is_done():
+            self.inertialization = None
+        return self.animations
+
+    def transition(self, clip, blend_time, weight=1, start_time=None, loop_num=-1, playback=1):
+        """
+        Replaces every animation that is not a layer with a new one through an inertialized transition. The old
+        animations stop at once and only the new one is sampled, with the offset from the pose the character was in
+        added on and decaying to nothing over blend_time. Layers carry on over the top.
+        :param blend_time: the seconds the offset takes to decay, 0 to switch straight away.
+        :param start_time: the new animation's start time, defaults to now.
+        :return: the new animation.
+        :raises ValueError: if either side of the transition is a palette_cache.BakedClip, which has no pose to offset.
+        """
+        if clip.is_baked or any(anim.clip.is_baked for anim in self.active_animations()):
+            raise ValueError("a baked clip cannot be transitioned to or from, clear the animations and add it instead")
+
+        run_time = GAME_CLOCK.run_time
+        times = (run_time - INERTIALIZATION_STEP, run_time)
+        animations = tuple(self.active_animations())
+        outgoing = None
+        if animations and blend_time > 0:
+            outgoing = np.stack([self.blend_animations(animations, clip.skeleton, time) for time in times])
+
+        for anim in animations:
+            if not anim.is_layer:
+                self.animations.remove(anim)
+        self.inertialization = None
+        new_anim = self.add_animation(clip, weight, run_time if start_time is None else start_time, loop_num,
+                                      playback)
+
+        if outgoing is not None:
+            incoming = np.stack([self.blend_animations((new_anim,), clip.skeleton, time) for time in times])
+            self.inertialization = Inertialization.between(outgoing, incoming, run_time, blend_time)
+        return new_anim
 
+    def blend_animations(self, animations, target_skeleton, run_time=None, joints=None):
+        """
+        The local space blend of the animations that are not layers (see blend_poses), with the transition's offset
+        added on. Without any animations to blend the pose is the skeleton's bind pose.
+        :param joints: optional indices of the only joints to sample.
+        :return: a (joints, 4) pose.
+        """
+        blended = [anim for anim in animations if not anim.is_layer]
+        if not blended:
+            pose = target_skeleton.bind_pose.copy() if joints is None else target_skeleton.bind_pose[joints]
+        elif len(blended) == 1:
+            pose = blended[0].clip.sample(blended[0].frame_t(run_time), joints)
+        else:
+            weights = np.array(solve_weights([anim.weight for anim in blended]))
+            pose_data = np.stack([anim.clip.sample(anim.frame_t(run_time), joints) for anim in blended])
+            pose = normalise_rotations(np.tensordot(weights, pose_data, 1))
+
+        if self.inertialization is not None:
+            offsets = self.inertialization.find_offsets(run_time)
+            pose = add_offsets(pose, offsets if joints is None else offsets[joints])
+        return pose
+
+    @span('animation')
+    def get_pose(self, run_time=None, lod=None):
+        """
+        The blend of every active animation (see blend_animations) with the layers applied over it.
+        :param run_time: the GAME_CLOCK run time to sample at, defaults to now.
+        :param lod: the active joint lod, only the lod's joints are sampled.
+        :return: a (joints, 4) pose, or None if nothing is animating.
+        """
+        animations = tuple(self.active_animations())
+        if not animations:
+            return None
+
+        target_skeleton = animations[0].clip.skeleton
+        skeleton_lod = target_skeleton.get_lod(lod)
+        pose = self.blend_animations(animations, target_skeleton, run_time,
+                                     None if skeleton_lod is None else skeleton_lod.joints)
+        for layer in animations:
+            if layer.is_layer:
+                layer_joints, indices = find_layer_joints(target_skeleton, layer.mask, skeleton_lod)
+                layer_data = layer.clip.sample(layer.frame_t(run_time), layer_joints)
+                pose[indices] = apply_layer(pose[indices], layer_data, np.float32(clamp(layer.weight, 0, 1)),
+                                            layer.clip.is_additive)
+        return pose
+
+    @span('animation')
+    def get_poses(self):
+        """
+        The model space pose of every active animation on its own, which costs a hierarchy pass each. Use get_pose
+        or get_palette for the blended pose.
+        """
+        poses, weights = [], []
+        for anim in tuple(self.active_animations()):
             pose = anim.get_pose()
             poses.append(pose)
             weights.append(anim.weight)
 
         return poses, solve_weights(weights)
+
+    @span('animation')
+    def get_palette(self, run_time=None, lod=None):
+        """
+        The blended skinning palette for this set's character.
+        :param run_time: the GAME_CLOCK run time to evaluate at, defaults to now.
+        :param lod: the active joint lod, joints above it are not sampled and follow their parent. Ignored when the
+        palettes come from the palette cache, as a lookup costs the same either way.
+        :return: (joints, 3, 3) skinning matrices, or None if nothing is animating.
+        """
+        animations = tuple(self.active_animations())
+        if not animations:
+            return None
+
+        # Baked palettes are in model space and cannot be blended, layered, or offset, so they only stand in for a
+        #   single animation.
+        if (self.palette_cache is not None and self.inertialization is None and len(animations) == 1
+                and not animations[0].is_layer):
+            return self.palette_cache.get(animations[0].clip).lookup(animations[0].frame_t(run_time))
+
+        pose = self.get_pose(run_time, lod)
+        return skin_poses(animations[0].clip.skeleton, pose[None], lod)[0].astype(np.float32)
@@ -0,0 +1,151 @@
+# Bakes clip libraries into a palette file, see palette_cache for the format. Run from the project folder:
+#
+#   python bake.py [--skeleton robot] [--rate 480] [--workers N] [--out FILE] [--force] [clip files]
+#
+#   Every clip of the given libraries (by default every library in resources/poses/animations that targets the
+#   skeleton) is sampled at the rate, composed, and multiplied by the inverse bind poses across a process pool. The
+#   bake is incremental: each clip's source hash covers its frames, its settings, the skeleton, and the rate, so a
+#   clip whose hash is already in the output file is copied across rather than baked again.
+
+from typing import List, Dict, Tuple
+from hashlib import blake2b
+from time import perf_counter
+from multiprocessing import get_context
+from argparse import ArgumentParser
+import os
+import struct
+
+import numpy as np
+
+import skeleton
+import animation
+import clip_file
+import palette_cache
+
+
+ANIMATION_FOLDER = "resources/poses/animations"
+SKELETON_FOLDER = "resources/skeletons"
+BAKED_FOLDER = "resources/baked"
+
+
+def source_hash(skeleton_source: bytes, clip: animation.Clip, rate: float):
+    digest = blake2b(digest_size=palette_cache.HASH_SIZE)
+    digest.update(struct.pack('<HdId?', palette_cache.VERSION, rate, clip.frame_count, clip.frames_per_second,
+                              clip.is_looping))
+    digest.update(skeleton_source)
+    digest.update(np.ascontiguousarray(clip.frame_data, dtype=np.float32).tobytes())
+    return digest.digest()
+
+
+def bake_job(job):
+    """
+    Bakes one clip in a worker process.
+    :param job: (clip id, skeleton id, frame data, fps, is looping, sample count)
+    :return: the clip id and its (samples, joints, 3, 3) palettes.
+    """
+    clip_id, skeleton_id, frame_data, fps, is_looping, sample_count = job
+    clip = animation.Clip(skeleton.create_skeleton(skeleton_id), frame_data, fps, is_looping)
+    return clip_id, palette_cache.bake_palettes(clip, sample_count)
+
+
+def find_libraries(skeleton_id, files: List[str]):
+    """
+    :return: every clip of the libraries that targets the skeleton, by clip id.
+    """
+    if not files:
+        files = [os.path.join(ANIMATION_FOLDER, name) for name in sorted(os.listdir(ANIMATION_FOLDER))
+                 if name.endswith('.json')]
+
+    clips: Dict[str, animation.Clip] = {}
+    for file in files:
+        library = clip_file.open_clip_file(clip_file.find_clip_file(file))
+        if library.skeleton_id != skeleton_id:
+            print(f"skipping {file}, its clips are for {library.skeleton_id}")
+            continue
+        for clip_id in library.clip_ids:
+            if clip_id in clips:
+                print(f"{file} has a second clip called {clip_id}, it replaces the first")
+            clips[clip_id] = library.clip(clip_id)
+    return clips
+
+
+def bake(skeleton_id, files: List[str] = (), rate=palette_cache.DEFAULT_SAMPLE_RATE, workers=None, out_file=None,
+         force=False):
+    """
+    Bakes every clip of the libraries for a skeleton into a palette file.
+    :return: the path written to.
+    """
+    start = perf_counter()
+    if out_file is None:
+        os.makedirs(BAKED_FOLDER, exist_ok=True)
+        out_file = os.path.join(BAKED_FOLDER, skeleton_id + palette_cache.EXTENSION)
+
+    target_skeleton = skeleton.create_skeleton(skeleton_id)
+    with open(os.path.join(SKELETON_FOLDER, f"{skeleton_id}.json"), 'rb') as skeleton_file:
+        skeleton_source = skeleton_file.read()
+    clips = find_libraries(skeleton_id, list(files))
+
+    previous = None
+    if not force and os.path.exists(out_file):
+        try:
+            previous = palette_cache.PaletteFile(out_file)
+        except ValueError as error:
+            print(f"rebaking everything, {error}")
+
+    sample_counter = palette_cache.PaletteCache(sample_rate=rate)
+    baked: Dict[str, Tuple[bytes, np.ndarray, float, bool]] = {}
+    jobs, hashes = [], {}
+    for clip_id, clip in clips.items():
+        hashes[clip_id] = source_hash(skeleton_source, clip, rate)
+        if previous is not None and clip_id in previous.table and previous.table[clip_id][0] == hashes[clip_id]:
+            baked[clip_id] = (hashes[clip_id], previous.stored_palettes(clip_id), clip.duration, clip.is_looping)
+        else:
+            jobs.append((clip_id, skeleton_id, np.array(clip.frame_data), clip.frames_per_second, clip.is_looping,
+                         sample_counter.find_sample_count(clip)))
+
+    worker_count = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    bake_start = perf_counter()
+    if worker_count == 1:
+        results = list(map(bake_job, jobs))
+    else:
+        with get_context().Pool(worker_count) as pool:
+            results = pool.map(bake_job, jobs)
+    bake_time = perf_counter() - bake_start
+
+    for clip_id, palettes in results:
+        clip = clips[clip_id]
+        baked[clip_id] = (hashes[clip_id], palettes, clip.duration, clip.is_looping)
+
+    # Keep the order of the libraries so an unchanged library writes an identical file.
+    baked = {clip_id: baked[clip_id] for clip_id in clips}
+    palette_cache.write_palette_file(out_file, skeleton_id, target_skeleton.joint_count, baked)
+    if previous is not None:
+        previous.close()
+
+    baked_samples = sum(len(palettes) for _, palettes in results)
+    print(f"{out_file}: {len(results)} clips baked, {len(clips) - len(results)} unchanged, "
+          f"{os.path.getsize(out_file) / 1024:.1f}KB")
+    if results:
+        print(f"baked {baked_samples} samples on {worker_count} workers in {bake_time * 1000:.1f}ms, "
+              f"{baked_samples / bake_time:.0f} samples/s, "
+              f"{baked_samples * target_skeleton.joint_count / bake_time:.0f} joints/s")
+    print(f"total {(perf_counter() - start) * 1000:.1f}ms")
+    return out_file
+
+
+def main():
+    parser = ArgumentParser(description="Bakes clip libraries into a palette file.")
+    parser.add_argument('files', nargs='*', help=f"clip libraries, defaults to every library in {ANIMATION_FOLDER}")
+    parser.add_argument('--skeleton', default='robot', help=f"a skeleton in {SKELETON_FOLDER}")
+    parser.add_argument('--rate', type=float, default=palette_cache.DEFAULT_SAMPLE_RATE,
+                        help="samples per second of clip time")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, defaults to one per core")
+    parser.add_argument('--out', default=None, help=f"the palette file, defaults to {BAKED_FOLDER}/SKELETON.bpal")
+    parser.add_argument('--force', action='store_true', help="rebake every clip")
+    args = parser.parse_args()
+
+    bake(args.skeleton, args.files, args.rate, args.workers, args.out, args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Times importing each layer in a fresh interpreter, and checks the core layer never imports arcade.
+#   Run from the project root: python -m benchmarks.import_times [runs]
+#
+#   The core layer (skeletons, clips, sampling, blending, crowds, lin_al, the clock) is headless, so pose evaluation
+#   can run in server processes and worker pools without a window or a GL context. The render layer is everything
+#   that draws, and it imports the core.
+import sys
+import subprocess
+from statistics import median
+
+
+CORE_MODULES = ('lin_al', 'clock', 'global_access', 'memory', 'profiling', 'transform', 'skeleton', 'animation',
+                'compression', 'clip_file', 'palette_cache', 'crowd', 'pose_workers', 'lod', 'scheduler')
+RENDER_MODULES = ('model', 'skinned_renderer', 'loading', 'profiling_overlay')
+
+TIMER = """
+import sys
+from time import perf_counter
+start = perf_counter()
+for module in sys.argv[1:]:
+    __import__(module)
+print(perf_counter() - start, 'arcade' in sys.modules)
+"""
+
+
+def time_import(modules, runs):
+    """
+    :return: the median import time in seconds, and whether arcade was imported.
+    """
+    times, imports_arcade = [], False
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', TIMER, *modules], capture_output=True, text=True, check=True)
+        import_time, arcade_imported = output.stdout.split()
+        times.append(float(import_time))
+        imports_arcade = imports_arcade or arcade_imported == 'True'
+    return median(times), imports_arcade
+
+
+def main(runs=5):
+    core_time, core_imports_arcade = time_import(CORE_MODULES, runs)
+    print(f"{'core':<8} {core_time * 1000:8.1f}ms  {'imports arcade' if core_imports_arcade else 'headless'}")
+
+    try:
+        render_time, _ = time_import(CORE_MODULES + RENDER_MODULES, runs)
+        print(f"{'render':<8} {render_time * 1000:8.1f}ms  (core + {render_time * 1000 - core_time * 1000:.1f}ms)")
+    except subprocess.CalledProcessError as error:
+        print(f"the render layer could not be imported:\n{error.stderr.strip().splitlines()[-1]}")
+
+    if core_imports_arcade:
+        sys.exit("the core layer must not import arcade")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,74 @@
+# Compares the single process pose evaluation paths against the PoseWorkerPool as the worker count grows.
+#   Run from the project root: python -m benchmarks.pose_worker_scaling [characters] [ticks]
+import sys
+import os
+import random
+from time import perf_counter
+
+import animation
+import clip_file
+import skeleton
+from clock import GAME_CLOCK
+from crowd import CrowdAnimator
+from pose_workers import PoseWorkerPool
+
+
+class BenchCharacter:
+    """
+    The parts of a SkinnedRenderer the animation systems use, without a model or a GL context.
+    """
+
+    def __init__(self, target_skeleton, clip):
+        self.skeleton = target_skeleton
+        self.animator = animation.AnimationSet()
+        self.animator.add_animation(clip, 1, random.random(), -1, random.uniform(0.25, 0.5))
+        self.palette = None
+        self.crowd = None
+        self.joint_lod = None
+
+
+def time_ticks(update, ticks):
+    update()
+    start = perf_counter()
+    for _ in range(ticks):
+        GAME_CLOCK.increment()
+        update()
+    return (perf_counter() - start) / ticks
+
+
+def main(character_count=2000, ticks=60):
+    random.seed(0)
+    GAME_CLOCK.begin()
+    clip = clip_file.load_clips("resources/poses/animations/robot_motion.json", 'run')
+    target_skeleton = skeleton.create_skeleton("robot")
+    characters = [BenchCharacter(target_skeleton, clip) for _ in range(character_count)]
+
+    def get_poses():
+        for character in characters:
+            character.animator.get_poses()
+
+    results = [("AnimationSet.get_poses", time_ticks(get_poses, max(ticks // 10, 1)))]
+
+    crowd = CrowdAnimator()
+    for character in characters:
+        crowd.register(character)
+    results.append(("CrowdAnimator", time_ticks(crowd.update, ticks)))
+    for character in characters:
+        crowd.unregister(character)
+
+    worker_count = 1
+    while worker_count <= (os.cpu_count() or 1):
+        with PoseWorkerPool(target_skeleton, [clip], worker_count, capacity=character_count) as pool:
+            for character in characters:
+                pool.register(character)
+            results.append((f"PoseWorkerPool x{worker_count}", time_ticks(pool.update, ticks)))
+        worker_count *= 2
+
+    baseline = results[0][1]
+    print(f"{character_count} characters, {target_skeleton.joint_count} joints")
+    for name, tick_time in results:
+        print(f"{name:<26} {tick_time * 1000:9.2f} ms/tick  {baseline / tick_time:7.1f}x")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
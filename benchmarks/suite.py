@@ -0,0 +1,400 @@
+# Micro-benchmarks of the animation hot paths, with scaling sweeps over joint count, clip length, concurrent
+#   animations, and characters. Runs headless. Run from the project root:
+#
+#   python -m benchmarks.suite [--filter TEXT] [--quick] [--out FILE] [--baseline FILE] [--threshold 0.1]
+#
+#   Results are written as json. Given a baseline (an earlier results file) every case that got slower by more than
+#   the threshold is flagged as a regression, and the exit status is 1. --results FILE compares an existing results
+#   file against the baseline without running anything.
+#
+#   Every synthetic skeleton and clip is seeded, and the GAME_CLOCK is stepped by a fixed amount, so two runs time the
+#   same work.
+import sys
+import os
+import json
+import random
+import platform
+import tempfile
+from datetime import datetime
+from statistics import median
+from timeit import Timer
+from argparse import ArgumentParser
+from typing import Dict, Callable
+
+import numpy as np
+
+import lin_al as la
+import skeleton
+import animation
+from clock import GAME_CLOCK
+from crowd import CrowdAnimator
+from memory import ASSETS
+from benchmarks.pose_worker_scaling import BenchCharacter
+
+
+RESULTS_FOLDER = "benchmarks/results"
+DEFAULT_THRESHOLD = 0.1  # a case more than 10% slower than its baseline is a regression
+
+JOINT_COUNTS = (8, 32, 128, 512)
+FRAME_COUNTS = (8, 64, 512)
+ANIMATION_COUNTS = (1, 2, 4, 8)
+CHARACTER_COUNTS = (1, 16, 128, 1024)
+BATCH_COUNTS = (32, 1024)
+
+
+class Case:
+    """
+    One benchmark at one point of its sweep. setup is only called if the case is run, and returns the callable to time.
+    """
+
+    def __init__(self, group, params, setup: Callable[[], Callable]):
+        self.group: str = group
+        self.params: Dict = params
+        self.setup: Callable[[], Callable] = setup
+
+    @property
+    def name(self):
+        if not self.params:
+            return self.group
+        return f"{self.group}[{','.join(f'{key}={value}' for key, value in self.params.items())}]"
+
+
+# -- SYNTHETIC DATA --
+
+def make_skeleton(joint_count, seed=0):
+    """
+    A random tree where each joint hangs off one of the four joints before it, so it is deeper than it is wide like
+    a real character.
+    """
+    rng = random.Random(seed)
+    joints = [skeleton.Joint(la.Affine2(), 'joint 0', -1)]
+    for index in range(1, joint_count):
+        parent = rng.randrange(max(0, index - 4), index)
+        bind_pose = joints[parent].inv_bind_pose_matrix.inverse() * la.Affine2(ty=rng.uniform(0.1, 1.0))
+        joints.append(skeleton.Joint(bind_pose.inverse(), f"joint {index}", parent))
+    return skeleton.Skeleton(joints, f"synthetic {joint_count}")
+
+
+def make_frames(joint_count, frame_count, seed=0):
+    """
+    :return: json style frames of [angle, tx, ty] per joint.
+    """
+    rng = np.random.default_rng(seed)
+    frames = np.zeros((frame_count, joint_count, 3))
+    frames[..., 0] = rng.uniform(-np.pi, np.pi, (frame_count, joint_count))
+    frames[..., 2] = rng.uniform(0.1, 1.0, joint_count)
+    return frames.tolist()
+
+
+def make_clip(target_skeleton, frame_count, seed=0):
+    frame_data = animation.generate_clip_data(make_frames(target_skeleton.joint_count, frame_count, seed))
+    return animation.Clip(target_skeleton, frame_data, 1 / 30, True)
+
+
+def make_characters(target_skeleton, clips, character_count, animation_count=1, seed=0):
+    rng = random.Random(seed)
+    characters = []
+    for _ in range(character_count):
+        character = BenchCharacter(target_skeleton, rng.choice(clips))
+        for _ in range(animation_count - 1):
+            character.animator.add_animation(rng.choice(clips), rng.uniform(0.1, 1), rng.random(), -1,
+                                             rng.uniform(0.25, 0.5))
+        characters.append(character)
+    return characters
+
+
+def stepped(run):
+    """
+    Steps the clock by a fixed tick before each call so the sampled frame_ts move like a running game.
+    """
+    def step():
+        GAME_CLOCK.increment()
+        run()
+    return step
+
+
+# -- CASES --
+
+def lin_al_cases():
+    vec_a, vec_b = la.Vec2(1.5, 2.5), la.Vec2(-0.5, 3)
+    matrix_a, matrix_b = la.Matrix33.all_matrix(la.Vec2(1, 2), la.Vec2(2), 0.5), la.Matrix33.rotation_matrix(1.2)
+    affine_a, affine_b = la.Affine2.all_matrix(la.Vec2(1, 2), la.Vec2(2), 0.5), la.Affine2.rot_trans(1.2, 3, 4)
+    angles = np.linspace(0, 2 * np.pi, 1024)
+    translations = np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+
+    yield Case('lin_al.Vec2.add', {}, lambda: lambda: vec_a + vec_b)
+    yield Case('lin_al.Vec2.theta', {}, lambda: lambda: la.Vec2(3, 4).theta)
+    yield Case('lin_al.Matrix33.mul', {}, lambda: lambda: matrix_a * matrix_b)
+    yield Case('lin_al.Affine2.mul', {}, lambda: lambda: affine_a * affine_b)
+    yield Case('lin_al.Affine2.inverse', {}, lambda: lambda: affine_a.inverse())
+    yield Case('lin_al.Affine2.transform', {}, lambda: lambda: affine_a.transform(vec_a))
+    yield Case('lin_al.Matrix33Array.all_matrices', {'matrices': len(angles)},
+               lambda: lambda: la.Matrix33Array.all_matrices(translations, None, angles))
+
+
+def lin_al_batch_cases():
+    """
+    The same work done once with a list of Vec2 / Matrix33 and once with Vec2Array / Matrix33Array, so the speed up
+    of the batched types can be read off each pair of results.
+    """
+    for count in BATCH_COUNTS:
+        for impl in ('objects', 'arrays'):
+            for operation in ('all_matrices', 'mul', 'transform', 'lazy_inverse'):
+                def setup(count=count, impl=impl, operation=operation):
+                    rng = np.random.default_rng(count)
+                    angles = rng.uniform(-np.pi, np.pi, count)
+                    translations = rng.uniform(-1, 1, (count, 2))
+                    points = rng.uniform(-1, 1, (count, 2))
+
+                    if impl == 'arrays':
+                        vectors = la.Vec2Array(points)
+                        matrices = la.Matrix33Array.all_matrices(translations, None, angles)
+                        others = la.Matrix33Array(matrices.values[::-1])
+                        runs = {'all_matrices': lambda: la.Matrix33Array.all_matrices(translations, None, angles),
+                                'mul': lambda: matrices * others,
+                                'transform': lambda: vectors * matrices,
+                                'lazy_inverse': lambda: matrices.lazy_inverse()}
+                        return runs[operation]
+
+                    pairs = list(zip(translations.tolist(), angles.tolist()))
+                    vectors = [la.Vec2(x, y) for x, y in points.tolist()]
+                    matrices = [la.Matrix33.all_matrix(la.Vec2(x, y), la.Vec2(1), angle) for (x, y), angle in pairs]
+                    others = matrices[::-1]
+                    runs = {'all_matrices': lambda: [la.Matrix33.all_matrix(la.Vec2(x, y), la.Vec2(1), angle)
+                                                     for (x, y), angle in pairs],
+                            'mul': lambda: [matrix * other for matrix, other in zip(matrices, others)],
+                            'transform': lambda: [vector * matrix for vector, matrix in zip(vectors, matrices)],
+                            'lazy_inverse': lambda: [la.Matrix33.lazy_inverse(matrix) for matrix in matrices]}
+                    return runs[operation]
+                yield Case(f'lin_al.batch.{operation}', {'count': count, 'impl': impl}, setup)
+
+
+def get_pose_cases():
+    for joint_count in JOINT_COUNTS:
+        for frame_count in FRAME_COUNTS:
+            def setup(joint_count=joint_count, frame_count=frame_count):
+                anim = animation.Animation(make_clip(make_skeleton(joint_count), frame_count), 1, 0, -1, 0.5)
+                return stepped(anim.get_pose)
+            yield Case('Animation.get_pose', {'joints': joint_count, 'frames': frame_count}, setup)
+
+
+def get_poses_cases():
+    for animation_count in ANIMATION_COUNTS:
+        def setup(animation_count=animation_count):
+            target_skeleton = make_skeleton(32)
+            clips = [make_clip(target_skeleton, 64, seed) for seed in range(4)]
+            character, = make_characters(target_skeleton, clips, 1, animation_count)
+            return stepped(character.animator.get_poses)
+        yield Case('AnimationSet.get_poses', {'animations': animation_count}, setup)
+
+    for animation_count in ANIMATION_COUNTS:
+        def setup(animation_count=animation_count):
+            target_skeleton = make_skeleton(32)
+            clips = [make_clip(target_skeleton, 64, seed) for seed in range(4)]
+            character, = make_characters(target_skeleton, clips, 1, animation_count)
+            return stepped(character.animator.get_palette)
+        yield Case('AnimationSet.get_palette', {'animations': animation_count}, setup)
+
+
+def compose_cases():
+    for joint_count in JOINT_COUNTS:
+        for character_count in CHARACTER_COUNTS:
+            def setup(joint_count=joint_count, character_count=character_count):
+                target_skeleton = make_skeleton(joint_count)
+                pose_data = make_clip(target_skeleton, character_count).frame_data
+                local_matrices = animation.local_matrices(pose_data)
+                out = np.empty_like(local_matrices)
+                return lambda: target_skeleton.compose(local_matrices, out)
+            yield Case('Skeleton.compose', {'joints': joint_count, 'characters': character_count}, setup)
+
+
+def crowd_cases():
+    for character_count in CHARACTER_COUNTS:
+        def setup(character_count=character_count):
+            target_skeleton = make_skeleton(32)
+            clips = [make_clip(target_skeleton, 64, seed) for seed in range(4)]
+            crowd = CrowdAnimator()
+            for character in make_characters(target_skeleton, clips, character_count, 2):
+                crowd.register(character)
+            return stepped(crowd.update)
+        yield Case('CrowdAnimator.update', {'characters': character_count, 'animations': 2}, setup)
+
+
+def find_quarter_mask(target_skeleton):
+    """
+    The mask of the joint whose subtree is closest to a quarter of the skeleton, like an arm or the upper body.
+    """
+    masks = [target_skeleton.get_mask(joint.joint_name) for joint in target_skeleton.joints]
+    return min(masks, key=lambda mask: abs(len(mask.joints) - target_skeleton.joint_count / 4))
+
+
+def layer_cases():
+    for layer in ('none', 'masked', 'full'):
+        def setup(layer=layer):
+            target_skeleton = make_skeleton(32)
+            clips = [make_clip(target_skeleton, 64, seed) for seed in range(4)]
+            mask = find_quarter_mask(target_skeleton) if layer == 'masked' else None
+            additive_clip = animation.make_additive_clip(clips[0])
+            crowd = CrowdAnimator()
+            for character in make_characters(target_skeleton, clips, 128):
+                if layer != 'none':
+                    character.animator.add_animation(additive_clip, 0.5, 0, -1, 0.5, mask)
+                crowd.register(character)
+            return stepped(crowd.update)
+        yield Case('CrowdAnimator.update', {'characters': 128, 'layer': layer}, setup)
+
+
+def transition_cases():
+    for transition in ('crossfade', 'inertialized'):
+        def setup(transition=transition):
+            target_skeleton = make_skeleton(32)
+            clips = [make_clip(target_skeleton, 64, seed) for seed in range(2)]
+            character, = make_characters(target_skeleton, clips[:1], 1)
+            if transition == 'crossfade':
+                character.animator.add_animation(clips[1], 1, 0, -1, 0.5)
+            else:
+                character.animator.transition(clips[1], 1e9)  # never finishes, so every call is mid blend
+            return stepped(character.animator.get_palette)
+        yield Case('AnimationSet.get_palette', {'transition': transition}, setup)
+
+
+def generate_clips_cases():
+    for frame_count in FRAME_COUNTS:
+        def setup(frame_count=frame_count):
+            target_skeleton = skeleton.create_skeleton('robot')
+            library = {'target': 'robot', 'clips': [
+                {'id': f"clip {index}", 'fps': 1 / 30, 'loop': True,
+                 'frames': make_frames(target_skeleton.joint_count, frame_count, index)} for index in range(4)]}
+
+            folder = tempfile.mkdtemp()
+            file = os.path.join(folder, f"suite_{frame_count}.json")
+            with open(file, 'w') as library_file:
+                json.dump(library, library_file)
+            prefix = animation.clip_key(animation.library_name(file), '')
+
+            def generate():
+                # Forget the registered clips, otherwise every call after the first is a registry lookup.
+                for key in [key for key in ASSETS.entries if key.startswith(prefix)]:
+                    ASSETS.remove(key)
+                animation.generate_clips(file, None)
+            return generate
+        yield Case('animation.generate_clips', {'clips': 4, 'frames': frame_count}, setup)
+
+
+def load_mesh_model_cases():
+    for use_cache in (False, True):
+        def setup(use_cache=use_cache):
+            import model  # the render layer, only needed for this case
+            return lambda: model.load_mesh_model('robot', use_cache)
+        yield Case('model.load_mesh_model', {'model': 'robot', 'cache': use_cache}, setup)
+
+
+SUITES = (lin_al_cases, lin_al_batch_cases, get_pose_cases, get_poses_cases, compose_cases, crowd_cases, layer_cases,
+          transition_cases, generate_clips_cases, load_mesh_model_cases)
+
+
+# -- RUNNING --
+
+def time_case(run, target_time, repeats):
+    """
+    Finds how many calls take at least target_time, then times that many calls repeats times.
+    :return: the seconds per call of each repeat, and the calls per repeat.
+    """
+    timer = Timer(run)
+    number = 1
+    while timer.timeit(number) < target_time and number < 1 << 20:
+        number *= 2
+    return [timer.timeit(number) / number for _ in range(repeats)], number
+
+
+def run_suite(name_filter='', target_time=0.05, repeats=5):
+    GAME_CLOCK.begin()
+    results = {}
+    for suite in SUITES:
+        for case in suite():
+            if name_filter not in case.name:
+                continue
+            try:
+                run = case.setup()
+                run()
+            except ImportError as error:
+                print(f"{case.name:<64} skipped, {error}")
+                continue
+
+            times, number = time_case(run, target_time, repeats)
+            results[case.name] = {'group': case.group, 'params': case.params, 'median': median(times),
+                                  'min': min(times), 'repeats': repeats, 'number': number}
+            print(f"{case.name:<64} {median(times) * 1e6:12.2f}us  (min {min(times) * 1e6:.2f}us)")
+    return results
+
+
+def machine_info():
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Prints every case in both runs with its change in median time.
+    :return: the names of the cases that regressed by more than the threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            verdict = 'REGRESSION'
+        elif ratio < 1 - threshold:
+            verdict = 'faster'
+        else:
+            verdict = ''
+        print(f"{name:<64} {baseline[name]['median'] * 1e6:12.2f}us -> {result['median'] * 1e6:12.2f}us  "
+              f"{ratio:6.2f}x  {verdict}")
+
+    missing = len(set(baseline) - set(results))
+    if missing:
+        print(f"{missing} baseline cases were not run")
+    print(f"{len(regressions)} regressions over {threshold:.0%}")
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description="Micro-benchmarks of the animation hot paths.")
+    parser.add_argument('--filter', default='', help="only run cases whose name contains this")
+    parser.add_argument('--quick', action='store_true', help="shorter timings, for a rough check")
+    parser.add_argument('--out', default=None, help=f"the results file, defaults to {RESULTS_FOLDER}/DATE.json")
+    parser.add_argument('--baseline', default=None, help="a results file to flag regressions against")
+    parser.add_argument('--results', default=None, help="compare this results file instead of running the suite")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="the slow down, as a fraction, that counts as a regression")
+    args = parser.parse_args()
+
+    if args.results is not None:
+        with open(args.results) as results_file:
+            results = json.load(results_file)['results']
+    else:
+        if args.quick:
+            results = run_suite(args.filter, 0.01, 3)
+        else:
+            results = run_suite(args.filter)
+
+        out_file = args.out
+        if out_file is None:
+            os.makedirs(RESULTS_FOLDER, exist_ok=True)
+            out_file = os.path.join(RESULTS_FOLDER, f"{datetime.now():%Y-%m-%d_%H-%M-%S}.json")
+        with open(out_file, 'w') as results_file:
+            json.dump({'machine': machine_info(), 'results': results}, results_file, indent=2)
+        print(f"results written to {out_file}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
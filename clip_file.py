@@ -0,0 +1,232 @@
+# A binary container for clips, so a clip library can be memory mapped rather than parsed. The json files in
+#   resources/poses/animations stay the editable source, the binary files are converted from them.
+#
+#   Layout, all little endian:
+#       - header: magic, version, clip count, joint count, skeleton id.
+#       - offset table: one entry per clip of clip id, byte offset of its frames, frame count, fps, and looping.
+#       - frame blocks: each clip's float32 (frames, joints, 4) frame data [cos, sin, tx, ty], 16 byte aligned.
+#
+#   Loading only reads the header and offset table. Every clip's frame data is a read-only view straight into the
+#   mapping, so nothing is copied or paged in until a clip is sampled.
+
+from typing import Dict, Tuple
+import json
+import mmap
+import os
+import struct
+import sys
+import uuid
+
+import numpy as np
+
+import skeleton
+import animation
+import compression
+from memory import ASSETS, asset_key
+from profiling import span
+
+
+MAGIC = b'BCLP'
+VERSION = 1
+EXTENSION = '.bclip'
+
+ID_SIZE = 32
+HEADER = struct.Struct(f'<4sHII{ID_SIZE}s')
+TABLE_ENTRY = struct.Struct(f'<{ID_SIZE}sQId?7x')
+ALIGNMENT = 16
+
+FRAME_DTYPE = np.dtype('<f4')
+
+
+def pack_id(text: str):
+    encoded = text.encode('utf-8')
+    if len(encoded) > ID_SIZE:
+        raise ValueError(f"'{text}' is longer than the {ID_SIZE} bytes a clip file allows for an id")
+    return encoded
+
+
+def unpack_id(data: bytes):
+    return data.rstrip(b'\0').decode('utf-8')
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_clip_file(file, skeleton_id, clips: Dict[str, Tuple[np.ndarray, float, bool]]):
+    """
+    Writes a clip file.
+    :param file: the path to write to.
+    :param skeleton_id: the skeleton every clip targets.
+    :param clips: clip id to (frame_data, fps, is_looping). All frame data must have the same joint count.
+    """
+    joint_counts = {frame_data.shape[1] for frame_data, _, _ in clips.values()}
+    if len(joint_counts) > 1:
+        raise ValueError(f"the clips of one clip file must share a joint count, got {sorted(joint_counts)}")
+    joint_count = joint_counts.pop() if joint_counts else 0
+
+    offset = align(HEADER.size + TABLE_ENTRY.size * len(clips))
+    table, blocks = [], []
+    for clip_id, (frame_data, fps, is_looping) in clips.items():
+        table.append(TABLE_ENTRY.pack(pack_id(clip_id), offset, len(frame_data), fps, is_looping))
+        blocks.append((offset, np.ascontiguousarray(frame_data, dtype=FRAME_DTYPE)))
+        offset = align(offset + frame_data.size * FRAME_DTYPE.itemsize)
+
+    # Written beside the target then swapped in, so an existing mapping of the old file is never truncated. The temp
+    #   file is unique to the call, so two threads or processes converting the same library cannot write into one.
+    temp_file = f"{file}.{uuid.uuid4().hex}.tmp"
+    with open(temp_file, 'wb') as clip_file:
+        clip_file.write(HEADER.pack(MAGIC, VERSION, len(clips), joint_count, pack_id(skeleton_id)))
+        clip_file.write(b''.join(table))
+        for block_offset, frame_data in blocks:
+            clip_file.write(b'\0' * (block_offset - clip_file.tell()))
+            clip_file.write(frame_data.tobytes())
+    os.replace(temp_file, file)
+
+
+def convert(json_file, out_file=None):
+    """
+    Converts a json clip library into a clip file.
+    :param out_file: defaults to the json file with its extension swapped.
+    :return: the path written to.
+    """
+    if out_file is None:
+        out_file = os.path.splitext(json_file)[0] + EXTENSION
+
+    json_data = json.load(open(json_file))
+    clips = {clip_data['id']: (animation.generate_clip_data(clip_data['frames']), clip_data['fps'], clip_data['loop'])
+             for clip_data in json_data['clips']}
+    write_clip_file(out_file, json_data['target'], clips)
+    return out_file
+
+
+class ClipFile:
+    """
+    An open, memory mapped clip file. Clips are only built when asked for, and are views into the mapping.
+    """
+
+    def __init__(self, file):
+        self.file: str = file
+        with open(file, 'rb') as clip_file:
+            self.mapping: mmap.mmap = mmap.mmap(clip_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.mapping) < HEADER.size:
+            raise ValueError(f"{file} is too short to be a clip file")
+        magic, version, clip_count, self.joint_count, skeleton_id = HEADER.unpack_from(self.mapping)
+        if magic != MAGIC:
+            raise ValueError(f"{file} is not a clip file")
+        if version != VERSION:
+            raise ValueError(f"{file} is clip file version {version}, only version {VERSION} can be read")
+        self.skeleton_id: str = unpack_id(skeleton_id)
+
+        # clip id to (byte offset, frame count, fps, is looping)
+        self.table: Dict[str, Tuple[int, int, float, bool]] = {}
+        for entry in TABLE_ENTRY.iter_unpack(self.mapping[HEADER.size:HEADER.size + TABLE_ENTRY.size * clip_count]):
+            clip_id, *clip_info = entry
+            self.table[unpack_id(clip_id)] = tuple(clip_info)
+
+    @property
+    def clip_ids(self):
+        return tuple(self.table)
+
+    @property
+    def nbytes(self):
+        return len(self.mapping)
+
+    def frame_data(self, clip_id):
+        offset, frame_count, _, _ = self.table[clip_id]
+        return np.frombuffer(self.mapping, FRAME_DTYPE, frame_count * self.joint_count * 4,
+                             offset).reshape(frame_count, self.joint_count, 4)
+
+    def clip(self, clip_id, target_skeleton=None):
+        if target_skeleton is None:
+            target_skeleton = skeleton.create_skeleton(self.skeleton_id)
+        if target_skeleton.joint_count != self.joint_count:
+            raise ValueError(f"{self.file} has clips for {self.joint_count} joints, but the skeleton "
+                             f"{target_skeleton.skeleton_id} has {target_skeleton.joint_count}")
+
+        _, _, fps, is_looping = self.table[clip_id]
+        return animation.Clip(target_skeleton, self.frame_data(clip_id), fps, is_looping)
+
+
+def clip_file_key(file):
+    return asset_key('clip_file', os.path.abspath(file))
+
+
+def open_clip_file(file):
+    """
+    :return: the open ClipFile of a path. Open clip files are registered assets, so their mappings count towards the
+    budget and show in the memory report. An evicted clip file's mapping lives on in any clips still viewing it.
+    """
+    return ASSETS.get(clip_file_key(file), lambda: ClipFile(file))
+
+
+def find_clip_file(file):
+    """
+    :return: the clip file for a path. A json library is converted, or reconverted when it is newer than its
+    clip file.
+    """
+    if not file.endswith('.json'):
+        return file
+
+    binary_file = os.path.splitext(file)[0] + EXTENSION
+    if not os.path.exists(binary_file) or os.path.getmtime(binary_file) < os.path.getmtime(file):
+        with ASSETS.lock:
+            if clip_file_key(binary_file) in ASSETS:
+                ASSETS.remove(clip_file_key(binary_file))
+        convert(file, binary_file)
+    return binary_file
+
+
+@span('loading')
+def load_clips(file, target, error_bound=None):
+    """
+    A drop in for animation.generate_clips. Only the target clip is built, or every clip when target is None. Clips
+    are registered with the asset registry under the same keys as generate_clips uses, so a clip already loaded from
+    either is shared.
+    :param file: a clip file, or a json clip library to use the converted clip file of.
+    :param error_bound: if given, the clips are compressed on load to within this model space error. Compressed clips
+    are registered separately for each bound.
+    """
+    library = animation.library_name(file)
+
+    def find_key(clip_id):
+        key = animation.clip_key(library, clip_id)
+        return key if error_bound is None else f"{key}~{error_bound:g}"
+
+    if target is not None and find_key(target) in ASSETS:
+        return ASSETS.get(find_key(target))
+
+    clip_file = open_clip_file(find_clip_file(file))
+    target_skeleton = skeleton.create_skeleton(clip_file.skeleton_id)
+
+    def load(clip_id):
+        clip = clip_file.clip(clip_id, target_skeleton)
+        if error_bound is not None:
+            clip = compression.compress_clip(clip, error_bound, clip_id)
+        return clip
+
+    for clip_id in (clip_file.clip_ids if target is None else (target,)):
+        clip = ASSETS.get(find_key(clip_id), lambda: load(clip_id))
+
+    if target is not None:
+        return clip
+
+
+def main(files):
+    """
+    Converts json clip libraries, every library in resources/poses/animations when none are given.
+    """
+    if not files:
+        folder = "resources/poses/animations"
+        files = [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith('.json')]
+
+    for file in files:
+        out_file = convert(file)
+        clip_file = ClipFile(out_file)
+        print(f"{file} -> {out_file}: {len(clip_file.clip_ids)} clips, {clip_file.joint_count} joints, "
+              f"{os.path.getsize(out_file)} bytes")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,312 @@
+# Keyframe compression for clips. Most joints barely move for most of a clip, so storing every channel of every
+#   joint for every frame wastes memory. A CompressedClip stores each joint's angle, x, and y as separate channels,
+#   each with only the keys needed to stay within an error bound, and every key quantised to 16 bits.
+#
+#   The error bound is measured in model space. Each joint is probed at its origin and at a point one bone length
+#   along its x axis, and the probes of the compressed clip must stay within the bound of the original's at every
+#   frame. Per channel tolerances are derived from the bound and the skeleton's bone lengths, then halved until the
+#   whole clip fits.
+#
+#   Sampling works straight from the keys and has the same interface as animation.Clip, so a CompressedClip can be
+#   played by an Animation, a crowd, or an update LOD in place of a Clip.
+
+from typing import List
+import sys
+
+import numpy as np
+
+import lin_al as la
+import skeleton
+import animation
+from profiling import span
+
+
+DEFAULT_ERROR_BOUND = 1e-3  # model space units
+MAX_PASSES = 8
+
+QUANTISED_MAX = np.iinfo(np.uint16).max
+CHANNELS = 3  # angle, x, y
+
+
+def find_reaches(target_skeleton: skeleton.Skeleton):
+    """
+    :return: each joint's bone length, the distance to its furthest child or, for a leaf, its parent. Then the
+    furthest any probe below each joint is from it in the bind pose, which scales how far an angle error travels.
+    """
+    positions = la.Vec2Array.from_vecs(joint.joint_model_pos for joint in target_skeleton.joints).values
+    parents = target_skeleton.parents
+
+    bone_lengths = np.zeros(target_skeleton.joint_count)
+    for joint, parent in enumerate(parents):
+        if parent != -1:
+            distance = np.linalg.norm(positions[joint] - positions[parent])
+            bone_lengths[parent] = max(bone_lengths[parent], distance)
+    for joint, parent in enumerate(parents):
+        if bone_lengths[joint] == 0 and parent != -1:
+            bone_lengths[joint] = np.linalg.norm(positions[joint] - positions[parent])
+
+    subtree_reaches = bone_lengths.copy()
+    for joint in reversed(range(target_skeleton.joint_count)):
+        parent = parents[joint]
+        if parent != -1:
+            reach = np.linalg.norm(positions[joint] - positions[parent]) + subtree_reaches[joint]
+            subtree_reaches[parent] = max(subtree_reaches[parent], reach)
+
+    return bone_lengths, subtree_reaches
+
+
+def probe_points(target_skeleton: skeleton.Skeleton, pose_data: np.ndarray, bone_lengths: np.ndarray):
+    """
+    :return: (..., joints, 2, 2) the model space origin and bone tip of every joint.
+    """
+    model_poses = target_skeleton.compose(animation.local_matrices(pose_data))
+    origins = model_poses[..., 2, :2]
+    tips = origins + model_poses[..., 0, :2] * bone_lengths[:, None]
+    return np.stack((origins, tips), axis=-2)
+
+
+def unpack_channels(frame_data: np.ndarray):
+    """
+    :return: (frames + 1, joints * 3) channel curves of [angle, x, y]. The extra frame is the first frame again, which
+    is what the last frame lerps to. Angles are unwrapped so a lerp between two keys never goes the long way round.
+    """
+    looped = np.concatenate((frame_data, frame_data[:1]))
+    channels = np.empty((*looped.shape[:2], CHANNELS))
+    channels[..., 0] = np.unwrap(np.arctan2(looped[..., 1], looped[..., 0]), axis=0)
+    channels[..., 1:] = looped[..., 2:]
+    return channels.reshape(len(looped), -1)
+
+
+def reduce_keys(curve: np.ndarray, tolerance: float):
+    """
+    Finds the keys of one channel. Starting from the first and last key, the frame furthest from the lerp between its
+    neighbouring keys is made a key until every frame is within the tolerance.
+    :return: the sorted key frames.
+    """
+    keys = [0, len(curve) - 1]
+    spans = [(0, len(curve) - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+
+        between = np.arange(start + 1, end)
+        line = curve[start] + (curve[end] - curve[start]) * (between - start) / (end - start)
+        errors = np.abs(curve[start + 1:end] - line)
+        worst = int(errors.argmax())
+        if errors[worst] > tolerance:
+            key = start + 1 + worst
+            keys.append(key)
+            spans.extend(((start, key), (key, end)))
+
+    return np.sort(keys)
+
+
+class CompressionReport:
+
+    def __init__(self, clip_id, original_bytes, compressed_bytes, key_count, full_key_count, max_error, mean_error,
+                 error_bound, passes):
+        self.clip_id: str = clip_id
+        self.original_bytes: int = original_bytes
+        self.compressed_bytes: int = compressed_bytes
+        self.key_count: int = key_count
+        self.full_key_count: int = full_key_count
+        self.max_error: float = max_error
+        self.mean_error: float = mean_error
+        self.error_bound: float = error_bound
+        self.passes: int = passes
+
+    @property
+    def ratio(self):
+        return self.original_bytes / max(self.compressed_bytes, 1)
+
+    def __str__(self):
+        return (f"{self.clip_id}: {self.original_bytes} -> {self.compressed_bytes} bytes ({self.ratio:.2f}x), "
+                f"{self.key_count}/{self.full_key_count} keys, error max {self.max_error:.2e} "
+                f"mean {self.mean_error:.2e} (bound {self.error_bound:.2e}, {self.passes} passes)")
+
+
+class CompressedClip:
+    """
+    A clip stored as per channel keys. Every channel's keys are stored back to back, offsets[c]:offsets[c+1] being
+    channel c's. Key values are uint16, a channel's value being minimums[c] + key_value * scales[c].
+    """
+
+    def __init__(self, target_skeleton, frame_count, fps, is_looping, key_frames, key_values, offsets, minimums,
+                 scales):
+        self.skeleton: skeleton.Skeleton = target_skeleton
+        self.frames_per_second = fps
+        self.is_looping: bool = is_looping
+        self.is_additive: bool = False
+        self.is_baked: bool = False
+        self.compressed_frame_count: int = frame_count
+
+        self.key_frames: np.ndarray = key_frames
+        self.key_values: np.ndarray = key_values
+        self.offsets: np.ndarray = offsets
+        self.minimums: np.ndarray = minimums
+        self.scales: np.ndarray = scales
+
+        # Every channel's key frames shifted into their own range so one searchsorted finds the keys of all of them.
+        channels = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        self.search_keys: np.ndarray = channels * (frame_count + 1) + key_frames
+
+        self.report: CompressionReport = None
+        self._frame_data: np.ndarray = None
+
+    @property
+    def frame_count(self):
+        return self.compressed_frame_count
+
+    @property
+    def duration(self):
+        return self.frames_per_second * self.frame_count
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.key_frames, self.key_values, self.offsets, self.minimums,
+                                              self.scales))
+
+    @property
+    def frame_data(self):
+        """
+        The decompressed (frames, joints, 4) frame data, for anything that needs whole frames like the worker pool.
+        """
+        if self._frame_data is None:
+            self._frame_data = self.decode(np.arange(self.frame_count, dtype=float))
+            self._frame_data.flags.writeable = False
+        return self._frame_data
+
+    @property
+    def frames(self):
+        return tuple(animation.FramePoseView(frame_data) for frame_data in self.frame_data)
+
+    def decode(self, positions: np.ndarray, joints=None):
+        """
+        Lerps every channel between the keys either side of each position. Rotations are lerped as unit vectors and
+        normalised, the same as a Clip, so a clip that keeps every key samples the same as the original.
+        :param positions: (samples,) frame positions in [0, frame_count).
+        :param joints: optional indices of the only joints to decode.
+        :return: (samples, joints, 4) pose data.
+        """
+        joint_indices = np.arange(self.skeleton.joint_count) if joints is None else np.asarray(joints)
+        channels = (joint_indices[:, None] * CHANNELS + np.arange(CHANNELS)).ravel()
+
+        queries = channels * (self.frame_count + 1) + positions[:, None]
+        upper = np.minimum(np.searchsorted(self.search_keys, queries, side='right'), self.offsets[channels + 1] - 1)
+        lower = upper - 1
+
+        lower_frames, upper_frames = self.key_frames[lower], self.key_frames[upper]
+        shape = (len(positions), len(joint_indices), CHANNELS)
+        weights = ((positions[:, None] - lower_frames) / (upper_frames - lower_frames)).reshape(shape)
+        lower_values = (self.minimums[channels] + self.key_values[lower] * self.scales[channels]).reshape(shape)
+        upper_values = (self.minimums[channels] + self.key_values[upper] * self.scales[channels]).reshape(shape)
+
+        pose_data = np.empty((*shape[:2], 4), dtype=np.float32)
+        angle_weights = weights[..., 0]
+        lower_angles, upper_angles = lower_values[..., 0], upper_values[..., 0]
+        pose_data[..., 0] = np.cos(lower_angles) * (1 - angle_weights) + np.cos(upper_angles) * angle_weights
+        pose_data[..., 1] = np.sin(lower_angles) * (1 - angle_weights) + np.sin(upper_angles) * angle_weights
+        pose_data[..., 2:] = lower_values[..., 1:] + (upper_values[..., 1:] - lower_values[..., 1:]) * weights[..., 1:]
+        return animation.normalise_rotations(pose_data)
+
+    @span('sampling')
+    def sample(self, frame_t, joints=None):
+        return self.sample_many((frame_t,), joints)[0]
+
+    @span('sampling')
+    def sample_many(self, frame_ts, joints=None):
+        """
+        The same as animation.Clip.sample_many, sampled from the keys.
+        """
+        positions = (np.asarray(frame_ts, dtype=float) * self.frame_count) % self.frame_count
+        return self.decode(positions, joints)
+
+
+def encode_channels(curves: np.ndarray, tolerances: np.ndarray):
+    """
+    Reduces and quantises every channel.
+    :return: key frames, key values, offsets, minimums, and scales for a CompressedClip.
+    """
+    minimums = curves.min(axis=0)
+    scales = (curves.max(axis=0) - minimums) / QUANTISED_MAX
+
+    key_frames, key_values, offsets = [], [], [0]
+    for channel, curve in enumerate(curves.T):
+        keys = reduce_keys(curve, tolerances[channel])
+        quantised = np.zeros(len(keys)) if scales[channel] == 0 else (curve[keys] - minimums[channel]) / scales[channel]
+        key_frames.append(keys)
+        key_values.append(np.rint(quantised))
+        offsets.append(offsets[-1] + len(keys))
+
+    return (np.concatenate(key_frames).astype(np.uint16), np.concatenate(key_values).astype(np.uint16),
+            np.array(offsets, dtype=np.uint32), minimums.astype(np.float32), scales.astype(np.float32))
+
+
+def compress_clip(clip: animation.Clip, error_bound=DEFAULT_ERROR_BOUND, clip_id=''):
+    """
+    Compresses a clip so no probe point moves more than error_bound in model space at any frame. If the bound can not
+    be met in MAX_PASSES every frame is kept and only the quantisation error remains.
+    :return: the CompressedClip, with its CompressionReport as report.
+    """
+    target_skeleton = clip.skeleton
+    frame_count = clip.frame_count
+    if frame_count + 1 > QUANTISED_MAX:
+        raise ValueError(f"a clip of {frame_count} frames is too long to compress, the most is {QUANTISED_MAX - 1}")
+
+    curves = unpack_channels(clip.frame_data)
+    bone_lengths, subtree_reaches = find_reaches(target_skeleton)
+    original_points = probe_points(target_skeleton, clip.frame_data, bone_lengths)
+
+    # An error anywhere up the chain moves everything below it, so the bound is shared between every level.
+    share = error_bound / len(target_skeleton.levels)
+    tolerances = np.empty((target_skeleton.joint_count, CHANNELS))
+    tolerances[:, 0] = share / np.maximum(subtree_reaches, 1e-6)
+    tolerances[:, 1:] = share
+    tolerances = tolerances.ravel()
+
+    for passes in range(1, MAX_PASSES + 2):
+        if passes > MAX_PASSES:
+            tolerances = np.zeros_like(tolerances)
+
+        compressed = CompressedClip(target_skeleton, frame_count, clip.frames_per_second, clip.is_looping,
+                                    *encode_channels(curves, tolerances))
+        errors = np.linalg.norm(probe_points(target_skeleton, compressed.frame_data, bone_lengths) - original_points,
+                                axis=-1)
+        if errors.max(initial=0) <= error_bound or passes > MAX_PASSES:
+            break
+        tolerances = tolerances / 2
+
+    compressed.is_additive = clip.is_additive
+    compressed.report = CompressionReport(clip_id, clip.frame_data.nbytes, compressed.nbytes,
+                                          len(compressed.key_frames), (frame_count + 1) * len(tolerances),
+                                          float(errors.max(initial=0)), float(errors.mean()) if errors.size else 0.0,
+                                          error_bound, passes)
+    return compressed
+
+
+def main(args: List[str]):
+    """
+    Prints a compression report for every clip of the given libraries. Usage: [--error BOUND] [files]
+    """
+    import clip_file
+
+    error_bound = DEFAULT_ERROR_BOUND
+    if args[:1] == ['--error']:
+        error_bound, args = float(args[1]), args[2:]
+    files = args or ["resources/poses/animations/basic_motion.json", "resources/poses/animations/robot_motion.json"]
+
+    original_total, compressed_total = 0, 0
+    for file in files:
+        library = clip_file.open_clip_file(clip_file.find_clip_file(file))
+        for clip_id in library.clip_ids:
+            report = compress_clip(library.clip(clip_id), error_bound, f"{file}:{clip_id}").report
+            original_total += report.original_bytes
+            compressed_total += report.compressed_bytes
+            print(report)
+
+    print(f"total: {original_total} -> {compressed_total} bytes")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
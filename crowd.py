@@ -0,0 +1,256 @@
+# The crowd animator evaluates the AnimationSets of many renderers together. Rather than every renderer sampling and
+#   composing its own poses inside draw(), the crowd gathers every active Animation once per tick, samples each clip
+#   for all of its animations at once, and runs one hierarchy pass per skeleton.
+#
+#   Renderers are grouped by skeleton. Each group owns one float32 palette buffer of shape (characters, joints, 3, 3)
+#   and every registered renderer's palette is a view into it, so nothing is copied on the way to the renderers.
+#   Characters with a joint lod are evaluated in one extra pass per lod. With a palette_cache.PaletteCache the batch
+#   looks up the palette of every character playing a single animation instead, which ignores joint lods. Baked
+#   palettes cannot be blended in local space, so characters playing more than one animation are always sampled.
+#
+#   Animation layers are gathered by their depth, a character's first layer being depth 0. Every layer at a depth
+#   belongs to a different character, so each depth is sampled in one batch per clip and mask and applied at once,
+#   keeping the order each character's layers were added in. Baked palettes cannot be layered or offset, so characters
+#   with layers or a transition in progress are always sampled.
+
+from typing import List, Dict, Tuple
+
+import numpy as np
+
+import skeleton
+import animation
+from profiling import span
+
+
+class SkeletonBatch:
+    """
+    All of the registered renderers that share a skeleton, and the palette buffer they draw from.
+    """
+
+    def __init__(self, target_skeleton, capacity=64, palette_cache=None):
+        self.skeleton: skeleton.Skeleton = target_skeleton
+        self.palette_cache = palette_cache
+        self.renderers: List = []
+        self.palettes: np.ndarray = np.zeros((capacity, target_skeleton.joint_count, 3, 3), dtype=np.float32)
+
+    def add(self, renderer):
+        if len(self.renderers) == len(self.palettes):
+            palettes = np.zeros((2 * len(self.palettes), *self.palettes.shape[1:]), dtype=np.float32)
+            palettes[:len(self.palettes)] = self.palettes
+            self.palettes = palettes
+            self.relink()
+
+        self.renderers.append(renderer)
+        renderer.palette = None
+
+    def remove(self, renderer):
+        # Swap the last renderer into the removed slot so the buffer stays packed.
+        slot = self.renderers.index(renderer)
+        last = self.renderers.pop()
+        if last is not renderer:
+            self.renderers[slot] = last
+            self.palettes[slot] = self.palettes[len(self.renderers)]
+            self.relink()
+
+    def relink(self):
+        for slot, renderer in enumerate(self.renderers):
+            if renderer.palette is not None:
+                renderer.palette = self.palettes[slot]
+
+    def gather(self, slots=None):
+        """
+        Collects every active animation of the characters in slots (by default every character), grouped by character.
+        :return: the rows of each clip, then the frame_t, solved weight, and character slot of every animation that is
+        not a layer. Last the (slot, animation, frame_t) of every layer, by depth.
+        """
+        clips: Dict[animation.Clip, List[int]] = {}
+        frame_ts, weights, characters = [], [], []
+        layers: List[List[Tuple[int, animation.Animation, float]]] = []
+
+        for slot in (range(len(self.renderers)) if slots is None else slots):
+            renderer = self.renderers[slot]
+            animations = renderer.animator.active_animations()
+            if not animations:
+                renderer.palette = None
+                continue
+
+            depth = 0
+            for anim in animations:
+                if anim.is_layer:
+                    if depth == len(layers):
+                        layers.append([])
+                    layers[depth].append((slot, anim, anim.frame_t()))
+                    depth += 1
+                    continue
+
+                clips.setdefault(anim.clip, []).append(len(frame_ts))
+                frame_ts.append(anim.frame_t())
+                weights.append(anim.weight)
+                characters.append(slot)
+            renderer.palette = self.palettes[slot]
+
+        # Solve the weights within each character, the same as solve_weights.
+        characters = np.asarray(characters, dtype=int)
+        weights = np.asarray(weights, dtype=float)
+        if len(weights):
+            starts = np.flatnonzero(np.diff(characters, prepend=-1))
+            weights /= np.repeat(np.add.reduceat(weights, starts), np.diff(starts, append=len(weights)))
+
+        return clips, np.asarray(frame_ts, dtype=float), weights, characters, layers
+
+    def find_joint_lods(self):
+        """
+        :return: the joint lod of every character slot, -1 for the full skeleton.
+        """
+        return np.array([-1 if self.skeleton.get_lod(renderer.joint_lod) is None else renderer.joint_lod
+                         for renderer in self.renderers], dtype=int)
+
+    def evaluate(self, slots=None):
+        """
+        :param slots: the ascending slots of the only characters to evaluate, the rest keep their palettes. Defaults
+        to every character.
+        """
+        slots = range(len(self.renderers)) if slots is None else slots
+        clips, frame_ts, weights, characters, layers = self.gather(slots)
+        layered_slots = [slot for depth in layers for slot, _, _ in depth]
+        inertialized_slots = [slot for slot in slots if self.renderers[slot].palette is not None
+                              and self.renderers[slot].animator.inertialization is not None]
+        posed_slots = np.union1d(layered_slots, inertialized_slots).astype(int)  # the slots that need their poses
+        if not len(frame_ts) and not len(posed_slots):
+            return
+
+        sampled = np.ones(len(frame_ts), dtype=bool)
+        if self.palette_cache is not None:
+            character_slots, animation_counts = np.unique(characters, return_counts=True)
+            sampled = np.isin(characters, np.union1d(posed_slots, character_slots[animation_counts > 1]))
+            cached_clips = {clip: np.asarray(rows)[~sampled[rows]] for clip, rows in clips.items()}
+            self.palette_cache.fill({clip: rows for clip, rows in cached_clips.items() if len(rows)}, frame_ts,
+                                    characters, self.palettes)
+            if not sampled.any() and not len(posed_slots):
+                return
+
+        joint_lods = self.find_joint_lods()
+        animation_lods = joint_lods[characters]
+        for joint_lod in np.unique(np.concatenate([animation_lods[sampled], joint_lods[posed_slots]])):
+            skeleton_lod = self.skeleton.get_lod(None if joint_lod == -1 else joint_lod)
+            joints = None if skeleton_lod is None else skeleton_lod.joints
+            in_lod = sampled & (animation_lods == joint_lod)
+            lod_rows = np.flatnonzero(in_lod)
+
+            joint_count = self.skeleton.joint_count if joints is None else len(joints)
+            pose_data = np.empty((len(frame_ts), joint_count, 4), dtype=np.float32)
+            for clip, rows in clips.items():
+                rows = np.asarray(rows)[in_lod[rows]]
+                if len(rows):
+                    pose_data[rows] = clip.sample_many(frame_ts[rows], joints)
+
+            poses, slots = animation.blend_poses(pose_data[lod_rows], weights[lod_rows], characters[lod_rows])
+            lod_posed_slots = posed_slots[joint_lods[posed_slots] == joint_lod]
+            if len(lod_posed_slots):
+                poses, slots = self.add_bind_poses(poses, slots, lod_posed_slots, skeleton_lod)
+                self.inertialize(poses, slots, skeleton_lod)
+                self.apply_layers(poses, slots, layers, lod_posed_slots, skeleton_lod)
+            self.palettes[slots] = animation.skin_poses(self.skeleton, poses,
+                                                        None if skeleton_lod is None else skeleton_lod.lod)
+
+    def add_bind_poses(self, poses, slots, posed_slots, skeleton_lod):
+        """
+        Gives the characters in posed_slots that have nothing but layers the bind pose to be layered over.
+        :return: the poses and the character slot of each.
+        """
+        bare_slots = np.setdiff1d(posed_slots, slots)
+        if not len(bare_slots):
+            return poses, slots
+
+        bind_pose = self.skeleton.bind_pose
+        if skeleton_lod is not None:
+            bind_pose = bind_pose[skeleton_lod.joints]
+        poses = np.concatenate([poses, np.broadcast_to(bind_pose, (len(bare_slots), *bind_pose.shape))])
+        return poses, np.concatenate([slots, bare_slots])
+
+    def inertialize(self, poses, slots, skeleton_lod):
+        """
+        Adds the offsets of the transitions in progress onto the blended poses, in place.
+        """
+        rows = [row for row, slot in enumerate(slots.tolist())
+                if self.renderers[slot].animator.inertialization is not None]
+        if not rows:
+            return
+
+        offsets = np.stack([self.renderers[slots[row]].animator.inertialization.find_offsets() for row in rows])
+        if skeleton_lod is not None:
+            offsets = offsets[:, skeleton_lod.joints]
+        poses[rows] = animation.add_offsets(poses[rows], offsets)
+
+    def apply_layers(self, poses, slots, layers, layered_slots, skeleton_lod):
+        """
+        Applies the layers of some characters over their blended poses, in place.
+        :param poses: the blended poses of the characters in slots.
+        :param layers: every layer of the batch, by depth, as returned by gather.
+        :param layered_slots: the characters to layer, all of them evaluated at skeleton_lod.
+        """
+        pose_rows = np.full(len(self.renderers), -1)
+        pose_rows[slots] = np.arange(len(slots))
+        is_layered = np.zeros(len(self.renderers), dtype=bool)
+        is_layered[layered_slots] = True
+
+        for depth in layers:
+            groups: Dict[Tuple[animation.Clip, skeleton.JointMask], List[Tuple[int, float, float]]] = {}
+            for slot, anim, frame_t in depth:
+                if is_layered[slot]:
+                    groups.setdefault((anim.clip, anim.mask), []).append((pose_rows[slot], frame_t, anim.weight))
+
+            for (clip, mask), group in groups.items():
+                rows, frame_ts, layer_weights = (np.asarray(column) for column in zip(*group))
+                layer_joints, indices = animation.find_layer_joints(self.skeleton, mask, skeleton_lod)
+                layer_data = clip.sample_many(frame_ts, layer_joints)
+                targets = rows[:, None], indices
+                poses[targets] = animation.apply_layer(poses[targets], layer_data,
+                                                       np.clip(layer_weights, 0, 1).astype(np.float32)[:, None, None],
+                                                       clip.is_additive)
+
+
+class CrowdAnimator:
+    """
+    Evaluates every registered renderer's AnimationSet in one batch per skeleton. Call update once per tick, after
+    the GAME_CLOCK has been incremented. A registered renderer's palette is then written by the crowd, so its draw no
+    longer evaluates its own animations.
+    """
+
+    def __init__(self, palette_cache=None):
+        self.batches: Dict[str, SkeletonBatch] = {}
+        self.palette_cache = palette_cache
+
+    def register(self, renderer):
+        skeleton_id = renderer.skeleton.skeleton_id
+        if skeleton_id not in self.batches:
+            self.batches[skeleton_id] = SkeletonBatch(renderer.skeleton, palette_cache=self.palette_cache)
+
+        self.batches[skeleton_id].add(renderer)
+        renderer.crowd = self
+
+    def unregister(self, renderer):
+        self.batches[renderer.skeleton.skeleton_id].remove(renderer)
+        renderer.crowd = None
+        renderer.palette = None
+
+    @property
+    def character_count(self):
+        return sum(len(batch.renderers) for batch in self.batches.values())
+
+    @span('animation')
+    def update(self, renderers=None):
+        """
+        :param renderers: only evaluate these registered renderers, the rest keep their last palettes. Defaults to
+        every registered renderer.
+        """
+        if renderers is None:
+            for batch in self.batches.values():
+                batch.evaluate()
+            return
+
+        chosen = {id(renderer) for renderer in renderers}
+        for batch in self.batches.values():
+            slots = [slot for slot, renderer in enumerate(batch.renderers) if id(renderer) in chosen]
+            if slots:
+                batch.evaluate(slots)
@@ -6,9 +6,11 @@
 #   Due to personal choice vectors are represented as rows, e.g., [1.0, 2.0]. This is so vector by matrix multiplication
 #   is easier to read. (left to right)
 import math
-from typing import List, Tuple
+from typing import List, Tuple, Iterable
 from math import cos, sin, atan2, sqrt
 
+import numpy as np
+
 
 def dot_3_3(left: Tuple, right: Tuple):
     return left[0] * right[0] + left[1] * right[1] + left[2] * right[2]
@@ -23,29 +25,36 @@ def dot_2_2(left: Tuple, right: Tuple):
 
 
 class Vec2:
+    """
+    Only x and y are stored. The polar form (theta and squared length) is worked out the first time it is read and
+    cached until the cartesian values change, since almost every vector is only ever added and multiplied.
+    """
+    __slots__ = ('_x', '_y', '_theta', '_square_length', 'point')
 
     def __init__(self, x: float = 0, y=None, radial=False, point=True):
-        self._radial: List[float] = [0, 0]  # Theta then Squared Length
-        self._values: List[float] = [0, 0]  # X then Y
-        self._x, self._y, self._theta, self._square_length = .0, .0, .0, .0
         self.point = point
 
         if radial:
-            self.radial = [x, y]
+            self.radial = (x, y)
         else:
-            if y is None:
-                self.values: List[float] = [x, x]
-            else:
-                self.values: List[float] = [x, y]
+            self._x = x
+            self._y = x if y is None else y
+            self._theta = None
+            self._square_length = None
 
     def __mul__(self, other):
         if isinstance(other, Matrix33):
-            return Vec2(dot_3_3(tuple([*self.values, self.point]), other.column_1),
-                        dot_3_3(tuple([*self.values, self.point]), other.column_2))
+            v = other.values
+            x, y, w = self._x, self._y, self.point
+            return Vec2(x*v[0] + y*v[3] + w*v[6], x*v[1] + y*v[4] + w*v[7])
+        elif isinstance(other, Affine2):
+            return other.transform(self)
+        elif isinstance(other, Matrix33Array):
+            return other.transform_points((self._x, self._y), self.point)
         elif isinstance(other, Vec2):
-            return self.x*other.x + self.y*other.y
+            return self._x*other._x + self._y*other._y
         elif isinstance(other, Tuple):
-            result = self.x*other[0] + self.y*other[1]
+            result = self._x*other[0] + self._y*other[1]
             if len(other) > 2:
                 result += other[2]
             return result
@@ -57,33 +66,40 @@ class Vec2:
 
     def __truediv__(self, other):
         if isinstance(other, Vec2):
-            return Vec2(self.x/other.x, self.y/other.y)
+            return Vec2(self._x/other._x, self._y/other._y)
         else:
-            return Vec2(self.x/other, self.y/other)
+            return Vec2(self._x/other, self._y/other)
 
     def __rtruediv__(self, other):
         if isinstance(other, Vec2):
-            return Vec2(other.x / self.x, other.y / self.y)
+            return Vec2(other._x / self._x, other._y / self._y)
         else:
-            return Vec2(other/self.x, other/self.y)
+            return Vec2(other/self._x, other/self._y)
 
     def __add__(self, other):
         if isinstance(other, Vec2):
-            return Vec2(self.x + other.x, self.y + other.y)
+            return Vec2(self._x + other._x, self._y + other._y)
         else:
-            return Vec2(self.x + other, self.y + other)
+            return Vec2(self._x + other, self._y + other)
 
     def __sub__(self, other):
         if isinstance(other, Vec2):
-            return Vec2(self.x - other.x, self.y - other.y)
+            return Vec2(self._x - other._x, self._y - other._y)
         else:
-            return Vec2(self.x - other, self.y - other)
+            return Vec2(self._x - other, self._y - other)
 
     def __neg__(self):
-        return Vec2(-self.x, -self.y)
+        return Vec2(-self._x, -self._y)
 
     def item_mul(self, other):
-        return Vec2(self.x * other.x, self.y * other.y)
+        return Vec2(self._x * other._x, self._y * other._y)
+
+    def _find_polar(self):
+        theta = atan2(self._y, self._x)
+        if theta < 0:
+            theta += 2*math.pi
+        self._theta = theta
+        self._square_length = self._x**2 + self._y**2
 
     @property
     def x(self):
@@ -91,7 +107,8 @@ class Vec2:
 
     @x.setter
     def x(self, value: float):
-        self.values = [value, self._y]
+        self._x = value
+        self._theta = self._square_length = None
 
     @property
     def y(self):
@@ -99,60 +116,60 @@ class Vec2:
 
     @y.setter
     def y(self, value):
-        self.values = [self._x, value]
+        self._y = value
+        self._theta = self._square_length = None
 
     @property
     def theta(self):
+        if self._theta is None:
+            self._find_polar()
         return self._theta
 
     @theta.setter
     def theta(self, value: float):
-        self.radial = [value, self._square_length]
+        self.radial = (value, self.square_length)
 
     @property
     def length(self):
-        return sqrt(self._square_length)
+        return sqrt(self.square_length)
 
     @length.setter
     def length(self, value: float):
-        self._radial = [self._theta, value**2]
+        theta = self.theta
         ratio = value/self.length
-        self._square_length = self._radial[1]
         self._x *= ratio
         self._y *= ratio
-        self._values = [self._x, self._y]
+        self._theta, self._square_length = theta, value**2
 
     @property
     def square_length(self):
+        if self._square_length is None:
+            self._square_length = self._x**2 + self._y**2
         return self._square_length
 
     @square_length.setter
     def square_length(self, value: float):
-        self.radial = [self._theta, value]
+        self.radial = (self.theta, value)
 
     @property
     def radial(self):
-        return self._radial
+        return [self.theta, self.square_length]
 
     @radial.setter
     def radial(self, value: List[float]):
-        self._radial = list(value)
         self._theta, self._square_length = value
-        self._x = cos(self._theta) * self.length
-        self._y = sin(self._theta) * self.length
+        length = sqrt(self._square_length)
+        self._x = cos(self._theta) * length
+        self._y = sin(self._theta) * length
 
     @property
     def values(self):
-        return self._values
+        return [self._x, self._y]
 
     @values.setter
     def values(self, value: List[float]):
-        self._values = list(value)
         self._x, self._y = value
-        self._theta = atan2(self._y, self._x)
-        if self._theta < 0:
-            self._theta += 2*math.pi
-        self._square_length = self._x**2 + self._y**2
+        self._theta = self._square_length = None
 
 
 def lerp(a: Vec2, b: Vec2, transition) -> Vec2:
@@ -200,10 +217,7 @@ class Matrix33:
 
     @staticmethod
     def inverse_all_matrix(translate: Vec2 = Vec2(0), scale: Vec2 = Vec2(1), angle: float = 0):
-        inv_scale = Vec2(1/scale.x, 1/scale.y)
-        return (Matrix33.translation_matrix(-translate) *
-                Matrix33.rotation_matrix(-angle) *
-                Matrix33.scale_matrix(inv_scale))
+        return Affine2.all_matrix(translate, scale, angle).inverse().to_matrix33()
 
     @staticmethod
     def lazy_inverse(matrix):
@@ -213,20 +227,7 @@ class Matrix33:
         :param matrix: A transform matrix.
         :return: Inverse matrix.
         """
-
-        scale_x = Vec2(matrix[0], matrix[1]).length
-        scale_y = Vec2(matrix[3], matrix[4]).length
-        if matrix[1] != 0:
-            rotation_angle = atan2(matrix[1], matrix[0])
-        else:
-            rotation_angle = 0
-
-        translation = Vec2(matrix[6], matrix[7])
-        scale = Vec2(1/scale_x, 1/scale_y)
-
-        return (Matrix33.translation_matrix(-translation) *
-                Matrix33.rotation_matrix(-rotation_angle) *
-                Matrix33.scale_matrix(scale))
+        return Affine2.from_matrix33(matrix).inverse().to_matrix33()
 
     @staticmethod
     def transpose_matrix(matrix):
@@ -267,12 +268,96 @@ class Matrix33:
         """
         Will always be a matrix.
         """
+        if isinstance(other, Matrix33Array):
+            return NotImplemented
+        elif isinstance(other, Affine2):
+            other = other.to_matrix33()
         return Matrix33([
          dot_3_3(self.row_1, other.column_1), dot_3_3(self.row_1, other.column_2), dot_3_3(self.row_1, other.column_3),
          dot_3_3(self.row_2, other.column_1), dot_3_3(self.row_2, other.column_2), dot_3_3(self.row_2, other.column_3),
          dot_3_3(self.row_3, other.column_1), dot_3_3(self.row_3, other.column_2), dot_3_3(self.row_3, other.column_3)])
 
 
+class Affine2:
+    """
+    A 2D affine transform. Every matrix in the project is a transform whose third column is (0, 0, 1), so only the
+    six meaningful values are stored:
+        a,  b,  0
+        c,  d,  0
+        tx, ty, 1
+    Composition and inversion skip the constant terms. For reading it behaves like a Matrix33, so indexing and values
+    use the full 3x3 layout.
+    """
+    __slots__ = ('a', 'b', 'c', 'd', 'tx', 'ty')
+
+    def __init__(self, a: float = 1, b: float = 0, c: float = 0, d: float = 1, tx: float = 0, ty: float = 0):
+        self.a, self.b, self.c, self.d, self.tx, self.ty = a, b, c, d, tx, ty
+
+    @staticmethod
+    def from_matrix33(matrix):
+        return Affine2(matrix[0], matrix[1], matrix[3], matrix[4], matrix[6], matrix[7])
+
+    @staticmethod
+    def from_values(values: List[float]):
+        return Affine2(values[0], values[1], values[3], values[4], values[6], values[7])
+
+    @staticmethod
+    def all_matrix(translate: Vec2 = Vec2(0), scale: Vec2 = Vec2(1), angle: float = 0):
+        rot_cos = cos(angle)
+        rot_sin = sin(angle)
+        return Affine2(rot_cos*scale.x, rot_sin*scale.x, -rot_sin*scale.y, rot_cos*scale.y, translate.x, translate.y)
+
+    @staticmethod
+    def rot_trans(angle: float, trans_x: float, trans_y: float):
+        rot_cos = cos(angle)
+        rot_sin = sin(angle)
+        return Affine2(rot_cos, rot_sin, -rot_sin, rot_cos, trans_x, trans_y)
+
+    def to_matrix33(self):
+        return Matrix33(self.values)
+
+    def inverse(self):
+        """
+        Exact closed form inverse of the 2x2 part, the translation is then carried through it.
+        """
+        inv_det = 1 / (self.a*self.d - self.b*self.c)
+        a, b = self.d*inv_det, -self.b*inv_det
+        c, d = -self.c*inv_det, self.a*inv_det
+        return Affine2(a, b, c, d, -(self.tx*a + self.ty*c), -(self.tx*b + self.ty*d))
+
+    def transform(self, point: Vec2):
+        x, y = point.x, point.y
+        if point.point:
+            return Vec2(x*self.a + y*self.c + self.tx, x*self.b + y*self.d + self.ty)
+        return Vec2(x*self.a + y*self.c, x*self.b + y*self.d)
+
+    def transform_xy(self, x: float, y: float):
+        return x*self.a + y*self.c + self.tx, x*self.b + y*self.d + self.ty
+
+    @property
+    def translation(self):
+        return Vec2(self.tx, self.ty)
+
+    @property
+    def values(self):
+        return [self.a, self.b, 0, self.c, self.d, 0, self.tx, self.ty, 1]
+
+    def __getitem__(self, item):
+        return self.values[item]
+
+    def __mul__(self, other):
+        """
+        An Affine2 with an Affine2, otherwise a Matrix33.
+        """
+        if isinstance(other, Affine2):
+            return Affine2(self.a*other.a + self.b*other.c, self.a*other.b + self.b*other.d,
+                           self.c*other.a + self.d*other.c, self.c*other.b + self.d*other.d,
+                           self.tx*other.a + self.ty*other.c + other.tx, self.tx*other.b + self.ty*other.d + other.ty)
+        elif isinstance(other, Matrix33Array):
+            return NotImplemented
+        return self.to_matrix33() * other
+
+
 class RotTrans:
 
     def __init__(self, angle, trans_x, trans_y):
@@ -281,3 +366,210 @@ class RotTrans:
 
     def to_matrix(self):
         return Matrix33.all_matrix(self.translation, Vec2(1), self.angle)
+
+    def to_affine(self):
+        return Affine2.rot_trans(self.angle, self.translation.x, self.translation.y)
+
+
+# -- ARRAY TYPES --
+# Batched counterparts of Vec2 and Matrix33 backed by numpy arrays. They follow the same row vector convention so a
+# stack of matrices composes with a single batched matmul. Leading dimensions are free, e.g., (joints, 3, 3) for one
+# skeleton or (characters, joints, 3, 3) for a crowd.
+
+
+class Vec2Array:
+
+    def __init__(self, values):
+        self.values: np.ndarray = np.asarray(values, dtype=float)
+
+    @staticmethod
+    def from_vecs(vectors: Iterable[Vec2]):
+        return Vec2Array([(vec.x, vec.y) for vec in vectors])
+
+    @staticmethod
+    def from_radial(thetas, lengths=1.0):
+        thetas = np.asarray(thetas, dtype=float)
+        return Vec2Array(np.stack((np.cos(thetas), np.sin(thetas)), axis=-1) * np.asarray(lengths)[..., None])
+
+    def to_vecs(self) -> List[Vec2]:
+        return [Vec2(x, y) for x, y in self.values.reshape(-1, 2).tolist()]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, item):
+        values = self.values[item]
+        if values.ndim == 1:
+            return Vec2(float(values[0]), float(values[1]))
+        return Vec2Array(values)
+
+    def __mul__(self, other):
+        if isinstance(other, (Matrix33, Affine2, Matrix33Array)):
+            return Matrix33Array.to_array(other).transform_points(self)
+        elif isinstance(other, Vec2Array):
+            return np.sum(self.values * other.values, axis=-1)
+        return Vec2Array(self.values * np.asarray(other)[..., None])
+
+    def __rmul__(self, other):
+        return self.__mul__(other)
+
+    def __truediv__(self, other):
+        return Vec2Array(self.values / np.asarray(other)[..., None])
+
+    def __add__(self, other):
+        if isinstance(other, Vec2Array):
+            return Vec2Array(self.values + other.values)
+        elif isinstance(other, Vec2):
+            return Vec2Array(self.values + (other.x, other.y))
+        return Vec2Array(self.values + other)
+
+    def __sub__(self, other):
+        if isinstance(other, Vec2Array):
+            return Vec2Array(self.values - other.values)
+        elif isinstance(other, Vec2):
+            return Vec2Array(self.values - (other.x, other.y))
+        return Vec2Array(self.values - other)
+
+    def __neg__(self):
+        return Vec2Array(-self.values)
+
+    @property
+    def x(self):
+        return self.values[..., 0]
+
+    @property
+    def y(self):
+        return self.values[..., 1]
+
+    @property
+    def theta(self):
+        # Matches Vec2, angles are kept in the range [0, 2pi)
+        return np.arctan2(self.values[..., 1], self.values[..., 0]) % (2*math.pi)
+
+    @property
+    def square_length(self):
+        return np.sum(self.values**2, axis=-1)
+
+    @property
+    def length(self):
+        return np.sqrt(self.square_length)
+
+
+class Matrix33Array:
+
+    def __init__(self, values):
+        values = np.asarray(values, dtype=float)
+        if values.shape[-2:] != (3, 3):
+            values = values.reshape(*values.shape[:-1], 3, 3)
+        self.values: np.ndarray = values
+
+    @staticmethod
+    def identity(*shape):
+        return Matrix33Array(np.broadcast_to(np.eye(3), (*shape, 3, 3)).copy())
+
+    @staticmethod
+    def from_matrices(matrices: Iterable[Matrix33]):
+        return Matrix33Array([matrix.values for matrix in matrices])
+
+    @staticmethod
+    def to_array(matrix):
+        if isinstance(matrix, Matrix33Array):
+            return matrix
+        return Matrix33Array(matrix.values)
+
+    @staticmethod
+    def from_affines(affines: Iterable[Affine2]):
+        return Matrix33Array([affine.values for affine in affines])
+
+    def to_matrices(self) -> List[Matrix33]:
+        return [Matrix33(values) for values in self.values.reshape(-1, 9).tolist()]
+
+    @staticmethod
+    def all_matrices(translations, scales=None, angles=0.0):
+        """
+        Batched Matrix33.all_matrix.
+        :param translations: (..., 2) translations or a Vec2Array.
+        :param scales: (..., 2) scales or a Vec2Array, None means no scaling.
+        :param angles: (...) angles in radians.
+        :return: a Matrix33Array with the broadcast shape of the inputs.
+        """
+        translations = translations.values if isinstance(translations, Vec2Array) else np.asarray(translations, float)
+        angles = np.asarray(angles, dtype=float)
+        return Matrix33Array.from_rot_trans(np.cos(angles), np.sin(angles),
+                                            translations[..., 0], translations[..., 1], scales)
+
+    @staticmethod
+    def from_rot_trans(rot_cos, rot_sin, trans_x, trans_y, scales=None):
+        """
+        Builds transform matrices straight from the cos and sin of each angle, which saves the trig when the unit
+        vectors are already known.
+        """
+        rot_cos, rot_sin, trans_x, trans_y = np.broadcast_arrays(rot_cos, rot_sin, trans_x, trans_y)
+        values = np.zeros((*rot_cos.shape, 3, 3))
+        if scales is None:
+            scale_x = scale_y = 1.0
+        else:
+            scales = scales.values if isinstance(scales, Vec2Array) else np.asarray(scales, float)
+            scale_x, scale_y = scales[..., 0], scales[..., 1]
+
+        values[..., 0, 0] = rot_cos * scale_x
+        values[..., 0, 1] = rot_sin * scale_x
+        values[..., 1, 0] = -rot_sin * scale_y
+        values[..., 1, 1] = rot_cos * scale_y
+        values[..., 2, 0] = trans_x
+        values[..., 2, 1] = trans_y
+        values[..., 2, 2] = 1
+        return Matrix33Array(values)
+
+    def lazy_inverse(self):
+        """
+        Batched inverse of transform matrices. Like Matrix33.lazy_inverse it assumes the third column is (0, 0, 1), but
+        uses the closed form of the 2x2 inverse so it is exact for any invertible transform.
+        :return: Inverse matrices.
+        """
+        values = self.values
+        a, b = values[..., 0, 0], values[..., 0, 1]
+        c, d = values[..., 1, 0], values[..., 1, 1]
+        tx, ty = values[..., 2, 0], values[..., 2, 1]
+        inv_det = 1 / (a*d - b*c)
+
+        inverse = np.zeros_like(values)
+        inverse[..., 0, 0] = d * inv_det
+        inverse[..., 0, 1] = -b * inv_det
+        inverse[..., 1, 0] = -c * inv_det
+        inverse[..., 1, 1] = a * inv_det
+        inverse[..., 2, 0] = -(tx * inverse[..., 0, 0] + ty * inverse[..., 1, 0])
+        inverse[..., 2, 1] = -(tx * inverse[..., 0, 1] + ty * inverse[..., 1, 1])
+        inverse[..., 2, 2] = 1
+        return Matrix33Array(inverse)
+
+    def transform_points(self, points, point=True):
+        """
+        Multiplies each row vector by its matching matrix, broadcasting over the leading dimensions.
+        :param points: (..., 2) points or a Vec2Array.
+        :param point: if False the translation is ignored, the same as Vec2.point.
+        :return: a Vec2Array.
+        """
+        points = points.values if isinstance(points, Vec2Array) else np.asarray(points, dtype=float)
+        result = np.einsum('...i,...ij->...j', points, self.values[..., :2, :2])
+        if point:
+            result += self.values[..., 2, :2]
+        return Vec2Array(result)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, item):
+        values = self.values[item]
+        if values.ndim == 2:
+            return Matrix33(values.ravel().tolist())
+        return Matrix33Array(values)
+
+    def __mul__(self, other):
+        """
+        Will always be a Matrix33Array.
+        """
+        return Matrix33Array(self.values @ Matrix33Array.to_array(other).values)
+
+    def __rmul__(self, other):
+        return Matrix33Array(Matrix33Array.to_array(other).values @ self.values)
@@ -0,0 +1,261 @@
+# Background asset loading. Parsing skeletons, clips, meshes, and sprite textures happens on a pool of worker threads,
+#   and only the work that must touch the GL context (building sprite lists, uploading mesh buffers) is left for the
+#   main thread. Every request returns a concurrent.futures.Future, which is always resolved on the main thread inside
+#   AssetLoader.update, so done callbacks are free to make renderers.
+#
+#   Requests are started highest priority first, and a queued request can be re-prioritised. Scenes can show progress
+#   and start animating the first characters while the rest of a crowd is still streaming in.
+
+from typing import List, Dict, Callable
+from concurrent.futures import Future
+from threading import Thread, Condition, Lock
+from queue import SimpleQueue, Empty
+from time import perf_counter
+import heapq
+import os
+
+import skeleton
+import animation
+import clip_file
+import model
+from memory import ASSETS, asset_key
+from profiling import span
+
+
+class LoadRequest:
+
+    def __init__(self, work: Callable, finalise: Callable, priority: float, label: str):
+        self.work: Callable = work  # runs on a worker thread
+        self.finalise: Callable = finalise  # runs on the main thread with the work's result
+        self.priority: float = priority
+        self.label: str = label
+        self.sequence: int = 0  # the heap entry that is current, older entries for the request are skipped
+        self.future: Future = Future()
+
+
+class AssetLoader:
+    """
+    A pool of worker threads fed from a priority queue. Call update once per frame on the main thread to finish
+    loaded requests and resolve their futures.
+    """
+
+    def __init__(self, workers=None):
+        self.queue: List = []  # heap of (-priority, sequence, request)
+        self.condition: Condition = Condition()
+        self.sequence: int = 0
+        self.is_running: bool = True
+
+        self.loaded: SimpleQueue = SimpleQueue()  # (request, result, error) waiting for the main thread
+        self.requests: Dict[Future, LoadRequest] = {}
+
+        self.submitted: int = 0
+        self.finished: int = 0
+        self.last_update_time: float = 0
+
+        self.threads: List[Thread] = [Thread(target=self.work, daemon=True, name=f"asset loader {index}")
+                                      for index in range(workers or min(4, os.cpu_count() or 1))]
+        for thread in self.threads:
+            thread.start()
+
+    # -- REQUESTS --
+
+    def submit(self, work: Callable, finalise: Callable = None, priority=0.0, label=''):
+        """
+        :param work: the thread safe part of the load, called with no arguments on a worker thread.
+        :param finalise: optional, called on the main thread with the work's result. Its return value is the result.
+        :param priority: higher priorities are started first.
+        :return: the request's future.
+        """
+        request = LoadRequest(work, finalise, priority, label)
+        with self.condition:
+            self.requests[request.future] = request
+            self.submitted += 1
+            self.push(request)
+        return request.future
+
+    def push(self, request: LoadRequest):
+        self.sequence += 1
+        request.sequence = self.sequence
+        heapq.heappush(self.queue, (-request.priority, self.sequence, request))
+        self.condition.notify()
+
+    def set_priority(self, future: Future, priority):
+        """
+        Changes the priority of a request that has not started yet.
+        """
+        with self.condition:
+            request = self.requests.get(future)
+            if request is not None and not future.running() and not future.done():
+                request.priority = priority
+                self.push(request)
+
+    def cancel(self, future: Future):
+        with self.condition:
+            if future in self.requests and future.cancel():
+                self.finish(future)
+                return True
+            return False
+
+    def finish(self, future: Future):
+        """
+        Counts a request as finished, cancelled or not. Call while holding the condition.
+        """
+        self.requests.pop(future, None)
+        self.finished += 1
+        if self.is_idle:
+            self.submitted = self.finished = 0
+
+    # -- PROGRESS --
+
+    @property
+    def pending(self):
+        return self.submitted - self.finished
+
+    @property
+    def progress(self):
+        """
+        The fraction of the requests submitted since the loader was last idle that are finished.
+        """
+        return self.finished / self.submitted if self.submitted else 1.0
+
+    @property
+    def is_idle(self):
+        return self.pending == 0
+
+    def pending_labels(self):
+        with self.condition:
+            return [request.label for request in self.requests.values()]
+
+    # -- THREADS --
+
+    def work(self):
+        while True:
+            with self.condition:
+                while self.is_running and not self.queue:
+                    self.condition.wait()
+                if not self.is_running:
+                    return
+                _, sequence, request = heapq.heappop(self.queue)
+                if sequence != request.sequence or not request.future.set_running_or_notify_cancel():
+                    continue  # re-prioritised or cancelled
+
+            try:
+                self.loaded.put((request, request.work(), None))
+            except Exception as error:
+                self.loaded.put((request, None, error))
+
+    @span('loading')
+    def update(self, budget_ms=None):
+        """
+        Finishes loaded requests on the main thread and resolves their futures, running their done callbacks.
+        :param budget_ms: optional time limit, anything left over is finished next update.
+        """
+        start = perf_counter()
+        while budget_ms is None or perf_counter() - start < budget_ms / 1000:
+            try:
+                request, result, error = self.loaded.get_nowait()
+            except Empty:
+                break
+
+            if error is None and request.finalise is not None:
+                try:
+                    result = request.finalise(result)
+                except Exception as finalise_error:
+                    error = finalise_error
+
+            with self.condition:
+                self.finish(request.future)
+
+            if error is None:
+                request.future.set_result(result)
+            else:
+                request.future.set_exception(error)
+
+        self.last_update_time = perf_counter() - start
+
+    def shutdown(self):
+        """
+        Cancels every request that has not started and waits for the running ones. Their results are still finished
+        by update.
+        """
+        with self.condition:
+            self.is_running = False
+            for _, _, request in self.queue:
+                # A re-prioritised request is in the queue more than once, it is only counted the first time.
+                if request.future in self.requests and request.future.cancel():
+                    self.finish(request.future)
+            self.queue.clear()
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    # -- ASSETS --
+
+    def create_skeleton(self, target, priority=0.0):
+        return self.submit(lambda: skeleton.create_skeleton(target), priority=priority, label=f"skeleton {target}")
+
+    def generate_clips(self, file, target, priority=0.0):
+        return self.submit(lambda: animation.generate_clips(file, target), priority=priority, label=f"clips {file}")
+
+    def load_clips(self, file, target, error_bound=None, priority=0.0):
+        return self.submit(lambda: clip_file.load_clips(file, target, error_bound), priority=priority,
+                           label=f"clips {file}")
+
+    def create_primitive_model(self, file, priority=0.0):
+        return self.submit(lambda: model.create_primitive_model(file), priority=priority, label=f"model {file}")
+
+    def create_sprite_model(self, file, cache_imperative=2, priority=0.0):
+        """
+        The json and textures are read on a worker, the sprites and their sprite list are made on the main thread.
+        """
+        key = asset_key('sprite_model', file)
+
+        def read():
+            return None if key in ASSETS else model.load_sprite_segments(file)
+
+        def build(segment_data):
+            # The shared model may have been evicted since read found it, then the segments are read here instead.
+            shared = ASSETS.get(key, lambda: model.SpriteModel(*(segment_data or model.load_sprite_segments(file))))
+            return shared.instance() if cache_imperative == 2 else shared
+
+        return self.submit(read, build, priority, f"sprite model {file}")
+
+    def load_mesh_model(self, model_name, context=None, priority=0.0):
+        """
+        The shared mesh is parsed on a worker. With a context its buffers are uploaded on the main thread.
+        """
+        def upload(mesh_model):
+            if context is not None:
+                mesh_model.calculate_buffers(context)
+            return mesh_model
+
+        return self.submit(lambda: model.create_mesh_model(model_name), upload, priority, f"mesh {model_name}")
+
+
+def gather(futures: List[Future]):
+    """
+    :return: a future of every future's result, in order. It fails as soon as any of them fails or is cancelled, with
+    that error, rather than waiting on the rest. Resolved by whichever thread resolves the deciding future.
+    """
+    gathered = Future()
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def on_done(future):
+        with lock:
+            remaining[0] -= 1
+            if gathered.done():
+                return
+            if future.cancelled():
+                gathered.set_exception(RuntimeError("a gathered load was cancelled"))
+            elif future.exception() is not None:
+                gathered.set_exception(future.exception())
+            elif not remaining[0]:
+                gathered.set_result([future.result() for future in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(on_done)
+    return gathered
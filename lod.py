@@ -0,0 +1,114 @@
+# Animation level of detail. Characters that are small on screen do not need the full cost of skeletal evaluation.
+#
+#   Update rate LOD: a renderer's animator is only evaluated every few frames (or at a fixed rate of GAME_CLOCK time).
+#   Each real evaluation is done one interval ahead, so the frames in between are a lerp from the last evaluated
+#   palette to the next one rather than an extrapolation, and the character never lags behind the clock.
+#
+#   Joint LOD: joints given a lod in the skeleton json (fingers, feet) are only sampled and composed when a renderer's
+#   joint_lod is at least theirs, otherwise they follow their parent. The palette keeps every joint, so the renderers'
+#   buffers never change size.
+
+from clock import GAME_CLOCK
+
+
+# Update rate tiers, the number of frames between real evaluations.
+FULL, HALF, QUARTER = 1, 2, 4
+
+# The on screen scale (pixels per model unit) a tier needs. Checked in order, the first that fits is used.
+TIER_THRESHOLDS = ((FULL, 96), (HALF, 48), (QUARTER, 0))
+
+# The on screen scale each joint lod needs, None being every joint.
+JOINT_LOD_THRESHOLDS = ((None, 64), (1, 32), (0, 0))
+
+
+def select_joint_lod(screen_scale):
+    return next(joint_lod for joint_lod, threshold in JOINT_LOD_THRESHOLDS if screen_scale >= threshold)
+
+
+def lerp_palettes(last_palette, next_palette, transition):
+    return last_palette + (next_palette - last_palette) * transition
+
+
+class UpdateLOD:
+    """
+    The update rate LOD of one renderer.
+    :param tier: FULL, HALF, or QUARTER. Ignored when a fixed rate is given.
+    :param hz: a fixed number of evaluations per second of GAME_CLOCK time.
+    :param auto: pick the tier from the on screen scale of the renderer's transform each frame.
+    :param hysteresis: how far past a threshold, as a fraction of it, the scale has to go before the tier changes.
+    :param auto_joints: also pick the renderer's joint lod from its on screen scale.
+    """
+
+    def __init__(self, tier=FULL, hz=None, auto=True, hysteresis=0.15, auto_joints=False):
+        self.tier: int = tier
+        self.hz: float = hz
+        self.auto: bool = auto and hz is None
+        self.hysteresis: float = hysteresis
+        self.auto_joints: bool = auto_joints
+
+        self.last_palette = None
+        self.next_palette = None
+        self.last_time: float = 0
+        self.next_time: float = 0
+        self.evaluation_count: int = 0
+
+    def interval(self):
+        if self.hz is not None:
+            return 1 / self.hz
+        return self.tier * GAME_CLOCK.time_step
+
+    def select_tier(self, screen_scale):
+        """
+        Steps through the tiers one at a time. The next finer tier is entered once the scale is hysteresis above its
+        threshold, and the current tier is left once the scale is hysteresis below its own, so a scale within
+        hysteresis of a threshold keeps whichever tier it already has.
+        """
+        tiers = [tier for tier, _ in TIER_THRESHOLDS]
+        thresholds = dict(TIER_THRESHOLDS)
+        if self.tier in thresholds:
+            index = tiers.index(self.tier)
+        else:
+            index = next(index for index, tier in enumerate(tiers) if screen_scale >= thresholds[tier])
+
+        while index > 0 and screen_scale >= thresholds[tiers[index - 1]] * (1 + self.hysteresis):
+            index -= 1
+        while index < len(tiers) - 1 and screen_scale < thresholds[tiers[index]] * (1 - self.hysteresis):
+            index += 1
+        self.tier = tiers[index]
+        return self.tier
+
+    def evaluate(self, renderer, run_time):
+        self.evaluation_count += 1
+        return renderer.animator.get_palette(run_time, renderer.joint_lod)
+
+    def get_palette(self, renderer):
+        if self.auto or self.auto_joints:
+            scale = renderer.transform.scale
+            screen_scale = max(abs(scale.x), abs(scale.y))
+            if self.auto:
+                self.select_tier(screen_scale)
+            if self.auto_joints:
+                renderer.joint_lod = select_joint_lod(screen_scale)
+
+        now = GAME_CLOCK.run_time
+        interval = self.interval()
+        if interval <= 0 or self.tier == FULL and self.hz is None:
+            self.next_palette = None
+            return self.evaluate(renderer, None)
+
+        if self.next_palette is None or not self.last_time <= now < self.next_time + interval:
+            # Nothing to lerp from yet, or the clock jumped. Start again from now.
+            self.last_time, self.last_palette = now, self.evaluate(renderer, None)
+            self.next_time = now + interval
+            self.next_palette = self.evaluate(renderer, self.next_time)
+        elif now >= self.next_time:
+            self.last_time, self.last_palette = self.next_time, self.next_palette
+            self.next_time += interval
+            self.next_palette = self.evaluate(renderer, self.next_time)
+
+        if self.last_palette is None or self.next_palette is None:
+            self.next_palette = None
+            return self.last_palette
+
+        transition = (now - self.last_time) / (self.next_time - self.last_time)
+        return lerp_palettes(self.last_palette, self.next_palette, transition)
@@ -1,10 +1,397 @@
-from copy import deepcopy
+# The asset registry. Skeletons, clips, and models are loaded once and shared, keyed by namespace and name so that two
+#   files can both have a clip called "run". Renderers hold AssetHandles on the assets they use, which keeps them
+#   loaded. Assets nobody holds stay cached too, until the registry is over its memory budget, when the least recently
+#   used of them are evicted.
+#
+#   The registry is locked, so assets can be loaded from loading.AssetLoader's worker threads.
+#
+#   Shared assets must be treated as immutable. Anything an instance changes (like sprite positions) lives on a per
+#   instance copy that still shares the immutable data, see model.SpriteModel.instance.
+#
+#   The accounting half of the module measures what things really hold. deep_size_of walks an object's references,
+#   AssetRegistry.report measures every registered asset and instance_report a renderer's own state without the shared
+#   assets. AllocationTracker uses tracemalloc to split allocations by module, and FrameAllocationCounter counts the
+#   memory blocks each frame leaves allocated so a steady state that keeps allocating shows up.
 
+from typing import List, Dict, Callable, Tuple
+from collections import OrderedDict, deque
+from threading import RLock
+from types import ModuleType, FunctionType, BuiltinFunctionType, MethodType
+import gc
+import os
+import sys
+import tracemalloc
 
-def cache(data, key, cache_dict, imperative):
-    if imperative == 1:
-        cache_dict[key] = data
-    elif imperative == 2:
-        cache_dict[key] = deepcopy(data)
-    elif imperative != 0:
-        print(f"unknown cache imperative the item {data} will not be cached")
+import numpy as np
+
+
+DEFAULT_BUDGET = 256 * 1024 * 1024  # bytes
+
+
+def asset_key(namespace, name):
+    return f"{namespace}:{name}"
+
+
+def size_of(asset):
+    """
+    The memory an asset holds onto. Assets with large buffers report them as nbytes.
+    """
+    nbytes = getattr(asset, 'nbytes', None)
+    return nbytes if nbytes is not None else sys.getsizeof(asset)
+
+
+class RegisteredAsset:
+
+    def __init__(self, key, asset, size):
+        self.key: str = key
+        self.asset = asset
+        self.size: int = size
+        self.references: int = 0
+
+
+class AssetHandle:
+    """
+    One holder's reference to a registered asset. Release it, or use it as a context manager, once done.
+    """
+    __slots__ = ('registry', 'key', 'asset', 'is_released')
+
+    def __init__(self, registry, key, asset):
+        self.registry: AssetRegistry = registry
+        self.key: str = key
+        self.asset = asset
+        self.is_released: bool = False
+
+    def release(self):
+        if not self.is_released:
+            self.is_released = True
+            self.registry.release(self.key)
+
+    def __enter__(self):
+        return self.asset
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class AssetRegistry:
+    """
+    Shared assets with reference counts. Once the unreferenced assets push the total past budget bytes the least
+    recently used are evicted. Referenced assets are never evicted, so the total can go over budget.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget: int = budget
+
+        self.entries: Dict[str, RegisteredAsset] = {}
+        self.unreferenced: Dict[str, RegisteredAsset] = OrderedDict()  # least recently used first
+        self.keys_by_id: Dict[int, str] = {}
+        self.nbytes: int = 0
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+        self.lock: RLock = RLock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def insert(self, key, asset):
+        """
+        Registers an asset, replacing any asset already under the key.
+        """
+        with self.lock:
+            self.add_entry(key, asset)
+            self.evict()
+        return asset
+
+    def add_entry(self, key, asset):
+        if key in self.entries:
+            self.remove(key)
+
+        entry = RegisteredAsset(key, asset, size_of(asset))
+        self.entries[key] = entry
+        self.unreferenced[key] = entry
+        self.keys_by_id[id(asset)] = key
+        self.nbytes += entry.size
+        return entry
+
+    def find_entry(self, key, loader: Callable = None):
+        """
+        The loader runs outside the lock so other threads can keep loading. If two threads load the same asset at
+        once the first to finish is registered and the other's copy is dropped.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                if key in self.unreferenced:
+                    self.unreferenced.move_to_end(key)
+                return entry
+
+        if loader is None:
+            raise KeyError(f"no asset is registered as {key}")
+        asset = loader()
+
+        with self.lock:
+            self.misses += 1
+            return self.entries.get(key) or self.add_entry(key, asset)
+
+    def get(self, key, loader: Callable = None):
+        """
+        :return: the asset under the key, loaded with loader() if it is not registered. Does not take a reference.
+        """
+        entry = self.find_entry(key, loader)
+        with self.lock:
+            self.evict()
+        return entry.asset
+
+    def acquire(self, key, loader: Callable = None):
+        """
+        The same as get, but takes a reference.
+        :return: an AssetHandle, the asset is handle.asset.
+        """
+        entry = self.find_entry(key, loader)
+        with self.lock:
+            if self.entries.get(key) is not entry:
+                entry = self.add_entry(key, entry.asset)  # evicted by another thread in between
+            entry.references += 1
+            self.unreferenced.pop(key, None)
+            self.evict()
+        return AssetHandle(self, key, entry.asset)
+
+    def acquire_asset(self, asset):
+        """
+        Takes a reference on an already registered asset object.
+        :return: an AssetHandle, or None if the asset is not registered.
+        """
+        with self.lock:
+            key = self.keys_by_id.get(id(asset))
+            if key is None or self.entries[key].asset is not asset:
+                return None
+            return self.acquire(key)
+
+    def release(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.references == 0:
+                return
+
+            entry.references -= 1
+            if entry.references == 0:
+                self.unreferenced[key] = entry
+                self.evict()
+
+    def references(self, key):
+        entry = self.entries.get(key)
+        return 0 if entry is None else entry.references
+
+    def evict(self):
+        with self.lock:
+            while self.nbytes > self.budget and self.unreferenced:
+                key = next(iter(self.unreferenced))
+                self.remove(key)
+                self.evictions += 1
+
+    def remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key)
+            self.unreferenced.pop(key, None)
+            self.keys_by_id.pop(id(entry.asset), None)
+            self.nbytes -= entry.size
+
+    def namespace(self, namespace):
+        """
+        :return: every registered asset in a namespace, by name.
+        """
+        prefix = asset_key(namespace, '')
+        with self.lock:
+            return {key[len(prefix):]: entry.asset for key, entry in self.entries.items() if key.startswith(prefix)}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.unreferenced.clear()
+            self.keys_by_id.clear()
+            self.nbytes = 0
+
+    def report(self):
+        """
+        :return: per entry key, references, budgeted size, and the deep bytes and object count of the asset. Other
+        registered assets an asset refers to (like a clip's skeleton) are left to their own entries. Largest first.
+        """
+        with self.lock:
+            entries = list(self.entries.values())
+            registered = {id(entry.asset) for entry in entries} | {id(self)}
+
+        report = []
+        for entry in entries:
+            deep_bytes, objects = deep_size_of(entry.asset, registered - {id(entry.asset)})
+            report.append({'key': entry.key, 'references': entry.references, 'size': entry.size,
+                           'deep_bytes': deep_bytes, 'objects': objects})
+        return sorted(report, key=lambda row: row['deep_bytes'], reverse=True)
+
+    def instance_report(self, instance, shared=()):
+        """
+        The memory an instance (like a renderer) holds on its own, without any registered assets it shares.
+        :param shared: other objects the instance shares and should not be counted, like a crowd or a palette cache.
+        :return: the deep bytes and object count of each attribute, and their total as 'total'. An object two
+        attributes share is counted under the first.
+        """
+        with self.lock:
+            seen = {id(entry.asset) for entry in self.entries.values()}
+        seen.update((id(self), id(instance)))
+        seen.update(id(shared_object) for shared_object in shared)
+
+        report = {}
+        for attribute, value in vars(instance).items():
+            report[attribute] = deep_size_of(value, seen)
+        report['total'] = (sys.getsizeof(instance) + sum(size for size, _ in report.values()),
+                           1 + sum(objects for _, objects in report.values()))
+        return report
+
+
+ASSETS = AssetRegistry()
+
+
+# -- ACCOUNTING --
+
+NOT_DATA = (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType)
+
+
+def deep_size_of(target, seen=None) -> Tuple[int, int]:
+    """
+    Walks everything reachable from target through containers, attributes, and slots, counting each object once.
+    Classes, modules, and functions are not counted. A numpy view counts its base array once, which holds the data,
+    and a view of any other buffer counts the bytes it views.
+    Memory held outside python (GL buffers, textures on the GPU) is not seen.
+    :param seen: ids of objects not to count, which is updated with every object counted.
+    :return: the bytes and the number of objects.
+    """
+    seen = set() if seen is None else seen
+    size, objects = 0, 0
+    stack = [target]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, NOT_DATA):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        objects += 1
+
+        if isinstance(current, np.ndarray):
+            if isinstance(current.base, np.ndarray):
+                stack.append(current.base)
+            elif current.base is not None:
+                size += current.nbytes  # a view of a foreign buffer, like a memory mapped clip file
+                stack.append(current.base)
+        elif isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset, deque)):
+            stack.extend(current)
+        elif not isinstance(current, (str, bytes, int, float, complex, bool)):
+            instance_dict = getattr(current, '__dict__', None)
+            if instance_dict is not None:
+                stack.append(instance_dict)
+            for cls in type(current).__mro__:
+                for slot in cls.__dict__.get('__slots__', ()):
+                    if hasattr(current, slot):
+                        stack.append(getattr(current, slot))
+    return size, objects
+
+
+class AllocationTracker:
+    """
+    Live allocations per module with tracemalloc, relative to when the tracker started. Each of the project's modules
+    is a subsystem of its own, anything allocated outside them is grouped as '<other>'. tracemalloc slows every
+    allocation down, so only run it while investigating.
+    """
+
+    def __init__(self, frames=1):
+        self.frames: int = frames
+        self.root: str = os.path.dirname(os.path.abspath(__file__))
+        self.baseline: tracemalloc.Snapshot = None
+        self.started_tracing: bool = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_tracing = True
+        self.baseline = tracemalloc.take_snapshot()
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def find_module(self, filename):
+        if not filename.startswith(self.root):
+            return '<other>'
+        return os.path.splitext(os.path.relpath(filename, self.root))[0].replace(os.sep, '.')
+
+    def by_module(self):
+        """
+        :return: the bytes and blocks each module has allocated since start and not freed, largest first.
+        """
+        modules: Dict[str, List[int]] = {}
+        for stat in tracemalloc.take_snapshot().compare_to(self.baseline, 'filename'):
+            totals = modules.setdefault(self.find_module(stat.traceback[0].filename), [0, 0])
+            totals[0] += stat.size_diff
+            totals[1] += stat.count_diff
+        return dict(sorted(((module, tuple(totals)) for module, totals in modules.items()),
+                           key=lambda item: item[1][0], reverse=True))
+
+
+class FrameAllocationCounter:
+    """
+    Counts the memory blocks python has allocated across each frame. Once the scene is warmed up a frame should leave
+    nothing behind, so a steady positive count is a leak or a cache that never stops growing. While tracemalloc is
+    tracing the traced bytes left behind are counted too.
+
+    Garbage in reference cycles stays allocated until the cyclic collector next runs, which looks like a small leak.
+    With collect the collector runs before and after every frame, which is slow but only counts what is really kept.
+    """
+
+    def __init__(self, window=120, collect=False):
+        self.collect: bool = collect
+        self.net_blocks: deque = deque(maxlen=window)
+        self.net_bytes: deque = deque(maxlen=window)
+        self.start_blocks: int = 0
+        self.start_bytes: int = 0
+
+    def begin_frame(self):
+        if self.collect:
+            gc.collect()
+        self.start_blocks = sys.getallocatedblocks()
+        if tracemalloc.is_tracing():
+            self.start_bytes = tracemalloc.get_traced_memory()[0]
+
+    def end_frame(self):
+        """
+        :return: the blocks left allocated by the frame.
+        """
+        if self.collect:
+            gc.collect()
+        net_blocks = sys.getallocatedblocks() - self.start_blocks
+        self.net_blocks.append(net_blocks)
+        if tracemalloc.is_tracing():
+            self.net_bytes.append(tracemalloc.get_traced_memory()[0] - self.start_bytes)
+        return net_blocks
+
+    @property
+    def blocks_per_frame(self):
+        return sum(self.net_blocks) / len(self.net_blocks) if self.net_blocks else 0.0
+
+    @property
+    def bytes_per_frame(self):
+        return sum(self.net_bytes) / len(self.net_bytes) if self.net_bytes else 0.0
+
+    def is_growing(self, threshold=1.0):
+        """
+        :return: if the frames in the window left more than threshold blocks behind on average.
+        """
+        return self.blocks_per_frame > threshold
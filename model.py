@@ -1,12 +1,16 @@
 import json
-from typing import List, Dict, Tuple
-from array import array
+import os
+import re
+import uuid
+from typing import List
 
+import numpy as np
 import arcade
 import arcade.gl as gl
 
 import lin_al as la
-from memory import cache
+from memory import ASSETS, asset_key
+from profiling import span
 
 
 # -- PRIMITIVE MODELS --
@@ -39,9 +43,6 @@ class PrimitiveModel:
         self.master_joint: SegmentPrimitive = segments[0]
 
 
-prim_cache: Dict[str, PrimitiveModel] = {}
-
-
 def make_prim_segment(joint_list: List[SegmentPrimitive], parent_index: int, joint_data: dict):
     """
     Recursive generation of Joint Primitive.
@@ -57,15 +58,7 @@ def make_prim_segment(joint_list: List[SegmentPrimitive], parent_index: int, joi
         make_prim_segment(joint_list, new_joint.segment_index, child_data)
 
 
-def create_primitive_model(file, cache_imperative=1):
-    """
-    Generates a positioned 2D Primitive Model from a json file.
-
-    :param file: a json file in a parent->child joint tree.
-    :param cache_imperative: the cache imperative. This decides whether the model should be cached.
-     0 = don't cache, 1 = cache and return, 2 = cache copy and return.
-    :return: a 2D primitive Model
-    """
+def load_primitive_model(file):
     json_data = json.load(open(file))
     master_segment = SegmentPrimitive(json_data["id"], json_data["colour"], json_data["thickness"],
                                       la.Vec2(*json_data["pos"]), 0, -1)
@@ -73,9 +66,23 @@ def create_primitive_model(file, cache_imperative=1):
     for child_data in json_data["children"]:
         make_prim_segment(joint_list, master_segment.segment_index, child_data)
 
-    model = PrimitiveModel(joint_list, json_data['name'])
-    cache(model, json_data['name'], prim_cache, cache_imperative)
-    return model
+    return PrimitiveModel(joint_list, json_data['name'])
+
+
+@span('loading')
+def create_primitive_model(file, cache_imperative=1):
+    """
+    Generates a positioned 2D Primitive Model from a json file, or gets the shared one from the asset registry.
+    Primitive models are never changed by their renderers, so 1 and 2 both share one model.
+
+    :param file: a json file in a parent->child joint tree.
+    :param cache_imperative: the cache imperative. This decides whether the model should be shared.
+     0 = load a new unregistered model, 1 or 2 = the shared model.
+    :return: a 2D primitive Model
+    """
+    if cache_imperative == 0:
+        return load_primitive_model(file)
+    return ASSETS.get(asset_key('primitive_model', file), lambda: load_primitive_model(file))
 
 # -- SPRITE MODEL --
 # This implementation uses multiple separate sprites to draw the model.
@@ -95,11 +102,16 @@ class SpriteSegment:
 
 
 class SpriteModel:
+    """
+    The sprites of a sprite model are moved by its renderer, so every renderer needs its own. Instances made with
+    instance() get new sprites, but share the textures and segment data of the model they were made from, its template.
+    """
 
-    def __init__(self, model_name, pixel_scale, segments, sprites=None):
+    def __init__(self, model_name, pixel_scale, segments, sprites=None, template=None):
         self.model_name: str = model_name
         self.model_pixel_scale: la.Vec2 = pixel_scale
         # the model pixel scale is the scaling required to map model space to pixel space
+        self.template: SpriteModel = template
 
         self._sprite_list: arcade.SpriteList = sprites  # a sprite list which is not ordered correctly
         self.segment_list: List[SpriteSegment] = segments  # a list of segments ordered correctly.
@@ -113,8 +125,19 @@ class SpriteModel:
     def draw(self):
         self._sprite_list.draw(pixelated=True)
 
+    @property
+    def nbytes(self):
+        textures = {id(segment.sprite.texture): segment.sprite.texture for segment in self.segment_list}
+        return sum(texture.width * texture.height * 4 for texture in textures.values())
 
-sprite_cache: Dict[str, SpriteModel] = {}
+    def instance(self):
+        segments = []
+        for segment in self.segment_list:
+            sprite = arcade.Sprite()
+            sprite.texture = segment.sprite.texture
+            sprite.scale = segment.sprite.scale
+            segments.append(SpriteSegment(segment.id, sprite, segment.target_joint, segment.model_pos, segment.depth))
+        return SpriteModel(self.model_name, self.model_pixel_scale, segments, template=self.template or self)
 
 
 def make_sprite_segment(sprite_data, sprite_scale, texture_location, seg_list):
@@ -141,13 +164,10 @@ def make_sprite_segment(sprite_data, sprite_scale, texture_location, seg_list):
         make_sprite_segment(child, sprite_scale, texture_location, seg_list)
 
 
-def create_sprite_model(file, cache_imperative=2):
+def load_sprite_segments(file):
     """
-    Generates a model made of a list of sprites derived from a json file.
-    :param file: a json file detailing the model.
-    :param cache_imperative: the cache imperative. This decides whether the model should be cached.
-     0 = don't cache, 1 = cache and return, 2 = cache copy and return.
-    :return: a generated model.
+    Reads a sprite model's json and textures. Nothing here touches the GL context, so it can run on any thread.
+    :return: the model name, its pixel scale, and its segments.
     """
     json_data = json.load(open(file))
     segments = []
@@ -157,10 +177,30 @@ def create_sprite_model(file, cache_imperative=2):
     for child in json_data['children']:
         make_sprite_segment(child, sprite_scale, text_location, segments)
 
-    model = SpriteModel(json_data['name'], la.Vec2(*json_data['model_pixel_scale']), segments)
-    cache(model, json_data['name'], sprite_cache, cache_imperative)
+    return json_data['name'], la.Vec2(*json_data['model_pixel_scale']), segments
+
+
+def load_sprite_model(file):
+    return SpriteModel(*load_sprite_segments(file))
+
+
+@span('loading')
+def create_sprite_model(file, cache_imperative=2):
+    """
+    Generates a model made of a list of sprites derived from a json file, or gets the shared one from the asset
+    registry.
+    :param file: a json file detailing the model.
+    :param cache_imperative: the cache imperative. This decides whether the model should be shared.
+     0 = load a new unregistered model, 1 = the shared model, 2 = an instance of the shared model with its own sprites.
+    :return: a generated model.
+    """
+    if cache_imperative == 0:
+        return load_sprite_model(file)
 
-    return model
+    shared = ASSETS.get(asset_key('sprite_model', file), lambda: load_sprite_model(file))
+    if cache_imperative == 2:
+        return shared.instance()
+    return shared
 
 
 # -- VERTEX MODEL --
@@ -168,102 +208,133 @@ def create_sprite_model(file, cache_imperative=2):
 # By doing it this way the 2D characters will not suffer from any splitting when being animated like there is for the
 # other two implementations.
 
-class Vertex:
-
-    def __init__(self, pos: la.Vec2, depth: float, uv: la.Vec2,
-                 indices: Tuple[int, int, int, int], weights: Tuple[float, float, float]):
-        self.pos: la.Vec2 = pos
-        self.depth: float = depth
-        self.uv: la.Vec2 = uv
-        self.joint_indices: Tuple[int, int, int, int] = indices
-        self.joint_weights: Tuple[float, float, float] = weights
-
-    def get_data(self):
-        # Return indices as vec4
-        for index in self.joint_indices:
-            yield index
-        # yield weights as vec3
-        for weight in self.joint_weights:
-            yield weight
-        # yield pos and depth as vec3
-        yield self.pos.x
-        yield self.pos.y
-        yield self.depth
-        # yield uv values as vec2
-        yield self.uv.x
-        yield self.uv.y
-
-
 class MeshModel:
+    """
+    A mesh as interleaved float32 vertex data, 12 floats per vertex: joint indices (4), joint weights (3), position
+    and depth (3), and uv (2). The indices are uint16, or uint32 once a mesh has too many vertices for them.
+    """
 
-    def __init__(self, model_name, vertices, indices):
+    def __init__(self, model_name, vertices: np.ndarray, indices: np.ndarray):
         self.model_name: str = model_name
 
-        self.vertices: Tuple[Vertex, ...] = vertices
-        self.indices: Tuple[int, ...] = indices
+        self.vertices: np.ndarray = vertices
+        self.indices: np.ndarray = indices
         self.vertex_buffer: gl.Buffer = None
         self.index_buffer: gl.Buffer = None
 
+    @property
+    def index_element_size(self):
+        return self.indices.itemsize
+
+    @property
+    def nbytes(self):
+        return self.vertices.nbytes + self.indices.nbytes
+
     def calculate_buffers(self, context: arcade.context.Context):
-        self.vertex_buffer = context.buffer(data=array('f', self.get_vertices_data()))
-        self.index_buffer = context.buffer(data=array('H', self.get_indices()))
-
-    def get_vertices_data(self):
-        for vertex in self.vertices:
-            yield from vertex.get_data()
-
-    def get_indices(self):
-        for index in self.indices:
-            yield index
-
-
-def load_mesh_model(model_name):
-    vertex_positions = []
-    vertex_uvs = []
-    vertex_weights = []
-    vertices_data: List[Tuple[int, int]] = []
-    triangles = []
-
-    def get_position(data: List[str]):
-        position = la.Vec2(float(data[0]), -float(data[2]))
-        depth = float(data[1])
-        vertex_positions.append((position, depth))
-
-    def get_uvs(data: List[str]):
-        uv = la.Vec2(float(data[0]), float(data[1]))
-        vertex_uvs.append(uv)
-
-    def make_triangle(data: List[str]):
-        for index in data:
-            index = index.split('/')
-            vert = (int(index[0])-1, int(index[1])-1)
-            if vert not in vertices_data:
-                vertices_data.append(vert)
-            triangles.append(vertices_data.index(vert))
-
-    obj_line_starters = {'v': get_position, 'vt': get_uvs, 'f': make_triangle}
-
-    with open(f"resources/blends/{model_name}.obj", 'rt') as model_obj:
-        for line in model_obj.readlines():
-            line = line.rstrip('\n')
-            line_data = line.split(' ')
-            if line_data[0] in obj_line_starters:
-                obj_line_starters[line_data[0]](line_data[1:])
-
-    with open(f"resources/blends/{model_name}.wt", 'rt') as model_weights:
-        for line in model_weights.readlines():
-            line = line.rstrip("\n").split("|")
-            joint_indices = tuple(map(int, line[0].split()))
-            joint_weights = tuple(map(float, line[1].split()))
-            vertex_weights.append((joint_indices, joint_weights))
-
-    vertices = []
-    for vertex, uv in vertices_data:
-        pos = vertex_positions[vertex][0]
-        depth = vertex_positions[vertex][1]
-        uv = vertex_uvs[uv]
-        indices = vertex_weights[vertex][0]
-        weights = vertex_weights[vertex][1]
-        vertices.append(Vertex(pos, depth, uv, indices, weights))
-
-    return MeshModel(model_name, vertices, triangles)
+        # Every renderer of a shared mesh draws from the same buffers, so they are only made once.
+        if self.vertex_buffer is not None:
+            return
+        self.vertex_buffer = context.buffer(data=self.vertices)
+        self.index_buffer = context.buffer(data=self.indices)
+
+
+MESH_CACHE_VERSION = 1
+
+OBJ_POSITION = re.compile(r'^v (.*)$', re.MULTILINE)
+OBJ_UV = re.compile(r'^vt (.*)$', re.MULTILINE)
+OBJ_FACE = re.compile(r'^f (.*)$', re.MULTILINE)
+
+
+def parse_obj(text: str):
+    """
+    Reads the positions, uvs, and triangles of an obj file. Only v, vt, and f lines are used, every face must be a
+    triangle with a uv per corner.
+    :return: (positions (n, 3), uvs (n, 2), corners (triangles * 3, 2) of position and uv index)
+    """
+    positions = np.fromstring(' '.join(OBJ_POSITION.findall(text)), sep=' ').reshape(-1, 3)
+    uvs = np.fromstring(' '.join(OBJ_UV.findall(text)), sep=' ').reshape(-1, 2)
+
+    faces = OBJ_FACE.findall(text)
+    fields = faces[0].split()[0].count('/') + 1 if faces else 2
+    corners = np.fromstring(' '.join(faces).replace('/', ' '), dtype=np.int64, sep=' ').reshape(-1, fields)
+    return positions, uvs, corners[:, :2] - 1
+
+
+def parse_weights(text: str):
+    """
+    Reads a wt file, one line per obj position of 4 joint indices | 3 joint weights.
+    :return: (positions, 7) float32 array.
+    """
+    return np.fromstring(text.replace('|', ' '), dtype=np.float32, sep=' ').reshape(-1, 7)
+
+
+def build_mesh(positions, uvs, corners, weights):
+    """
+    Merges the corners that share a position and uv into one vertex, in the order they are first used.
+    :return: the interleaved vertex data and the indices.
+    """
+    keys = corners[:, 0] * max(len(uvs), 1) + corners[:, 1]
+    unique_keys, first_use, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first_use)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+
+    vertex_corners = corners[first_use[order]]
+    position_indices, uv_indices = vertex_corners[:, 0], vertex_corners[:, 1]
+
+    vertices = np.empty((len(vertex_corners), 12), dtype=np.float32)
+    vertices[:, 0:7] = weights[position_indices]
+    vertices[:, 7] = positions[position_indices, 0]
+    vertices[:, 8] = -positions[position_indices, 2]
+    vertices[:, 9] = positions[position_indices, 1]
+    vertices[:, 10:12] = uvs[uv_indices]
+
+    index_type = np.uint16 if len(vertices) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    return vertices, ranks[inverse].astype(index_type)
+
+
+def source_signature(*files):
+    stats = [os.stat(file) for file in files]
+    return np.array([MESH_CACHE_VERSION] + [value for stat in stats for value in (stat.st_mtime_ns, stat.st_size)],
+                    dtype=np.int64)
+
+
+@span('loading')
+def load_mesh_model(model_name, use_cache=True):
+    """
+    Loads resources/blends/{model_name}.obj and its .wt weights. The built arrays are cached in a .npz beside them,
+    which is used instead as long as neither source has changed.
+    """
+    obj_file = f"resources/blends/{model_name}.obj"
+    weight_file = f"resources/blends/{model_name}.wt"
+    cache_file = f"resources/blends/{model_name}.mesh.npz"
+    signature = source_signature(obj_file, weight_file)
+
+    if use_cache and os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            if np.array_equal(cached['signature'], signature):
+                return MeshModel(model_name, cached['vertices'], cached['indices'])
+
+    with open(obj_file, 'rt') as model_obj:
+        positions, uvs, corners = parse_obj(model_obj.read())
+    with open(weight_file, 'rt') as model_weights:
+        weights = parse_weights(model_weights.read())
+    vertices, indices = build_mesh(positions, uvs, corners, weights)
+
+    if use_cache:
+        # Written beside the cache then swapped in, so a half written cache is never read. The temp file is unique to
+        #   the call, as loader threads can build the same model at once.
+        temp_name = f"{cache_file}.{uuid.uuid4().hex}.tmp"
+        with open(temp_name, 'wb') as temp_file:
+            np.savez(temp_file, signature=signature, vertices=vertices, indices=indices)
+        os.replace(temp_name, cache_file)
+
+    return MeshModel(model_name, vertices, indices)
+
+
+@span('loading')
+def create_mesh_model(model_name):
+    """
+    The shared mesh model, loaded with load_mesh_model and registered with the asset registry.
+    """
+    return ASSETS.get(asset_key('mesh', model_name), lambda: load_mesh_model(model_name))
@@ -0,0 +1,288 @@
+# An opt-in cache of baked skinning palettes. A clip's palette only depends on how far through the clip it is, so
+#   the first time a clip is needed its palettes (inverse bind pose * model matrices) are baked at a fixed sample rate.
+#   From then on evaluating the clip is a lookup and a lerp between the two baked samples either side of frame_t.
+#
+#   Baked clips are kept least recently used first under a byte budget. A clip that is edited must be invalidated.
+#
+#   Clips can also be baked offline with bake.py into a palette file:
+#       - header: magic, version, clip count, joint count, skeleton id.
+#       - table: one entry per clip of clip id, source hash, byte offset, sample count, duration, and looping.
+#       - palette blocks: each clip's float32 (samples, joints, 3, 2) palettes, 16 byte aligned. The last column of
+#         every matrix is always (0, 0, 1) so it is not stored.
+#   A BakedClip loaded from one plays through any PaletteCache without its source clip or any hierarchy evaluation.
+
+from typing import Dict, Tuple
+from collections import OrderedDict
+from math import ceil, floor
+import mmap
+import os
+import struct
+import uuid
+
+import numpy as np
+
+import skeleton
+import animation
+from profiling import span
+
+
+# Baked samples per second of clip time. Lerped palettes are not rigid, so the error halves with each doubling. At 480
+#   the sample run stays within 0.004 model space units of a full evaluation.
+DEFAULT_SAMPLE_RATE = 480
+DEFAULT_BUDGET = 16 * 1024 * 1024  # bytes
+
+MAGIC = b'BPAL'
+VERSION = 1
+EXTENSION = '.bpal'
+
+ID_SIZE = 32
+HASH_SIZE = 16
+HEADER = struct.Struct(f'<4sHII{ID_SIZE}s')
+TABLE_ENTRY = struct.Struct(f'<{ID_SIZE}s{HASH_SIZE}sQId?7x')
+ALIGNMENT = 16
+
+PALETTE_DTYPE = np.dtype('<f4')
+
+
+def bake_palettes(clip, sample_count):
+    """
+    :return: (sample_count, joints, 3, 3) float32 palettes of a clip at evenly spaced frame_ts.
+    """
+    target_skeleton = clip.skeleton
+    pose_data = clip.sample_many(np.arange(sample_count) / sample_count)
+    model_poses = target_skeleton.compose(animation.local_matrices(pose_data))
+    return (target_skeleton.inv_bind_poses.values @ model_poses).astype(np.float32)
+
+
+class BakedClip:
+    """
+    A clip's skinning palettes at evenly spaced frame_ts. Sample i is at frame_t i / sample_count, and the last sample
+    lerps back to the first, the same as the clip's last frame does.
+
+    A BakedClip can be played by an Animation in place of its clip, as long as its AnimationSet or crowd has a
+    PaletteCache. It has no local poses to blend, layer, or offset, so AnimationSet only plays it on its own: adding
+    any other animation alongside it, or transitioning to or from it, raises a ValueError.
+    """
+
+    def __init__(self, target_skeleton, palettes, duration, is_looping):
+        self.skeleton: skeleton.Skeleton = target_skeleton
+        self.palettes: np.ndarray = palettes
+        self.duration: float = duration
+        self.is_looping: bool = is_looping
+        self.is_additive: bool = False  # palettes are model space, a baked clip is never an additive layer
+        self.is_baked: bool = True
+
+    @staticmethod
+    def bake(clip, sample_count):
+        return BakedClip(clip.skeleton, bake_palettes(clip, sample_count), clip.duration, clip.is_looping)
+
+    @property
+    def sample_count(self):
+        return len(self.palettes)
+
+    @property
+    def nbytes(self):
+        return self.palettes.nbytes
+
+    def lookup(self, frame_t):
+        sample = frame_t * self.sample_count
+        last_sample = floor(sample) % self.sample_count
+        next_weight = sample % 1
+        return (self.palettes[last_sample] * (1 - next_weight) +
+                self.palettes[(last_sample + 1) % self.sample_count] * next_weight)
+
+    def lookup_many(self, frame_ts):
+        """
+        :return: (len(frame_ts), joints, 3, 3) palettes.
+        """
+        sample = np.asarray(frame_ts) * self.sample_count
+        last_sample = np.floor(sample).astype(int) % self.sample_count
+        next_weight = (sample % 1).astype(np.float32)[:, None, None, None]
+        return (self.palettes[last_sample] * (1 - next_weight) +
+                self.palettes[(last_sample + 1) % self.sample_count] * next_weight)
+
+
+class PaletteCache:
+    """
+    Bakes clips on first use and evicts the least recently used once the baked palettes pass budget bytes. A clip
+    larger than the whole budget is baked for the one lookup and never kept.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, sample_rate=DEFAULT_SAMPLE_RATE):
+        self.budget: int = budget
+        self.sample_rate: float = sample_rate
+
+        self.baked: Dict[object, BakedClip] = OrderedDict()
+        self.nbytes: int = 0
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def find_sample_count(self, clip):
+        # Never fewer samples than the clip has frames, so no key frame is skipped over.
+        return max(clip.frame_count, ceil(clip.duration * self.sample_rate), 1)
+
+    @span('palette cache')
+    def get(self, clip):
+        """
+        :return: the BakedClip of a clip, baking it if it is not cached. A BakedClip is its own bake.
+        """
+        if isinstance(clip, BakedClip):
+            self.hits += 1
+            return clip
+
+        baked = self.baked.get(clip)
+        if baked is not None:
+            self.hits += 1
+            self.baked.move_to_end(clip)
+            return baked
+
+        self.misses += 1
+        baked = BakedClip.bake(clip, self.find_sample_count(clip))
+        if baked.nbytes > self.budget:
+            return baked
+
+        while self.nbytes + baked.nbytes > self.budget:
+            _, evicted = self.baked.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+        self.baked[clip] = baked
+        self.nbytes += baked.nbytes
+        return baked
+
+    def invalidate(self, clip):
+        baked = self.baked.pop(clip, None)
+        if baked is not None:
+            self.nbytes -= baked.nbytes
+
+    def clear(self):
+        self.baked.clear()
+        self.nbytes = 0
+
+    def reset_counters(self):
+        self.hits = self.misses = self.evictions = 0
+
+    @span('palette cache')
+    def fill(self, clips, frame_ts, characters, palettes):
+        """
+        Looks up the palettes of characters that each play a single animation. Baked palettes are in model space, so
+        they cannot be blended the way animation.blend_poses blends local poses, and characters playing more than one
+        animation are sampled instead.
+        :param clips: the rows of each clip, as returned by crowd.SkeletonBatch.gather.
+        :param frame_ts: the frame_t of each row.
+        :param characters: the palette each row is written to.
+        """
+        for clip, rows in clips.items():
+            palettes[characters[rows]] = self.get(clip).lookup_many(frame_ts[rows])
+
+
+def pack_id(text: str):
+    encoded = text.encode('utf-8')
+    if len(encoded) > ID_SIZE:
+        raise ValueError(f"'{text}' is longer than the {ID_SIZE} bytes a palette file allows for an id")
+    return encoded
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_palette_file(file, skeleton_id, joint_count, clips: Dict[str, Tuple[bytes, np.ndarray, float, bool]]):
+    """
+    Writes a palette file.
+    :param clips: clip id to (source hash, (samples, joints, 3, 3) or (samples, joints, 3, 2) palettes, duration,
+    is_looping).
+    """
+    offset = align(HEADER.size + TABLE_ENTRY.size * len(clips))
+    table, blocks = [], []
+    for clip_id, (source_hash, palettes, duration, is_looping) in clips.items():
+        block = np.ascontiguousarray(palettes[..., :2], dtype=PALETTE_DTYPE)
+        table.append(TABLE_ENTRY.pack(pack_id(clip_id), source_hash, offset, len(block), duration, is_looping))
+        blocks.append((offset, block))
+        offset = align(offset + block.nbytes)
+
+    temp_file = f"{file}.{uuid.uuid4().hex}.tmp"  # unique, so two bakes of one file never share a temp file
+    with open(temp_file, 'wb') as palette_file:
+        palette_file.write(HEADER.pack(MAGIC, VERSION, len(clips), joint_count, pack_id(skeleton_id)))
+        palette_file.write(b''.join(table))
+        for block_offset, block in blocks:
+            palette_file.write(b'\0' * (block_offset - palette_file.tell()))
+            palette_file.write(block.tobytes())
+    os.replace(temp_file, file)
+
+
+class PaletteFile:
+    """
+    An open, memory mapped palette file.
+    """
+
+    def __init__(self, file):
+        self.file: str = file
+        with open(file, 'rb') as palette_file:
+            self.mapping: mmap.mmap = mmap.mmap(palette_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.mapping) < HEADER.size:
+            raise ValueError(f"{file} is too short to be a palette file")
+        magic, version, clip_count, self.joint_count, skeleton_id = HEADER.unpack_from(self.mapping)
+        if magic != MAGIC:
+            raise ValueError(f"{file} is not a palette file")
+        if version != VERSION:
+            raise ValueError(f"{file} is palette file version {version}, only version {VERSION} can be read")
+        self.skeleton_id: str = skeleton_id.rstrip(b'\0').decode('utf-8')
+
+        # clip id to (source hash, byte offset, sample count, duration, is looping)
+        self.table: Dict[str, Tuple[bytes, int, int, float, bool]] = {}
+        for entry in TABLE_ENTRY.iter_unpack(self.mapping[HEADER.size:HEADER.size + TABLE_ENTRY.size * clip_count]):
+            clip_id, *clip_info = entry
+            self.table[clip_id.rstrip(b'\0').decode('utf-8')] = tuple(clip_info)
+
+    @property
+    def clip_ids(self):
+        return tuple(self.table)
+
+    def stored_palettes(self, clip_id):
+        """
+        :return: a read-only (samples, joints, 3, 2) view of a clip's palettes in the mapping.
+        """
+        _, offset, sample_count, _, _ = self.table[clip_id]
+        return np.frombuffer(self.mapping, PALETTE_DTYPE, sample_count * self.joint_count * 6,
+                             offset).reshape(sample_count, self.joint_count, 3, 2)
+
+    def clip(self, clip_id, target_skeleton=None):
+        if target_skeleton is None:
+            target_skeleton = skeleton.create_skeleton(self.skeleton_id)
+        _, _, sample_count, duration, is_looping = self.table[clip_id]
+
+        palettes = np.zeros((sample_count, self.joint_count, 3, 3), dtype=np.float32)
+        palettes[..., :2] = self.stored_palettes(clip_id)
+        palettes[..., 2, 2] = 1
+        return BakedClip(target_skeleton, palettes, duration, is_looping)
+
+    def close(self):
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass  # a stored_palettes view is still alive, the mapping is freed with it.
+
+
+def load_baked(file, target):
+    """
+    Loads baked clips from a palette file, the baked counterpart to clip_file.load_clips.
+    :return: the target BakedClip, or a dict of every clip id to its BakedClip when target is None.
+    """
+    palette_file = PaletteFile(file)
+    target_skeleton = skeleton.create_skeleton(palette_file.skeleton_id)
+    clip_ids = palette_file.clip_ids if target is None else (target,)
+    baked = {clip_id: palette_file.clip(clip_id, target_skeleton) for clip_id in clip_ids}
+    palette_file.close()
+
+    if target is not None:
+        return baked[target]
+    return baked
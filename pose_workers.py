@@ -0,0 +1,222 @@
+# An opt-in worker pool that spreads pose evaluation across processes. Pose evaluation is pure CPU work, and a single
+#   process only ever uses one core, so for very large crowds the characters are sharded across workers instead.
+#
+#   Everything the workers touch lives in multiprocessing.shared_memory blocks:
+#       - the clip atlas, every clip's frame data back to back. Read-only, workers build their clips as views into it.
+#       - the job table, one row per active animation (character, clip, frame_t, weight). Written by the pool each tick.
+#       - the palettes, (capacity, joints, 3, 3) float32. Written by the workers, the renderers read views of it.
+#
+#   Characters are sharded into contiguous ranges by slot, so for the same number of characters and workers a
+#   character is always evaluated by the same worker.
+
+from typing import List, Dict, Tuple
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import os
+
+import numpy as np
+
+import animation
+from crowd import SkeletonBatch
+
+
+JOB_DTYPE = np.dtype([('character', np.int32), ('clip', np.int32), ('frame_t', np.float64), ('weight', np.float64)])
+
+
+class SharedArray:
+    """
+    A numpy array backed by a shared memory block. The creating process owns the block and unlinks it.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape: Tuple[int, ...] = tuple(shape)
+        self.dtype: np.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+
+        self.is_owner: bool = name is None
+        self.memory: SharedMemory = SharedMemory(name=name, create=self.is_owner, size=size)
+        self.array: np.ndarray = np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)
+
+    @property
+    def spec(self):
+        return self.memory.name, self.shape, self.dtype
+
+    @staticmethod
+    def attach(spec):
+        name, shape, dtype = spec
+        return SharedArray(shape, dtype, name)
+
+    def close(self):
+        self.array = None
+        try:
+            self.memory.close()
+        except BufferError:
+            pass  # something still holds a view, the mapping is freed with it.
+        if self.is_owner:
+            self.memory.unlink()
+
+
+def shard_bounds(character_count, worker_count):
+    """
+    Splits the characters into one contiguous range per worker.
+    :return: worker_count + 1 bounds, worker w evaluates the characters in [bounds[w], bounds[w+1]).
+    """
+    return [character_count * worker // worker_count for worker in range(worker_count + 1)]
+
+
+def evaluate_shard(target_skeleton, clips, jobs, palettes, first_character, last_character):
+    """
+    Samples and blends the palettes of the characters in [first_character, last_character).
+    :param jobs: the job table rows of every active animation, ordered by character.
+    """
+    rows = slice(*np.searchsorted(jobs['character'], (first_character, last_character)))
+    shard = jobs[rows]
+    if not len(shard):
+        return
+
+    pose_data = np.empty((len(shard), target_skeleton.joint_count, 4), dtype=np.float32)
+    for clip_index in np.unique(shard['clip']):
+        clip_rows = shard['clip'] == clip_index
+        pose_data[clip_rows] = clips[clip_index].sample_many(shard['frame_t'][clip_rows])
+
+    animation.blend_palettes(target_skeleton, pose_data, shard['weight'], shard['character'], palettes)
+
+
+def worker_main(connection, target_skeleton, clip_specs, atlas_spec, jobs_spec, palettes_spec):
+    atlas = SharedArray.attach(atlas_spec)
+    jobs = SharedArray.attach(jobs_spec)
+    palettes = SharedArray.attach(palettes_spec)
+
+    atlas.array.flags.writeable = False
+    clips = [animation.Clip(target_skeleton, atlas.array[start:end], fps, is_looping)
+             for start, end, fps, is_looping in clip_specs]
+
+    try:
+        while True:
+            task = connection.recv()
+            if task is None:
+                break
+
+            animation_count, first_character, last_character = task
+            evaluate_shard(target_skeleton, clips, jobs.array[:animation_count], palettes.array,
+                           first_character, last_character)
+            connection.send(True)
+    finally:
+        clips.clear()
+        for shared in (atlas, jobs, palettes):
+            shared.close()
+        connection.close()
+
+
+class PoseWorkerPool(SkeletonBatch):
+    """
+    A SkeletonBatch evaluated by worker processes. Only one skeleton is supported per pool, every animation must
+    play one of the clips the pool was made with, and animation layers and inertialized transitions are not
+    supported.
+
+    Registered renderers behave the same as with a crowd.CrowdAnimator. Call update once per tick and close, or use
+    the pool as a context manager, to stop the workers and free the shared memory.
+    """
+
+    def __init__(self, target_skeleton, clips: List[animation.Clip], worker_count=None, capacity=1024,
+                 animation_capacity=None):
+        self.worker_count: int = worker_count or os.cpu_count() or 1
+        self.clips: List[animation.Clip] = list(clips)
+        self.clip_indices: Dict[animation.Clip, int] = {clip: index for index, clip in enumerate(self.clips)}
+
+        frame_counts = [clip.frame_count for clip in self.clips]
+        ends = np.cumsum(frame_counts).tolist()
+        clip_specs = [(end - count, end, clip.frames_per_second, clip.is_looping)
+                      for clip, count, end in zip(self.clips, frame_counts, ends)]
+
+        self.atlas: SharedArray = SharedArray((sum(frame_counts), target_skeleton.joint_count, 4), np.float32)
+        for clip, (start, end, _, _) in zip(self.clips, clip_specs):
+            self.atlas.array[start:end] = clip.frame_data
+
+        self.jobs: SharedArray = SharedArray((animation_capacity or 4 * capacity,), JOB_DTYPE)
+        self.shared_palettes: SharedArray = SharedArray((capacity, target_skeleton.joint_count, 3, 3), np.float32)
+
+        super().__init__(target_skeleton, capacity)
+        self.palettes = self.shared_palettes.array
+
+        context = get_context()
+        self.connections = []
+        self.workers = []
+        for _ in range(self.worker_count):
+            parent_connection, child_connection = context.Pipe()
+            worker = context.Process(target=worker_main, daemon=True,
+                                     args=(child_connection, target_skeleton, clip_specs, self.atlas.spec,
+                                           self.jobs.spec, self.shared_palettes.spec))
+            worker.start()
+            child_connection.close()
+            self.connections.append(parent_connection)
+            self.workers.append(worker)
+
+    def add(self, renderer):
+        if len(self.renderers) == len(self.palettes):
+            raise ValueError(f"the pose worker pool is full, it was made with a capacity of {len(self.palettes)}")
+        super().add(renderer)
+
+    def register(self, renderer):
+        self.add(renderer)
+        renderer.crowd = self
+
+    def unregister(self, renderer):
+        self.remove(renderer)
+        renderer.crowd = None
+        renderer.palette = None
+
+    def evaluate(self):
+        clips, frame_ts, weights, characters, layers = self.gather()
+        if layers or any(renderer.animator.inertialization is not None for renderer in self.renderers):
+            raise ValueError("the pose worker pool cannot evaluate animation layers or transitions, "
+                             "use a crowd.CrowdAnimator")
+        animation_count = len(frame_ts)
+        if not animation_count:
+            return
+        if animation_count > len(self.jobs.array):
+            raise ValueError(f"{animation_count} animations are active but the pool only has room for "
+                             f"{len(self.jobs.array)}")
+
+        jobs = self.jobs.array[:animation_count]
+        jobs['character'] = characters
+        jobs['frame_t'] = frame_ts
+        jobs['weight'] = weights
+        for clip, rows in clips.items():
+            jobs['clip'][rows] = self.clip_indices[clip]
+
+        bounds = shard_bounds(len(self.renderers), self.worker_count)
+        for worker, connection in enumerate(self.connections):
+            connection.send((animation_count, bounds[worker], bounds[worker + 1]))
+        for connection in self.connections:
+            connection.recv()
+
+    def update(self):
+        self.evaluate()
+
+    def close(self, timeout=1.0):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        for connection in self.connections:
+            connection.close()
+        self.connections, self.workers = [], []
+
+        for renderer in tuple(self.renderers):
+            self.unregister(renderer)
+        self.palettes = None
+        for shared in (self.atlas, self.jobs, self.shared_palettes):
+            shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,187 @@
+# Per frame instrumentation. Hot functions are marked with @span(subsystem), which only records the function and
+#   returns it untouched, so a disabled tracer costs nothing. TRACER.enable swaps every marked function for a timing
+#   wrapper on its class or module, and TRACER.disable puts the originals back.
+#
+#   Spans go into a preallocated ring buffer, so recording one allocates nothing that outlives it, and the buffer can
+#   be written out as Chrome trace event json (open it in chrome://tracing or Perfetto). Each span's self time, its
+#   time minus the spans nested inside it, is also added to its subsystem's total for the frame. Call
+#   TRACER.end_frame once per frame to roll those totals, which the overlay in profiling_overlay draws.
+#
+#   A marked function must be reachable from its module by its qualified name, and must be looked up through its
+#   class or module when called. A name imported with "from module import function" keeps the unwrapped function.
+
+from typing import List, Dict, Tuple, Callable
+from collections import deque
+from functools import wraps
+from threading import local, Lock, get_ident
+from time import perf_counter_ns
+import json
+import os
+import sys
+
+import numpy as np
+
+
+DEFAULT_CAPACITY = 65536  # spans kept in the ring buffer
+DEFAULT_WINDOW = 120  # frames the rolling subsystem timings average over
+
+SPANS: List[Tuple[Callable, str, str]] = []  # every marked function, its subsystem, and its span name
+
+
+def span(subsystem, name=None):
+    """
+    Marks a function or method to be timed while the tracer is enabled.
+    :param subsystem: the subsystem the function's time counts towards, e.g. 'sampling' or 'render'.
+    :param name: the span name, defaults to the function's qualified name.
+    """
+    def mark(function):
+        SPANS.append((function, subsystem, name or function.__qualname__))
+        return function
+    return mark
+
+
+def find_owner(function):
+    owner = sys.modules[function.__module__]
+    for attribute in function.__qualname__.split('.')[:-1]:
+        owner = getattr(owner, attribute)
+    return owner
+
+
+class Tracer:
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, window=DEFAULT_WINDOW):
+        self.is_enabled: bool = False
+        self.originals: List[Tuple[object, str, Callable]] = []
+
+        # The ring buffer, span i is at i % capacity. Each span's function is stored as its index into SPANS.
+        self.capacity: int = capacity
+        self.span_count: int = 0
+        self.span_ids: np.ndarray = np.zeros(capacity, dtype=np.int32)
+        self.span_starts: np.ndarray = np.zeros(capacity, dtype=np.int64)  # ns
+        self.span_durations: np.ndarray = np.zeros(capacity, dtype=np.int64)  # ns
+        self.span_threads: np.ndarray = np.zeros(capacity, dtype=np.uint64)
+        self.frame_starts: deque = deque(maxlen=capacity)
+
+        self.lock: Lock = Lock()
+        self.stacks = local()  # each thread's child time accumulators for the spans it has open
+        self.frame_times: Dict[str, int] = {}  # subsystem self time this frame, in ns
+        self.window: int = window
+        self.history: Dict[str, deque] = {}  # subsystem self time of the last window frames, in ns
+        self.frame_start: int = perf_counter_ns()
+
+    # -- SWITCHING --
+
+    def enable(self):
+        if self.is_enabled:
+            return
+        self.is_enabled = True
+        for span_id, (function, subsystem, _) in enumerate(SPANS):
+            owner = find_owner(function)
+            attribute = function.__name__
+            self.originals.append((owner, attribute, owner.__dict__[attribute]))
+            setattr(owner, attribute, self.wrap(function, subsystem, span_id))
+        self.frame_start = perf_counter_ns()
+
+    def disable(self):
+        for owner, attribute, original in reversed(self.originals):
+            setattr(owner, attribute, original)
+        self.originals.clear()
+        self.is_enabled = False
+
+    def wrap(self, function, subsystem, span_id):
+        @wraps(function)
+        def traced(*args, **kwargs):
+            stack = self.find_stack()
+            stack.append(0)
+            start = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = perf_counter_ns()
+                child_time = stack.pop()
+                if stack:
+                    stack[-1] += end - start
+                self.record(span_id, subsystem, start, end - start, end - start - child_time)
+        return traced
+
+    def find_stack(self):
+        stack = getattr(self.stacks, 'stack', None)
+        if stack is None:
+            stack = self.stacks.stack = []
+        return stack
+
+    # -- RECORDING --
+
+    def record(self, span_id, subsystem, start, duration, self_time):
+        with self.lock:
+            index = self.span_count % self.capacity
+            self.span_count += 1
+            self.span_ids[index] = span_id
+            self.span_starts[index] = start
+            self.span_durations[index] = duration
+            self.span_threads[index] = get_ident()
+            self.frame_times[subsystem] = self.frame_times.get(subsystem, 0) + self_time
+
+    def end_frame(self):
+        """
+        Rolls this frame's subsystem totals into the history. Subsystems that recorded nothing this frame add a 0.
+        :return: this frame's self time per subsystem and the whole frame's time ('frame'), in ns.
+        """
+        end = perf_counter_ns()
+        with self.lock:
+            frame_times, self.frame_times = self.frame_times, {}
+            for subsystem in frame_times.keys() - self.history.keys():
+                self.history[subsystem] = deque(maxlen=self.window)
+            for subsystem, history in self.history.items():
+                history.append(frame_times.get(subsystem, 0))
+            history = self.history.setdefault('frame', deque(maxlen=self.window))
+            history.append(end - self.frame_start)
+        self.frame_starts.append(self.frame_start)
+        frame_times['frame'] = end - self.frame_start
+        self.frame_start = end
+        return frame_times
+
+    def averages_ms(self):
+        """
+        :return: each subsystem's mean self time per frame over the window, in ms. 'frame' is the whole frame.
+        """
+        with self.lock:
+            return {subsystem: sum(history) / len(history) / 1e6 for subsystem, history in self.history.items()
+                    if history}
+
+    def clear(self):
+        with self.lock:
+            self.span_count = 0
+            self.frame_starts.clear()
+            self.frame_times.clear()
+            self.history.clear()
+
+    # -- EXPORT --
+
+    def chrome_trace(self):
+        """
+        :return: the buffered spans as Chrome trace events, with an instant event at the start of every frame.
+        """
+        with self.lock:
+            first = max(0, self.span_count - self.capacity)
+            order = np.arange(first, self.span_count) % self.capacity
+            spans = zip(self.span_ids[order].tolist(), self.span_starts[order].tolist(),
+                        self.span_durations[order].tolist(), self.span_threads[order].tolist())
+
+        pid = os.getpid()
+        events = []
+        for span_id, start, duration, thread in spans:
+            _, subsystem, name = SPANS[span_id]
+            events.append({'name': name, 'cat': subsystem, 'ph': 'X', 'ts': start / 1000, 'dur': duration / 1000,
+                           'pid': pid, 'tid': thread})
+        events.extend({'name': 'frame', 'cat': 'frame', 'ph': 'i', 's': 'p', 'ts': start / 1000, 'pid': pid,
+                       'tid': 0} for start in tuple(self.frame_starts))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, file):
+        with open(file, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+        return file
+
+
+TRACER = Tracer()
@@ -0,0 +1,29 @@
+# An on screen readout of profiling.TRACER's rolling per subsystem timings. Subsystem times are self times, so they
+#   add up to the traced part of the frame.
+
+import arcade
+
+from profiling import Tracer, TRACER
+
+
+class ProfileOverlay:
+
+    def __init__(self, tracer: Tracer = TRACER, x=15, y=15, line_height=16, colour=arcade.color.BLACK):
+        self.tracer: Tracer = tracer
+        self.x: float = x
+        self.y: float = y
+        self.line_height: float = line_height
+        self.colour: arcade.Color = colour
+
+    def find_lines(self):
+        averages = self.tracer.averages_ms()
+        frame_time = averages.pop('frame', 0)
+        lines = [f"frame {frame_time:6.2f}ms, traced {sum(averages.values()):6.2f}ms"]
+        for subsystem, time_ms in sorted(averages.items(), key=lambda item: item[1], reverse=True):
+            lines.append(f"  {subsystem:<14}{time_ms:6.2f}ms")
+        return lines
+
+    def draw(self):
+        # Bottom up, so the frame total sits on top.
+        for index, line in enumerate(reversed(self.find_lines())):
+            arcade.draw_text(line, self.x, self.y + index * self.line_height, self.colour, 12)
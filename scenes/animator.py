@@ -1,6 +1,5 @@
 import json
 import math
-from copy import deepcopy
 from os.path import isfile
 
 import arcade
@@ -11,6 +10,7 @@ import model
 import skeleton
 import animation
 import skinned_renderer
+from scheduler import AnimationScheduler
 from clock import GAME_CLOCK
 from global_access import SCREEN_WIDTH, SCREEN_HEIGHT
 
@@ -29,7 +29,7 @@ def prim_model_from_skeleton(base_skeleton: skeleton.Skeleton):
         else:
             segment_color = arcade.color.WHITE
 
-        model_pos = la.Vec2(0) * la.Matrix33.lazy_inverse(joint.inv_bind_pose_matrix)
+        model_pos = joint.joint_model_pos
         index = base_skeleton.joints.index(joint)
 
         segment = model.SegmentPrimitive(segment_name, segment_color, 2, model_pos, index, joint.parent)
@@ -37,18 +37,8 @@ def prim_model_from_skeleton(base_skeleton: skeleton.Skeleton):
     return model.PrimitiveModel(segments, base_skeleton.skeleton_id)
 
 
-def calculate_model_poses(joints, joint_poses):
-    model_poses = []
-    for index, joint in enumerate(joints):
-        if joint.parent != -1:
-            former_matrix = model_poses[joint.parent]
-        else:
-            former_matrix = la.Matrix33()
-
-        current_matrix = joint_poses[index].to_matrix() * former_matrix
-        model_poses.append(current_matrix)
-
-    return model_poses
+def calculate_model_poses(target_skeleton: skeleton.Skeleton, pose: animation.FramePose):
+    return la.Matrix33Array(target_skeleton.compose(animation.local_matrices(pose.to_array())))
 
 
 def save_clips(target_skeleton: skeleton.Skeleton, target_file: str, clips: dict):
@@ -85,7 +75,7 @@ class AnimatorWindow(arcade.Window):
         self.pending_frame = 0
 
         self.current_pose: animation.FramePose = current_pose
-        self.model_world_matrices = calculate_model_poses(self.current_skeleton.joints, current_pose.joint_poses)
+        self.model_world_matrices = calculate_model_poses(self.current_skeleton, current_pose)
 
         self.selected_joint = -1
 
@@ -100,17 +90,19 @@ class AnimatorWindow(arcade.Window):
 
         self.test_mesh_renderer = skinned_renderer.create_sample_mesh_renderer(self.ctx)
 
+        self.scheduler = AnimationScheduler()
+        self.scheduler.register(self.frame_renderer, important=True)
+        self.scheduler.register(self.test_mesh_renderer)
+
     def on_key_press(self, symbol: int, modifiers: int):
         if symbol == arcade.key.PERIOD:
             self.current_frame = (self.current_frame + 1) % self.current_clip.frame_count
-            self.current_pose = self.current_clip.frames[self.current_frame]
-            self.model_world_matrices = calculate_model_poses(self.current_skeleton.joints,
-                                                              self.current_pose.joint_poses)
+            self.current_pose = self.current_clip.frames[self.current_frame].copy()
+            self.model_world_matrices = calculate_model_poses(self.current_skeleton, self.current_pose)
         elif symbol == arcade.key.COMMA:
             self.current_frame = (self.current_frame - 1) % self.current_clip.frame_count
-            self.current_pose = self.current_clip.frames[self.current_frame]
-            self.model_world_matrices = calculate_model_poses(self.current_skeleton.joints,
-                                                              self.current_pose.joint_poses)
+            self.current_pose = self.current_clip.frames[self.current_frame].copy()
+            self.model_world_matrices = calculate_model_poses(self.current_skeleton, self.current_pose)
         elif symbol == arcade.key.SPACE:
             if self.animation is not None:
                 self.animation.smooth_stop()
@@ -121,30 +113,25 @@ class AnimatorWindow(arcade.Window):
 
         elif symbol == arcade.key.P:
             self.current_frame = self.pending_frame
-            self.current_pose = self.current_clip.frames[self.pending_frame]
-            self.model_world_matrices = calculate_model_poses(self.current_skeleton.joints,
-                                                              self.current_pose.joint_poses)
+            self.current_pose = self.current_clip.frames[self.pending_frame].copy()
+            self.model_world_matrices = calculate_model_poses(self.current_skeleton, self.current_pose)
         elif symbol == arcade.key.EQUAL:
             self.current_frame += 1
 
-            self.current_clip.frames.insert(self.current_frame, deepcopy(self.t_pose))
-            self.current_clip.frame_count = len(self.current_clip.frames)
+            self.current_clip.insert_frame(self.current_frame, self.t_pose)
 
-            self.current_pose = self.current_clip.frames[self.current_frame]
+            self.current_pose = self.current_clip.frames[self.current_frame].copy()
             self.pending_frame = self.current_frame
 
-            self.model_world_matrices = calculate_model_poses(self.current_skeleton.joints,
-                                                              self.current_pose.joint_poses)
+            self.model_world_matrices = calculate_model_poses(self.current_skeleton, self.current_pose)
         elif symbol == arcade.key.MINUS and self.current_clip.frame_count > 1:
-            self.current_clip.frames.remove(self.current_pose)
-            self.current_clip.frame_count = len(self.current_clip.frames)
+            self.current_clip.remove_frame(self.current_frame)
 
             self.current_frame = (self.current_frame - 1) % self.current_clip.frame_count
-            self.current_pose = self.current_clip.frames[self.current_frame]
+            self.current_pose = self.current_clip.frames[self.current_frame].copy()
             self.pending_frame = self.current_frame
 
-            self.model_world_matrices = calculate_model_poses(self.current_skeleton.joints,
-                                                              self.current_pose.joint_poses)
+            self.model_world_matrices = calculate_model_poses(self.current_skeleton, self.current_pose)
         elif symbol == arcade.key.S:
             if modifiers & arcade.key.LCTRL:
                 save_clips(self.current_skeleton, self.target_clips, self.clips)
@@ -154,6 +141,7 @@ class AnimatorWindow(arcade.Window):
 
     def on_draw(self):
         arcade.start_render()
+        self.scheduler.update()
 
         arcade.draw_line(0, SCREEN_HEIGHT/2-1, SCREEN_WIDTH, SCREEN_HEIGHT/2-1, arcade.color.WHITE, 2)
 
@@ -183,9 +171,9 @@ class AnimatorWindow(arcade.Window):
         if self.selected_joint != -1:
             parent_index = self.current_skeleton.joints[self.selected_joint].parent
             if parent_index != -1:
-                parent_matrix = la.Matrix33.lazy_inverse(self.model_world_matrices[parent_index])
+                parent_matrix = la.Affine2.from_matrix33(self.model_world_matrices[parent_index]).inverse()
             else:
-                parent_matrix = la.Matrix33()
+                parent_matrix = la.Affine2()
 
             pose_angle = self.current_pose.joint_poses[self.selected_joint].translation.theta
             square_length = self.current_pose.joint_poses[self.selected_joint].translation.square_length
@@ -201,9 +189,9 @@ class AnimatorWindow(arcade.Window):
             angle_change = self.current_pose.joint_poses[self.selected_joint].translation.theta - pose_angle
             if parent_index != -1:
                 self.current_pose.joint_poses[self.selected_joint].angle += angle_change
+            self.current_clip.set_frame(self.current_frame, self.current_pose)
 
-            self.model_world_matrices = calculate_model_poses(self.current_skeleton.joints,
-                                                              self.current_pose.joint_poses)
+            self.model_world_matrices = calculate_model_poses(self.current_skeleton, self.current_pose)
 
     def on_mouse_scroll(self, x: int, y: int, scroll_x: int, scroll_y: int):
         GAME_CLOCK.run_speed += scroll_y/15
@@ -226,19 +214,16 @@ def animator_setup():
 
     print(target_clip, json_data)
     if target_clip not in clips:
-        current_clip = animation.Clip(current_skeleton, [], 1/30, True)
+        current_clip = animation.Clip.from_frames(current_skeleton, [], 1/30, True)
         clips[target_clip] = current_clip
     else:
         current_clip = clips[target_clip]
 
     t_pose = animation.generate_frame(json.load(open(f"resources/poses/{target_skeleton}.json"))['poses']['t'])
 
-    if not current_clip.frames:
-        current_pose = deepcopy(t_pose)
-        current_clip.frames.append(current_pose)
-        current_clip.frame_count = len(current_clip.frames)
-    else:
-        current_pose = current_clip.frames[0]
+    if not current_clip.frame_count:
+        current_clip.insert_frame(0, t_pose)
+    current_pose = current_clip.frames[0].copy()
 
     return AnimatorWindow(current_skeleton, clips, current_clip, current_pose, t_pose, target_clips)
 
@@ -1,7 +1,15 @@
+from typing import List
+
 import arcade
 
-from skinned_renderer import create_sample_prim_renderer, create_sample_sprite_renderer, create_sample_mesh_renderer
-from model import load_mesh_model
+from skinned_renderer import make_sample_prim_renderer, make_sample_sprite_renderer, make_sample_mesh_renderer
+from scheduler import AnimationScheduler
+from crowd import CrowdAnimator
+from palette_cache import PaletteCache
+from loading import AssetLoader, gather
+from profiling import TRACER
+from profiling_overlay import ProfileOverlay
+from memory import ASSETS
 from clock import GAME_CLOCK
 from global_access import SCREEN_WIDTH, SCREEN_HEIGHT
 from lin_al import Vec2
@@ -11,6 +19,8 @@ from lin_al import Vec2
 # It is in no way expected to be usable without modification, but should hopefully give a basic method for others to
 # implement.
 
+TRACE_FILE = "trace.json"
+
 
 class SampleScene(arcade.Window):
 
@@ -20,32 +30,96 @@ class SampleScene(arcade.Window):
         GAME_CLOCK.begin()
 
         self.selected_joint = -1
-        self.test_prim_entity = create_sample_prim_renderer()
-
-        self.test_sprite_renderer = create_sample_sprite_renderer()
-
-        self.test_mesh_renderer = create_sample_mesh_renderer(self.ctx)
-
-        load_mesh_model("robot")
+        self.test_prim_entity = None
+        self.test_sprite_renderer = None
+        self.test_mesh_renderer = None
+        self.load_errors: List[str] = []
+
+        # The scheduler picks which renderers are evaluated each frame within its budget, and the crowd evaluates
+        #   those together, one batch per skeleton. The sample clips loop forever, so after the first frame their
+        #   palettes are only ever looked up.
+        self.palette_cache = PaletteCache()
+        self.crowd = CrowdAnimator(self.palette_cache)
+        self.scheduler = AnimationScheduler(crowd=self.crowd)
+
+        # P toggles tracing and its overlay, T writes the traced spans to TRACE_FILE, M prints a memory report.
+        self.profile_overlay = ProfileOverlay(y=40)
+
+        # Each renderer starts animating as soon as its own assets are in, the rest keep loading in the background.
+        self.loader = AssetLoader()
+        robot_clip = self.loader.load_clips("resources/poses/animations/robot_motion.json", 'run', priority=1)
+        robot_skeleton = self.loader.create_skeleton("robot", priority=1)
+
+        gather([self.loader.create_skeleton("basic"),
+                self.loader.create_primitive_model("resources/models/primitives/basic.json"),
+                self.loader.load_clips("resources/poses/animations/basic_motion.json", 'run')]
+               ).add_done_callback(self.when_loaded('prim renderer', self.add_prim_renderer))
+        gather([robot_skeleton, self.loader.create_sprite_model("resources/models/sprites/robot.json"), robot_clip]
+               ).add_done_callback(self.when_loaded('sprite renderer', self.add_sprite_renderer))
+        gather([robot_skeleton, self.loader.load_mesh_model('robot', self.ctx), robot_clip]
+               ).add_done_callback(self.when_loaded('mesh renderer', self.add_mesh_renderer))
+
+    def when_loaded(self, label, add_renderer):
+        """
+        :return: a done callback that makes the renderer from the loaded assets. A failed load is printed and shown in
+        place of the renderer, instead of being lost inside the future.
+        """
+        def on_done(loaded):
+            if loaded.cancelled():
+                return
+            error = loaded.exception()
+            if error is not None:
+                print(f"could not load the {label}: {error!r}")
+                self.load_errors.append(f"{label} failed to load: {error}")
+                return
+            add_renderer(*loaded.result())
+        return on_done
+
+    def register_renderer(self, renderer):
+        self.scheduler.register(renderer)
+        return renderer
+
+    def add_prim_renderer(self, entity_skeleton, entity_model, clip):
+        self.test_prim_entity = self.register_renderer(make_sample_prim_renderer(entity_skeleton, entity_model, clip))
+
+    def add_sprite_renderer(self, render_skeleton, render_model, clip):
+        self.test_sprite_renderer = self.register_renderer(
+            make_sample_sprite_renderer(render_skeleton, render_model, clip))
+
+    def add_mesh_renderer(self, render_skeleton, render_model, clip):
+        self.test_mesh_renderer = self.register_renderer(
+            make_sample_mesh_renderer(render_skeleton, render_model, clip, self.ctx))
 
     def on_update(self, delta_time: float):
         GAME_CLOCK.increment(delta_time)
+        self.loader.update(budget_ms=4)
 
     def on_draw(self):
         arcade.start_render()
+        self.scheduler.update()
 
         arcade.draw_text("Prim Renderer", SCREEN_WIDTH/6, SCREEN_HEIGHT/2,
                          anchor_x='center', anchor_y='top', color=arcade.color.BLACK)
-        self.test_prim_entity.draw()
+        if self.test_prim_entity is not None:
+            self.test_prim_entity.draw()
 
         arcade.draw_text("Sprite Renderer", SCREEN_WIDTH/2, SCREEN_HEIGHT/2,
                          anchor_x='center', anchor_y='top', color=arcade.color.BLACK)
-        self.test_sprite_renderer.find_render_data()
-        self.test_sprite_renderer.draw()
+        if self.test_sprite_renderer is not None:
+            self.test_sprite_renderer.find_render_data()
+            self.test_sprite_renderer.draw()
 
         arcade.draw_text("Mesh Renderer", 5*SCREEN_WIDTH / 6, SCREEN_HEIGHT / 2,
                          anchor_x='center', anchor_y='top', color=arcade.color.BLACK)
-        self.test_mesh_renderer.draw()
+        if self.test_mesh_renderer is not None:
+            self.test_mesh_renderer.draw()
+
+        for line, load_error in enumerate(self.load_errors):
+            arcade.draw_text(load_error, SCREEN_WIDTH / 2, 35 + 20 * line, anchor_x='center', color=arcade.color.RED)
+
+        if not self.loader.is_idle:
+            arcade.draw_text(f"loading {self.loader.progress:.0%}: {', '.join(self.loader.pending_labels())}",
+                             SCREEN_WIDTH / 2, 15, anchor_x='center', color=arcade.color.BLACK)
 
         if not GAME_CLOCK.is_counting:
             arcade.draw_text(f"PAUSED - time elapsed since last pause: {GAME_CLOCK.concurrent_run_time}s",
@@ -54,6 +128,15 @@ class SampleScene(arcade.Window):
             arcade.draw_text(f"time elapsed: {GAME_CLOCK.run_time}s, run speed: {GAME_CLOCK.run_speed}",
                              SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2 - 200, anchor_x='center', color=arcade.color.BLACK)
 
+        arcade.draw_text(f"animation: {self.scheduler.frame_time_ms:.2f}ms, "
+                         f"deferred: {self.scheduler.deferred_count}/{len(self.scheduler.entries)}, "
+                         f"palette cache hits: {self.palette_cache.hit_rate:.0%}",
+                         15, SCREEN_HEIGHT - 15, anchor_y='top', color=arcade.color.BLACK)
+
+        if TRACER.is_enabled:
+            self.profile_overlay.draw()
+            TRACER.end_frame()
+
     # -- BUTTON EVENTS --
 
     def on_key_press(self, symbol: int, modifiers: int):
@@ -63,8 +146,35 @@ class SampleScene(arcade.Window):
             GAME_CLOCK.run_speed += 0.1
         elif symbol == arcade.key.MINUS:
             GAME_CLOCK.run_speed -= 0.1
+        elif symbol == arcade.key.P:
+            if TRACER.is_enabled:
+                TRACER.disable()
+            else:
+                TRACER.clear()
+                TRACER.enable()
+        elif symbol == arcade.key.T:
+            print(f"trace written to {TRACER.write_chrome_trace(TRACE_FILE)}")
+        elif symbol == arcade.key.M:
+            self.print_memory_report()
+
+    def print_memory_report(self):
+        print(f"registered assets: {len(ASSETS)}, {ASSETS.nbytes / 1024:.1f}KB budgeted")
+        for row in ASSETS.report():
+            print(f"  {row['key']:<60} {row['deep_bytes'] / 1024:8.1f}KB {row['objects']:>6} objects "
+                  f"{row['references']:>3} references")
+        for renderer in (self.test_prim_entity, self.test_sprite_renderer, self.test_mesh_renderer):
+            if renderer is None:
+                continue
+            attributes = ASSETS.instance_report(renderer, (self.scheduler, self.crowd, self.palette_cache))
+            total_bytes, total_objects = attributes.pop('total')
+            print(f"{type(renderer).__name__}: {total_bytes / 1024:.1f}KB in {total_objects} objects")
+            for attribute, (attribute_bytes, objects) in attributes.items():
+                if objects:
+                    print(f"  {attribute:<24} {attribute_bytes / 1024:8.1f}KB {objects:>6} objects")
 
     def on_mouse_scroll(self, x: int, y: int, scroll_x: int, scroll_y: int):
-        self.test_prim_entity.transform.scale += Vec2(scroll_y)
-        self.test_mesh_renderer.transform.scale += Vec2(scroll_y)
-        self.test_mesh_renderer.update_world_matrix()
+        if self.test_prim_entity is not None:
+            self.test_prim_entity.transform.scale += Vec2(scroll_y)
+        if self.test_mesh_renderer is not None:
+            self.test_mesh_renderer.transform.scale += Vec2(scroll_y)
+            self.test_mesh_renderer.update_world_matrix()
@@ -0,0 +1,252 @@
+import json
+import random
+from time import perf_counter
+from argparse import ArgumentParser
+from typing import List, Dict
+
+import numpy as np
+import arcade
+
+import lin_al as la
+import transform
+import skeleton
+import model
+import clip_file
+from skinned_renderer import SkinnedRenderer, Primitive, Sprites, Mesh
+from crowd import CrowdAnimator
+from profiling import TRACER
+from memory import FrameAllocationCounter
+from clock import GAME_CLOCK
+from global_access import SCREEN_WIDTH, SCREEN_HEIGHT
+
+# A stress test of each renderer type. For every renderer the scene spawns N characters with a random clip phase,
+#   playback speed, and transform, draws them for a number of frames, and doubles N until the renderer can no longer
+#   hold 60Hz. Each step records the frame time percentiles and the CPU time of every traced subsystem, and once every
+#   renderer is done the scene prints a report of the character count each one sustains and closes.
+#
+#   Run from the project root: python -m scenes.stress_scene [--renderers prim sprite mesh] [--counts N ...]
+#       [--start 1] [--max 4096] [--frames 120] [--crowd] [--hidden] [--out report.json]
+#
+#   Frames are driven by the scene rather than arcade.run, with a fixed clock step, and every frame waits on the GPU
+#   so the frame time includes the draw calls. --hidden opens no visible window. On a machine without a display set
+#   ARCADE_HEADLESS=1 as well, so arcade makes a headless (EGL) context.
+
+TARGET_FRAME_TIME = 1 / 60
+PERCENTILES = (50, 95, 99)
+SUSTAIN_PERCENTILE = 95  # a count is sustained when this percentile of its frames fits in TARGET_FRAME_TIME
+
+
+class StressStep:
+    """
+    The measurements of one renderer type at one character count.
+    """
+
+    def __init__(self, renderer_type, character_count):
+        self.renderer_type: str = renderer_type
+        self.character_count: int = character_count
+        self.frame_times: List[float] = []  # seconds
+        self.subsystem_times: Dict[str, float] = {}  # summed seconds over every measured frame
+        self.allocations: FrameAllocationCounter = None  # the memory blocks each measured frame left behind
+
+    def percentiles_ms(self):
+        return dict(zip(PERCENTILES, (np.percentile(self.frame_times, PERCENTILES) * 1000).tolist()))
+
+    @property
+    def is_sustained(self):
+        return np.percentile(self.frame_times, SUSTAIN_PERCENTILE) <= TARGET_FRAME_TIME
+
+    def to_json(self):
+        frame_count = len(self.frame_times)
+        return {'renderer': self.renderer_type, 'characters': self.character_count,
+                'frame_ms': {f"p{percentile}": time for percentile, time in self.percentiles_ms().items()},
+                'subsystem_ms': {subsystem: time / frame_count * 1000
+                                 for subsystem, time in sorted(self.subsystem_times.items())},
+                'blocks_per_frame': self.allocations.blocks_per_frame, 'sustained': bool(self.is_sustained)}
+
+
+class StressScene(arcade.Window):
+
+    def __init__(self, renderer_types=('prim', 'sprite', 'mesh'), counts=None, start=1, max_count=4096,
+                 frames=120, warmup=10, use_crowd=False, visible=True, seed=0):
+        super().__init__(SCREEN_WIDTH, SCREEN_HEIGHT, "BoneCade stress test", visible=visible, vsync=False)
+        arcade.set_background_color(arcade.color.WHITE)
+        GAME_CLOCK.begin()
+
+        self.renderer_types: List[str] = list(renderer_types)
+        self.counts: List[int] = counts  # fixed character counts, ramps by doubling when None
+        self.start: int = start
+        self.max_count: int = max_count
+        self.frames: int = frames
+        self.warmup: int = warmup  # frames drawn at each step before measuring
+        self.use_crowd: bool = use_crowd
+        self.rng: random.Random = random.Random(seed)
+
+        self.factories = {'prim': self.make_primitive, 'sprite': self.make_sprites, 'mesh': self.make_mesh}
+        self.basic_skeleton = skeleton.create_skeleton("basic")
+        self.basic_clip = clip_file.load_clips("resources/poses/animations/basic_motion.json", 'run')
+        self.robot_skeleton = skeleton.create_skeleton("robot")
+        self.robot_clip = clip_file.load_clips("resources/poses/animations/robot_motion.json", 'run')
+        self.prim_model = model.create_primitive_model("resources/models/primitives/basic.json")
+        self.mesh_model = model.create_mesh_model('robot')
+
+        self.characters: List[SkinnedRenderer] = []
+        self.crowd: CrowdAnimator = None
+        self.steps: List[StressStep] = []
+
+    # -- CHARACTERS --
+
+    def random_transform(self):
+        position = la.Vec2(self.rng.uniform(0, SCREEN_WIDTH), self.rng.uniform(0, SCREEN_HEIGHT))
+        return transform.Transform(position, la.Vec2(self.rng.uniform(32, 128)), 0)
+
+    def animate(self, character, clip):
+        playback = self.rng.uniform(0.25, 0.5)
+        phase = self.rng.random() * clip.duration / playback
+        character.animator.add_animation(clip, 1, GAME_CLOCK.run_time - phase, -1, playback)
+        return character
+
+    def make_primitive(self):
+        return self.animate(Primitive(self.basic_skeleton, self.prim_model, self.random_transform()), self.basic_clip)
+
+    def make_sprites(self):
+        sprite_model = model.create_sprite_model("resources/models/sprites/robot.json")
+        return self.animate(Sprites(self.robot_skeleton, sprite_model, self.random_transform()), self.robot_clip)
+
+    def make_mesh(self):
+        return self.animate(Mesh(self.robot_skeleton, self.mesh_model, self.random_transform(), self.ctx),
+                            self.robot_clip)
+
+    def spawn(self, renderer_type, count):
+        self.clear_characters()
+        self.characters = [self.factories[renderer_type]() for _ in range(count)]
+        if self.use_crowd:
+            self.crowd = CrowdAnimator()
+            for character in self.characters:
+                self.crowd.register(character)
+
+    def clear_characters(self):
+        for character in self.characters:
+            character.release_assets()
+        self.characters = []
+        self.crowd = None
+
+    # -- FRAMES --
+
+    def draw_frame(self):
+        arcade.start_render()
+        if self.crowd is not None:
+            self.crowd.update()
+        for character in self.characters:
+            if isinstance(character, Sprites):
+                character.find_render_data()
+            character.draw()
+        self.ctx.finish()  # wait on the GPU so the frame time covers the draw calls
+
+    def run_step(self, renderer_type, count):
+        self.spawn(renderer_type, count)
+        step = StressStep(renderer_type, count)
+        # The collector runs outside the timed part. The step's own frame times and the tracer's frame history add
+        #   about two blocks a frame, anything more is kept by the characters.
+        step.allocations = FrameAllocationCounter(self.frames, collect=True)
+
+        for frame in range(self.warmup + self.frames):
+            is_measured = frame >= self.warmup
+            if is_measured:
+                step.allocations.begin_frame()
+
+            self.dispatch_events()
+            GAME_CLOCK.increment(TARGET_FRAME_TIME)
+
+            start = perf_counter()
+            self.draw_frame()
+            frame_time = perf_counter() - start
+            subsystem_times = TRACER.end_frame()
+            self.flip()
+
+            if is_measured:
+                step.frame_times.append(frame_time)
+                for subsystem, time in subsystem_times.items():
+                    if subsystem != 'frame':
+                        step.subsystem_times[subsystem] = step.subsystem_times.get(subsystem, 0) + time / 1e9
+                del subsystem_times
+                step.allocations.end_frame()
+
+        self.steps.append(step)
+        percentiles = step.percentiles_ms()
+        print(f"{renderer_type:<7}{count:>6} characters  " +
+              "  ".join(f"p{percentile} {time:7.2f}ms" for percentile, time in percentiles.items()) +
+              f"  {step.allocations.blocks_per_frame:+.1f} blocks/frame")
+        return step
+
+    def run_renderer(self, renderer_type):
+        if self.counts is not None:
+            for count in self.counts:
+                self.run_step(renderer_type, count)
+            return
+
+        count = self.start
+        while count <= self.max_count and self.run_step(renderer_type, count).is_sustained:
+            count *= 2
+
+    def run(self):
+        TRACER.clear()
+        TRACER.enable()
+        try:
+            for renderer_type in self.renderer_types:
+                self.run_renderer(renderer_type)
+        finally:
+            TRACER.disable()
+            self.clear_characters()
+        return self.report()
+
+    # -- REPORT --
+
+    def sustained_counts(self):
+        """
+        :return: the largest character count each renderer type held at 60Hz, 0 if it never did.
+        """
+        return {renderer_type: max([step.character_count for step in self.steps
+                                    if step.renderer_type == renderer_type and step.is_sustained], default=0)
+                for renderer_type in self.renderer_types}
+
+    def report(self):
+        report = {'target_frame_ms': TARGET_FRAME_TIME * 1000, 'sustain_percentile': SUSTAIN_PERCENTILE,
+                  'crowd': self.use_crowd, 'steps': [step.to_json() for step in self.steps],
+                  'sustained': self.sustained_counts()}
+
+        print(f"\ncharacters held at 60Hz (p{SUSTAIN_PERCENTILE} frame time under {TARGET_FRAME_TIME * 1000:.2f}ms):")
+        for renderer_type, count in report['sustained'].items():
+            never_dropped = all(step.is_sustained for step in self.steps if step.renderer_type == renderer_type)
+            print(f"  {renderer_type:<7}{count:>6}{'  (never dropped below 60Hz)' if never_dropped else ''}")
+        for step in report['steps']:
+            subsystems = ", ".join(f"{subsystem} {time:.2f}" for subsystem, time in step['subsystem_ms'].items())
+            print(f"  {step['renderer']:<7}{step['characters']:>6}: {subsystems} (ms/frame)")
+        return report
+
+
+def main():
+    parser = ArgumentParser(description="Ramps the character count of each renderer until it drops below 60Hz.")
+    parser.add_argument('--renderers', nargs='+', default=['prim', 'sprite', 'mesh'],
+                        choices=['prim', 'sprite', 'mesh'])
+    parser.add_argument('--counts', nargs='+', type=int, default=None, help="fixed character counts, skips the ramp")
+    parser.add_argument('--start', type=int, default=1, help="the first character count of the ramp")
+    parser.add_argument('--max', type=int, default=4096, help="the ramp stops after this many characters")
+    parser.add_argument('--frames', type=int, default=120, help="measured frames per character count")
+    parser.add_argument('--crowd', action='store_true', help="evaluate the characters with a CrowdAnimator")
+    parser.add_argument('--hidden', action='store_true', help="do not show the window")
+    parser.add_argument('--out', default=None, help="write the report to this json file")
+    args = parser.parse_args()
+
+    scene = StressScene(args.renderers, args.counts, args.start, args.max, args.frames, use_crowd=args.crowd,
+                        visible=not args.hidden)
+    report = scene.run()
+    scene.close()
+
+    if args.out is not None:
+        with open(args.out, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        print(f"report written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# A frame time budget for animation updates. Rather than every renderer evaluating its animations every frame, the
+#   scheduler ranks its renderers and only evaluates as many as fit into the budget. Everything else keeps drawing
+#   its last palette. Every frame a renderer is skipped its staleness grows, which raises its priority, and once it
+#   reaches max_staleness it is evaluated whatever the budget, so no renderer starves.
+#
+#   Given a crowd.CrowdAnimator the scheduler only chooses which renderers are evaluated, and the crowd evaluates the
+#   chosen ones together in one batch. The batch runs after the choice is made, so the budget is spent against the
+#   measured per renderer cost of the last batch rather than the time actually taken.
+
+from typing import List
+from time import perf_counter
+
+import lin_al as la
+from global_access import SCREEN_WIDTH, SCREEN_HEIGHT
+from profiling import span
+
+
+class ScheduledRenderer:
+
+    def __init__(self, renderer, important):
+        self.renderer = renderer
+        self.important: bool = important
+        self.staleness: int = 0  # frames since the renderer was last evaluated
+        self.priority: float = 0
+
+
+class AnimationScheduler:
+    """
+    Evaluates registered renderers in priority order until the per frame budget (in milliseconds) is spent.
+
+    Priority grows with on screen size (the transform's scale), shrinks with distance from the focus point, and is
+    multiplied by importance_boost for important renderers and by 1 + staleness for renderers that were skipped.
+    :param crowd: an optional crowd.CrowdAnimator the renderers are registered with, to evaluate the chosen renderers
+    in one batch.
+    """
+
+    def __init__(self, budget_ms=2.0, focus: la.Vec2 = None, max_staleness=8, importance_boost=4.0,
+                 distance_scale=SCREEN_WIDTH/2, crowd=None):
+        self.budget: float = budget_ms / 1000
+        self.focus: la.Vec2 = focus if focus is not None else la.Vec2(SCREEN_WIDTH/2, SCREEN_HEIGHT/2)
+        self.max_staleness: int = max_staleness
+        self.importance_boost: float = importance_boost
+        self.distance_scale: float = distance_scale
+        self.crowd = crowd
+        self.renderer_cost: float = 0  # seconds per renderer of the last crowd batch
+
+        self.entries: List[ScheduledRenderer] = []
+
+        # Per frame stats from the last update.
+        self.frame_time: float = 0
+        self.evaluated_count: int = 0
+        self.deferred_count: int = 0
+        self.total_deferred: int = 0
+
+    def register(self, renderer, important=False):
+        """
+        With a crowd the renderer is registered with it too, and its crowd is the crowd that writes its palette.
+        """
+        self.entries.append(ScheduledRenderer(renderer, important))
+        if self.crowd is not None:
+            self.crowd.register(renderer)
+        else:
+            renderer.crowd = self
+
+    def unregister(self, renderer):
+        self.entries = [entry for entry in self.entries if entry.renderer is not renderer]
+        if self.crowd is not None:
+            self.crowd.unregister(renderer)
+        else:
+            renderer.crowd = None
+
+    @property
+    def frame_time_ms(self):
+        return self.frame_time * 1000
+
+    def find_priority(self, entry: ScheduledRenderer):
+        render_transform = entry.renderer.transform
+        screen_size = render_transform.scale.length
+        distance = (render_transform.position - self.focus).length
+
+        priority = screen_size / (1 + distance / self.distance_scale)
+        if entry.important:
+            priority *= self.importance_boost
+        return priority * (1 + entry.staleness)
+
+    @span('animation')
+    def update(self):
+        start = perf_counter()
+        for entry in self.entries:
+            entry.priority = self.find_priority(entry)
+
+        evaluated = []
+        for entry in sorted(self.entries, key=lambda scheduled: scheduled.priority, reverse=True):
+            spent = perf_counter() - start
+            if self.crowd is not None:
+                spent += len(evaluated) * self.renderer_cost
+            if spent >= self.budget and entry.staleness < self.max_staleness:
+                entry.staleness += 1
+                continue
+
+            renderer = entry.renderer
+            if self.crowd is None:
+                renderer.palette = renderer.evaluate_palette()
+            entry.staleness = 0
+            evaluated.append(renderer)
+
+        if self.crowd is not None and evaluated:
+            batch_start = perf_counter()
+            self.crowd.update(evaluated)
+            self.renderer_cost = (perf_counter() - batch_start) / len(evaluated)
+
+        self.frame_time = perf_counter() - start
+        self.evaluated_count = len(evaluated)
+        self.deferred_count = len(self.entries) - len(evaluated)
+        self.total_deferred += self.deferred_count
@@ -11,39 +11,202 @@
 #
 #   An issue for later, and something that will need to be profiled.
 
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from copy import deepcopy
 import json
 
-import arcade
+import numpy as np
 
 import lin_al as la
-from lin_al import RotTrans
-from memory import cache
+from memory import ASSETS, asset_key
+from profiling import span
 
 
 class Joint:
 
-    def __init__(self, inv_matrix, joint_name, parent):
-        self.inv_bind_pose_matrix: la.Matrix33 = inv_matrix
-        self.joint_model_pos: la.Vec2 = la.Vec2(0) * la.Matrix33.lazy_inverse(inv_matrix)
+    def __init__(self, inv_matrix, joint_name, parent, lod=0):
+        self.inv_bind_pose_matrix: la.Affine2 = inv_matrix
+        self.joint_model_pos: la.Vec2 = inv_matrix.inverse().translation
         self.joint_name: str = joint_name
         self.parent: int = parent
+        self.lod: int = lod  # the joint is only evaluated when the active joint lod is at least this.
+
+
+class SkeletonLOD:
+    """
+    The joints of a skeleton that are evaluated at one joint lod. The skipped joints stay in their bind pose relative
+    to their closest evaluated ancestor, the same as if their local matrices were never animated.
+    """
+
+    def __init__(self, parents: np.ndarray, joint_lods: np.ndarray, inv_bind_poses: la.Matrix33Array, lod: int):
+        self.lod: int = lod
+        active = joint_lods <= lod
+        self.joints: np.ndarray = np.flatnonzero(active)
+        self.levels: List[Tuple[np.ndarray, np.ndarray]] = find_levels(parents, active)
+
+        self.skipped: np.ndarray = np.flatnonzero(~active)
+        sources = []
+        for joint in self.skipped:
+            while joint != -1 and not active[joint]:
+                joint = parents[joint]
+            if joint == -1:
+                raise ValueError(f"joint lod {lod} skips a root joint, roots must be lod 0")
+            sources.append(joint)
+        self.sources: np.ndarray = np.array(sources, dtype=int)
+
+        # The bind pose of each skipped joint in the model space of its source.
+        bind_poses = inv_bind_poses[self.skipped].lazy_inverse().values
+        self.bind_offsets: np.ndarray = bind_poses @ inv_bind_poses.values[self.sources]
+
+
+class JointMask:
+    """
+    The joints an animation layer affects, some root joints and every joint below them. The joints are kept as an
+    index array into Skeleton.joints, and for every joint lod as the masked joints that lod evaluates along with their
+    indices into the lod's pose data, so a masked layer samples nothing it does not need.
+    """
+
+    def __init__(self, target_skeleton, roots: Tuple[str, ...]):
+        self.roots: Tuple[str, ...] = roots
+        names = [joint.joint_name for joint in target_skeleton.joints]
+        masked = np.zeros(target_skeleton.joint_count, dtype=bool)
+        for root in roots:
+            if root not in names:
+                raise ValueError(f"{target_skeleton.skeleton_id} has no joint called {root}")
+            masked[names.index(root)] = True
+
+        # Joints are listed parents first, so one pass carries the mask down the tree.
+        for joint, parent in enumerate(target_skeleton.parents):
+            if parent != -1 and masked[parent]:
+                masked[joint] = True
+        self.joints: np.ndarray = np.flatnonzero(masked)
+
+        self.lod_joints: List[Tuple[np.ndarray, np.ndarray]] = []
+        for skeleton_lod in target_skeleton.lods:
+            in_mask = masked[skeleton_lod.joints]
+            self.lod_joints.append((skeleton_lod.joints[in_mask], np.flatnonzero(in_mask)))
+
+    def find_joints(self, skeleton_lod=None):
+        """
+        :param skeleton_lod: the active SkeletonLOD, None for the full skeleton.
+        :return: the masked joints to sample, and their indices into the pose data.
+        """
+        if skeleton_lod is None:
+            return self.joints, self.joints
+        return self.lod_joints[skeleton_lod.lod]
 
 
 class Skeleton:
+    """
+    Alongside the joints the skeleton keeps a parent index array and the joints split into levels by depth. Every
+    joint in a level only depends on joints in earlier levels, so a whole level can be composed in one batched
+    operation. This only depends on joints being listed parents first.
+
+    Joints can be given a lod in the skeleton json. A SkeletonLOD is kept for every lod below the highest, anything
+    at or above it is the full skeleton.
+
+    bind_pose is the local bind pose as pose data, which is what a character with only animation layers is layered
+    over.
+    """
 
     def __init__(self, joint_list, name):
         self.skeleton_id: str = name
         self.joint_count: int = len(joint_list)
         self.joints: List[Joint] = joint_list
 
+        self.parents: np.ndarray = np.array([joint.parent for joint in joint_list], dtype=int)
+        self.levels: List[Tuple[np.ndarray, np.ndarray]] = find_levels(self.parents)
+        self.inv_bind_poses: la.Matrix33Array = la.Matrix33Array.from_affines(
+            joint.inv_bind_pose_matrix for joint in joint_list)
+
+        self.joint_lods: np.ndarray = np.array([joint.lod for joint in joint_list], dtype=int)
+        self.max_lod: int = int(self.joint_lods.max(initial=0))
+        self.lods: List[SkeletonLOD] = [SkeletonLOD(self.parents, self.joint_lods, self.inv_bind_poses, lod)
+                                        for lod in range(self.max_lod)]
+        self.masks: Dict[Tuple[str, ...], JointMask] = {}
+
+        # Each joint's bind pose relative to its parent's. The rotation and translation are read straight out of the
+        #   matrices, as bind poses are never scaled.
+        local_binds = self.inv_bind_poses.lazy_inverse().values
+        children = np.flatnonzero(self.parents != -1)
+        local_binds[children] = local_binds[children] @ self.inv_bind_poses.values[self.parents[children]]
+        self.bind_pose: np.ndarray = np.stack([local_binds[:, 0, 0], local_binds[:, 0, 1],
+                                               local_binds[:, 2, 0], local_binds[:, 2, 1]], axis=-1).astype(np.float32)
+        self.bind_pose.flags.writeable = False
+
+    @property
+    def nbytes(self):
+        return self.parents.nbytes + self.inv_bind_poses.values.nbytes + self.joint_lods.nbytes + self.bind_pose.nbytes
+
+    def get_mask(self, *roots):
+        """
+        :param roots: the names of the joints the mask starts from, each brings every joint below it.
+        :return: the skeleton's JointMask of those joints, made the first time it is asked for.
+        """
+        roots = tuple(sorted(roots))
+        if roots not in self.masks:
+            self.masks[roots] = JointMask(self, roots)
+        return self.masks[roots]
+
+    def get_lod(self, lod):
+        """
+        :return: the SkeletonLOD for a joint lod, or None if every joint is evaluated at that lod.
+        """
+        if lod is None or lod >= self.max_lod:
+            return None
+        return self.lods[max(lod, 0)]
+
+    @span('hierarchy')
+    def compose(self, local_matrices: np.ndarray, out: np.ndarray = None, lod=None):
+        """
+        The local to model space hierarchy pass. Each level is multiplied by its parents' model matrices at once.
+        :param local_matrices: (..., joints, 3, 3) local joint matrices. Any leading dimensions are treated as a stack
+        of characters.
+        :param out: optional array to write the model matrices into.
+        :param lod: the active joint lod. The local matrices of joints above it are never read.
+        :return: (..., joints, 3, 3) model space matrices.
+        """
+        if out is None:
+            out = np.empty_like(local_matrices)
+
+        skeleton_lod = self.get_lod(lod)
+        levels = self.levels if skeleton_lod is None else skeleton_lod.levels
+        for joints, parents in levels:
+            if parents is None:
+                out[..., joints, :, :] = local_matrices[..., joints, :, :]
+            else:
+                out[..., joints, :, :] = local_matrices[..., joints, :, :] @ out[..., parents, :, :]
+
+        if skeleton_lod is not None:
+            out[..., skeleton_lod.skipped, :, :] = skeleton_lod.bind_offsets @ out[..., skeleton_lod.sources, :, :]
+        return out
+
+
+def find_levels(parents: np.ndarray, active: np.ndarray = None):
+    """
+    Splits the joints by their depth in the tree.
+    :param parents: the parent index of every joint, -1 for a root.
+    :param active: optional mask of the joints to include. The parent of an included joint must be included.
+    :return: a list of (joint indices, parent indices) per level. The roots have no parent indices.
+    """
+    depths = np.zeros(len(parents), dtype=int)
+    for index, parent in enumerate(parents):
+        if parent != -1:
+            depths[index] = depths[parent] + 1
+    if active is not None:
+        depths[~active] = -1
 
-skeleton_cache: Dict[str, Skeleton] = {}
+    levels = []
+    for depth in range(depths.max(initial=-1) + 1):
+        joints = np.flatnonzero(depths == depth)
+        levels.append((joints, parents[joints] if depth else None))
+    return levels
 
 
 def make_skeleton_joint(joint_list: List[Joint], parent_index: int, joint_data: dict):
-    new_joint = Joint(la.Matrix33(joint_data['matrix']), joint_data['id'], parent_index)
+    # A joint can never be evaluated when its parent is not, so it is at least its parent's lod.
+    lod = max(joint_data.get('lod', 0), joint_list[parent_index].lod)
+    new_joint = Joint(la.Affine2.from_values(joint_data['matrix']), joint_data['id'], parent_index, lod)
     joint_index = len(joint_list)
     joint_list.append(new_joint)
 
@@ -51,28 +214,31 @@ def make_skeleton_joint(joint_list: List[Joint], parent_index: int, joint_data:
         make_skeleton_joint(joint_list, joint_index, child_data)
 
 
-def create_skeleton(target, cache_imperative=1):
-    """
-    Generate a skeleton object from a json file or loads one from cache.
-    :param target: The target skeleton to load.
-    :param cache_imperative: the cache imperative. This decides whether the skeleton should be cached.
-     0 = don't cache, 1 = cache and return, 2 = cache copy and return.
-    :return:
-    """
-    if target in skeleton_cache:
-        if cache_imperative == 2:
-            return deepcopy(skeleton_cache[target])
-        else:
-            return skeleton_cache[target]
-
+def load_skeleton(target):
     json_data = json.load(open(f"resources/skeletons/{target}.json"))
-    master_joint = Joint(la.Matrix33(json_data['matrix']), json_data['id'], -1)
+    # The root is always evaluated, every skipped joint follows it at the lowest lod.
+    master_joint = Joint(la.Affine2.from_values(json_data['matrix']), json_data['id'], -1)
     joint_list = [master_joint]
 
     for child_data in json_data['children']:
         make_skeleton_joint(joint_list, 0, child_data)
 
-    skeleton = Skeleton(joint_list, json_data['name'])
-    cache(skeleton, json_data['name'], skeleton_cache, cache_imperative)
+    return Skeleton(joint_list, json_data['name'])
+
+
+@span('loading')
+def create_skeleton(target, cache_imperative=1):
+    """
+    Generate a skeleton object from a json file or loads the shared one from the asset registry.
+    :param target: The target skeleton to load.
+    :param cache_imperative: the cache imperative. This decides whether the skeleton should be shared.
+     0 = load a new unregistered skeleton, 1 = the shared skeleton, 2 = a copy of the shared skeleton.
+    :return: the skeleton
+    """
+    if cache_imperative == 0:
+        return load_skeleton(target)
 
-    return skeleton
\ No newline at end of file
+    shared = ASSETS.get(asset_key('skeleton', target), lambda: load_skeleton(target))
+    if cache_imperative == 2:
+        return deepcopy(shared)
+    return shared
@@ -1,6 +1,6 @@
 from typing import Tuple, List
 from math import degrees
-from numpy import zeros, arange, float32
+from numpy import zeros, float32, array, where, ndarray, identity
 from struct import unpack
 
 import arcade
@@ -10,10 +10,14 @@ import arcade.gl as gl
 import lin_al as la
 from global_access import SCREEN_WIDTH, SCREEN_HEIGHT
 from clock import GAME_CLOCK
+from memory import ASSETS, AssetHandle
 import skeleton
 import model
 import transform
 import animation
+import clip_file
+import lod
+from profiling import span
 
 
 class SkinnedRenderer:
@@ -24,6 +28,35 @@ class SkinnedRenderer:
         self.model = render_model
         self.animator: animation.AnimationSet = animation.AnimationSet()
 
+        # (joints, 3, 3) skinning matrices, None when nothing is animating. When the renderer is registered with a
+        # crowd.CrowdAnimator or a scheduler.AnimationScheduler that writes the palette, otherwise the renderer
+        # evaluates its own animator.
+        self.palette: ndarray = None
+        self.crowd = None
+        self.update_lod: lod.UpdateLOD = None  # opt-in update rate LOD
+        self.joint_lod: int = None  # the skeleton joint lod to evaluate, None evaluates every joint
+
+        # References on the registered assets the renderer uses, which keep them from being evicted. A sprite model
+        # instance holds its template.
+        shared_model = getattr(render_model, 'template', None) or render_model
+        self.asset_handles: List[AssetHandle] = [handle for handle in (ASSETS.acquire_asset(render_skeleton),
+                                                                       ASSETS.acquire_asset(shared_model))
+                                                 if handle is not None]
+
+    def evaluate_palette(self):
+        if self.update_lod is not None:
+            return self.update_lod.get_palette(self)
+        return self.animator.get_palette(lod=self.joint_lod)
+
+    def update_palette(self):
+        if self.crowd is None:
+            self.palette = self.evaluate_palette()
+
+    def release_assets(self):
+        for handle in self.asset_handles:
+            handle.release()
+        self.asset_handles = []
+
     def draw(self):
         pass
 
@@ -36,63 +69,47 @@ class Primitive(SkinnedRenderer):
     def __init__(self, render_skeleton, render_model, position):
         super().__init__(render_skeleton, render_model, position)
         self.last_world_space_joints: List[la.Vec2] = []
+        self.model_view_positions: la.Vec2Array = la.Vec2Array.from_vecs(
+            segment.model_view_pos for segment in render_model.segment_list)
 
-    def calculate_prim_point(self, index, poses, weights, world_matrix):
-        inverse_matrix = self.skeleton.joints[index].inv_bind_pose_matrix
-        segment = self.model.segment_list[index]
+    def calculate_prim_points(self, palette, world_matrix):
+        if palette is None:
+            return self.model_view_positions * world_matrix
+        return self.model_view_positions * la.Matrix33Array(palette) * world_matrix
 
-        if not len(poses):
-            final_point = segment.model_view_pos * world_matrix
-        else:
-            final_point = la.Vec2(0)
-            for k, pose in enumerate(poses):
-                joint_pose = pose[index]
-                skinning_matrix = inverse_matrix * joint_pose
-                final_point += segment.model_view_pos * skinning_matrix * world_matrix * weights[k]
-        return final_point
-
-    def render_points(self, poses, weights):
-        index = 0
-        world_matrix = self.transform.to_matrix()
-
-        world_space_joints = []
-        while index < self.skeleton.joint_count:
-            primitive_segment = self.model.segment_list[index]
-
-            final_point = self.calculate_prim_point(index, poses, weights, world_matrix)
+    def render_points(self, palette):
+        world_matrix = self.transform.to_affine()
+        world_space_joints = self.calculate_prim_points(palette, world_matrix).to_vecs()
+
+        for index, primitive_segment in enumerate(self.model.segment_list):
+            final_point = world_space_joints[index]
             if primitive_segment.parent_primitive_index != -1:
                 parent_point = world_space_joints[primitive_segment.parent_primitive_index]
                 arcade.draw_line(final_point.x, final_point.y, parent_point.x, parent_point.y,
                                  primitive_segment.colour, primitive_segment.thickness)
             arcade.draw_point(final_point.x, final_point.y, primitive_segment.colour, primitive_segment.thickness * 2)
 
-            world_space_joints.append(final_point)
-            index += 1
-
         self.last_world_space_joints = world_space_joints
 
+    @span('render')
     def draw(self):
-        poses, weights = self.animator.get_poses()
-        self.render_points(poses, weights)
+        self.update_palette()
+        self.render_points(self.palette)
 
     def pose_draw(self, pose: animation.FramePose):
-        poses = []
-        for index, joint_pose in enumerate(pose.joint_poses):
-            parent = self.skeleton.joints[index].parent
-            if parent != -1:
-                poses.append(joint_pose.to_matrix() * poses[parent])
-            else:
-                poses.append(joint_pose.to_matrix())
-
-        self.render_points((poses,), (1,))
+        model_poses = self.skeleton.compose(animation.local_matrices(pose.to_array()))
+        self.render_points(self.skeleton.inv_bind_poses.values @ model_poses)
 
 
 def create_sample_prim_renderer():
-    clip = animation.generate_clips("resources/poses/animations/basic_motion.json", 'run')
+    clip = clip_file.load_clips("resources/poses/animations/basic_motion.json", 'run')
 
     entity_skeleton = skeleton.create_skeleton("basic")
     entity_model = model.create_primitive_model("resources/models/primitives/basic.json")
+    return make_sample_prim_renderer(entity_skeleton, entity_model, clip)
 
+
+def make_sample_prim_renderer(entity_skeleton, entity_model, clip):
     position = transform.Transform(la.Vec2(SCREEN_WIDTH/6, SCREEN_HEIGHT/2), la.Vec2(128), 0)
     sample_prim = Primitive(entity_skeleton, entity_model, position)
 
@@ -103,7 +120,7 @@ def create_sample_prim_renderer():
 class SpriteRenderData:
 
     def __init__(self, matrices, angles):
-        self.matrices: Tuple[Tuple[la.Matrix33, float]] = matrices
+        self.matrices: la.Matrix33Array = matrices  # each joint's palette * world matrix
         self.angles: Tuple[float] = angles
 
 
@@ -113,66 +130,56 @@ class Sprites(SkinnedRenderer):
         super().__init__(render_skeleton, render_model, render_transform)
         self.render_data: SpriteRenderData = None
 
+        self.joint_model_positions: la.Vec2Array = la.Vec2Array.from_vecs(
+            joint.joint_model_pos for joint in render_skeleton.joints)
+        self.segment_positions: la.Vec2Array = la.Vec2Array.from_vecs(
+            segment.model_pos for segment in render_model.segment_list)
+        self.segment_joints: ndarray = array([segment.target_joint for segment in render_model.segment_list], int)
+
+    @span('render')
     def find_render_data(self):
-        poses, weights = self.animator.get_poses()
-        world_matrix = self.transform.to_matrix()
-        joint_matrices = []
-        joint_positions = []
-        joint_angles = []
-        for index, joint in enumerate(self.skeleton.joints):
-            inv_matrix = joint.inv_bind_pose_matrix
-
-            if not poses:
-                final_joint = joint.joint_model_pos * world_matrix
-                joint_matrices.append((world_matrix,))
-                joint_positions.append(final_joint)
-                joint_angles.append(0)
-            else:
-                matrices = []
-                final_point = la.Vec2(0)
-                for k, pose in enumerate(poses):
-                    pose_matrix = (inv_matrix * pose[index] * world_matrix *
-                                   la.Matrix33.scale_matrix(la.Vec2(weights[k])))
-                    final_point += joint.joint_model_pos * pose_matrix
-                    matrices.append(pose_matrix)
-                joint_matrices.append(tuple(matrices))
-                joint_positions.append(final_point)
-
-                if joint.parent != -1:
-                    parent_point = joint_positions[joint.parent]
-                    angle = (final_point - parent_point).theta
-                    joint_angles.append(angle)
-                else:
-                    joint_angles.append(0)
-
-        self.render_data = SpriteRenderData(tuple(joint_matrices), tuple(joint_angles))
+        self.update_palette()
+        world_matrix = la.Matrix33Array.to_array(self.transform.to_affine())
+
+        if self.palette is None:
+            joint_matrices = la.Matrix33Array.identity(self.skeleton.joint_count) * world_matrix
+            joint_angles = (0,) * self.skeleton.joint_count
+        else:
+            joint_matrices = la.Matrix33Array(self.palette) * world_matrix
 
+            joint_positions = self.joint_model_positions * joint_matrices
+            joint_offsets = joint_positions - la.Vec2Array(joint_positions.values[self.skeleton.parents])
+            joint_angles = tuple(where(self.skeleton.parents != -1, joint_offsets.theta, 0).tolist())
+
+        self.render_data = SpriteRenderData(joint_matrices, joint_angles)
+
+    @span('render')
     def draw(self):
         scale = self.transform.scale.x/self.model.model_pixel_scale.x * self.model.model_pixel_scale.y
         if self.render_data is not None:
-            for segment in self.model.segment_list:
-                index = segment.target_joint
+            segment_matrices = la.Matrix33Array(self.render_data.matrices.values[self.segment_joints])
+            positions = (self.segment_positions * segment_matrices).values.tolist()
+            for segment, position in zip(self.model.segment_list, positions):
                 sprite = segment.sprite
 
                 if sprite.scale != scale:
                     sprite.scale = scale
 
-                sprite.angle = degrees(self.render_data.angles[index])
-                position = la.Vec2(0)
-                for matrix in self.render_data.matrices[index]:
-                    position += segment.model_pos * matrix
-
-                sprite.position = position.x, position.y
+                sprite.angle = degrees(self.render_data.angles[segment.target_joint])
+                sprite.position = position[0], position[1]
 
         self.model.draw()
 
 
 def create_sample_sprite_renderer():
-    clip = animation.generate_clips("resources/poses/animations/robot_motion.json", 'run')
+    clip = clip_file.load_clips("resources/poses/animations/robot_motion.json", 'run')
 
     render_skeleton = skeleton.create_skeleton("robot")
     render_model = model.create_sprite_model("resources/models/sprites/robot.json")
+    return make_sample_sprite_renderer(render_skeleton, render_model, clip)
 
+
+def make_sample_sprite_renderer(render_skeleton, render_model, clip):
     position = transform.Transform(la.Vec2(SCREEN_WIDTH/2, SCREEN_HEIGHT/2), la.Vec2(128), 0)
     sample_sprite = Sprites(render_skeleton, render_model, position)
     sample_sprite.animator.add_animation(clip, 1, GAME_CLOCK.run_time, -1, 0.375)
@@ -201,7 +208,8 @@ class Mesh(SkinnedRenderer):
         self.geometry = context.geometry(
             [gl.BufferDescription(render_model.vertex_buffer, '4f 3f 3f 2f', ['joint_indices', 'joint_weights',
                                                                               'vert_pos', 'vert_uv'])],
-            index_buffer=render_model.index_buffer, index_element_size=2, mode=context.TRIANGLES
+            index_buffer=render_model.index_buffer, index_element_size=render_model.index_element_size,
+            mode=context.TRIANGLES
         )
         self.program = context.load_program(vertex_shader="resources/shaders/skeleton_vert.glsl",
                                             fragment_shader="resources/shaders/skeleton_frag.glsl")
@@ -225,20 +233,24 @@ class Mesh(SkinnedRenderer):
         #                            m33[6], m33[7], m33[8], 0,
         #                            0, 0, 0, 1]
 
-    def draw(self):
-        matrices = zeros(512, float32)
-        poses, weights = self.animator.get_poses()
-        for index, joint_pose in enumerate(poses[0]):
-            sm = self.skeleton.joints[index].inv_bind_pose_matrix * joint_pose
-            index_range = arange(16*index, 16*index + 16)
-            matrices.put(index_range, [sm[0], sm[1], sm[2], 0,
-                                       sm[3], sm[4], sm[5], 0,
-                                       sm[6], sm[7], sm[8], 0,
-                                       0,     0,     0,     1])
+    @span('upload')
+    def upload_palette(self):
+        matrices = zeros((32, 4, 4), float32)
+        joint_count = self.skeleton.joint_count
+        if self.palette is not None:
+            matrices[:joint_count, :3, :3] = self.palette
+        else:
+            matrices[:joint_count, :3, :3] = identity(3)
+        matrices[:joint_count, 3, 3] = 1
 
         self.skeleton_buffer.write(matrices)
         self.skeleton_buffer.bind_to_uniform_block(1)
 
+    @span('render')
+    def draw(self):
+        self.update_palette()
+        self.upload_palette()
+
         # self.test_geo.transform(self.test_prog, self.target_buffer)
         # print(unpack(self.buffer_format, self.target_buffer.read())[16:32])
 
@@ -247,11 +259,14 @@ class Mesh(SkinnedRenderer):
 
 
 def create_sample_mesh_renderer(context):
-    clip = animation.generate_clips("resources/poses/animations/robot_motion.json", 'run')
+    clip = clip_file.load_clips("resources/poses/animations/robot_motion.json", 'run')
 
     render_skeleton = skeleton.create_skeleton("robot")
-    render_model = model.load_mesh_model('robot')
+    render_model = model.create_mesh_model('robot')
+    return make_sample_mesh_renderer(render_skeleton, render_model, clip, context)
+
 
+def make_sample_mesh_renderer(render_skeleton, render_model, clip, context):
     position = transform.Transform(la.Vec2(5*SCREEN_WIDTH/6, SCREEN_HEIGHT/2), la.Vec2(128), 0)
     sample_mesh = Mesh(render_skeleton, render_model, position, context)
     sample_mesh.animator.add_animation(clip, 1, GAME_CLOCK.run_time, -1, 0.375)
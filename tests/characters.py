@@ -0,0 +1,15 @@
+# Stand-ins for SkinnedRenderer, so the animation systems can be tested without a model or a GL context.
+import animation
+
+
+class Character:
+    """
+    The parts of a SkinnedRenderer the animation systems use.
+    """
+
+    def __init__(self, target_skeleton):
+        self.skeleton = target_skeleton
+        self.animator = animation.AnimationSet()
+        self.palette = None
+        self.crowd = None
+        self.joint_lod = None
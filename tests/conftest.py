@@ -0,0 +1,7 @@
+# The modules live in the project root, which is also where their resource paths are relative to.
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
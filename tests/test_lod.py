@@ -0,0 +1,25 @@
+from lod import UpdateLOD, FULL, HALF, QUARTER
+
+
+def test_tiers_step_with_hysteresis_both_ways():
+    update_lod = UpdateLOD(QUARTER, hysteresis=0.15)
+
+    # HALF needs 48 * 1.15 to enter, FULL 96 * 1.15.
+    assert update_lod.select_tier(50) == QUARTER
+    assert update_lod.select_tier(56) == HALF
+    assert update_lod.select_tier(100) == HALF
+    assert update_lod.select_tier(111) == FULL
+
+    # FULL is left below 96 * 0.85, HALF below 48 * 0.85.
+    assert update_lod.select_tier(90) == FULL
+    assert update_lod.select_tier(80) == HALF
+    assert update_lod.select_tier(45) == HALF
+    assert update_lod.select_tier(40) == QUARTER
+
+
+def test_tiers_skip_steps_past_every_band():
+    update_lod = UpdateLOD(QUARTER, hysteresis=0.15)
+    assert update_lod.select_tier(100) == HALF
+    update_lod.tier = QUARTER
+    assert update_lod.select_tier(200) == FULL
+    assert update_lod.select_tier(10) == QUARTER
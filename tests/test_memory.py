@@ -0,0 +1,27 @@
+import os
+
+import animation
+import clip_file
+from memory import ASSETS
+
+LIBRARY = "resources/poses/animations/robot_motion.json"
+
+
+def test_reloading_a_library_keeps_held_clips():
+    run = animation.generate_clips(LIBRARY, 'run')
+    key = animation.clip_key(animation.library_name(LIBRARY), 'run')
+    handle = ASSETS.acquire(key)
+    try:
+        animation.generate_clips(LIBRARY, None)
+        assert ASSETS.entries[key].asset is run
+        assert ASSETS.entries[key].references == 1
+    finally:
+        handle.release()
+
+
+def test_open_clip_files_are_registered_assets():
+    clip_file.load_clips(LIBRARY, None)
+    binary_file = clip_file.find_clip_file(LIBRARY)
+    entry = ASSETS.entries[clip_file.clip_file_key(binary_file)]
+    assert entry.size == os.path.getsize(binary_file)
+    assert clip_file.open_clip_file(binary_file) is entry.asset
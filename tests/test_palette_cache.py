@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+import animation
+import skeleton
+import clip_file
+from crowd import CrowdAnimator
+from palette_cache import PaletteCache, BakedClip, write_palette_file, load_baked
+from clock import GAME_CLOCK
+
+from characters import Character
+
+
+def make_blending_characters(count=4):
+    """
+    Characters blending the robot run with the run played backwards, at different phases.
+    """
+    target_skeleton = skeleton.create_skeleton('robot')
+    run = clip_file.load_clips("resources/poses/animations/robot_motion.json", 'run')
+    backwards = animation.Clip(target_skeleton, run.frame_data[::-1].copy(), run.frames_per_second, True)
+
+    characters = []
+    for index in range(count):
+        character = Character(target_skeleton)
+        character.animator.add_animation(run, 1, index * 0.1, -1, 0.5)
+        character.animator.add_animation(backwards, 0.5 + index * 0.25, index * 0.37, -1, 0.5)
+        characters.append(character)
+    return characters
+
+
+def test_cache_does_not_change_a_two_clip_blend():
+    GAME_CLOCK.begin()
+    GAME_CLOCK.increment(0.4)
+    characters = make_blending_characters()
+
+    sampled = [character.animator.get_palette() for character in characters]
+    for character in characters:
+        character.animator.palette_cache = PaletteCache()
+    cached = [character.animator.get_palette() for character in characters]
+
+    for sampled_palette, cached_palette in zip(sampled, cached):
+        np.testing.assert_allclose(cached_palette, sampled_palette, atol=1e-6)
+
+
+def test_crowd_cache_does_not_change_a_two_clip_blend():
+    GAME_CLOCK.begin()
+    GAME_CLOCK.increment(0.4)
+    characters = make_blending_characters()
+
+    palettes = []
+    for palette_cache in (None, PaletteCache()):
+        crowd = CrowdAnimator(palette_cache)
+        for character in characters:
+            crowd.register(character)
+        crowd.update()
+        palettes.append(np.stack([character.palette for character in characters]))
+        for character in characters:
+            crowd.unregister(character)
+
+    np.testing.assert_allclose(palettes[1], palettes[0], atol=1e-6)
+
+
+def load_baked_run(folder):
+    """
+    Bakes the robot run into a palette file and loads it back.
+    :return: the run and its loaded BakedClip.
+    """
+    target_skeleton = skeleton.create_skeleton('robot')
+    run = clip_file.load_clips("resources/poses/animations/robot_motion.json", 'run')
+    baked = BakedClip.bake(run, PaletteCache().find_sample_count(run))
+    file = str(folder / "robot.bpal")
+    write_palette_file(file, 'robot', target_skeleton.joint_count,
+                       {'run': (bytes(16), baked.palettes, run.duration, run.is_looping)})
+    return run, load_baked(file, 'run')
+
+
+def test_loaded_baked_clip_plays_like_its_clip(tmp_path):
+    GAME_CLOCK.begin()
+    GAME_CLOCK.increment(0.4)
+    run, baked = load_baked_run(tmp_path)
+
+    palettes = []
+    for clip in (run, baked):
+        character = Character(baked.skeleton)
+        character.animator.palette_cache = PaletteCache()
+        character.animator.add_animation(clip, 1, 0.3, -1, 0.5)
+        palettes.append(character.animator.get_palette())
+
+        crowd = CrowdAnimator(PaletteCache())
+        character.animator.palette_cache = None
+        crowd.register(character)
+        crowd.update()
+        palettes.append(character.palette)
+
+    for palette in palettes[1:]:
+        np.testing.assert_allclose(palette, palettes[0], atol=1e-5)
+
+
+def test_baked_clips_only_play_on_their_own(tmp_path):
+    GAME_CLOCK.begin()
+    run, baked = load_baked_run(tmp_path)
+    character = Character(baked.skeleton)
+    animator = character.animator
+
+    animator.add_animation(run, 1, 0, -1, 1)
+    with pytest.raises(ValueError):
+        animator.add_animation(baked, 1, 0, -1, 1)
+    with pytest.raises(ValueError):
+        animator.transition(baked, 0.2)
+
+    animator.animations.clear()
+    with pytest.raises(ValueError):
+        animator.add_animation(baked, 1, 0, -1, 1, baked.skeleton.get_mask(baked.skeleton.joints[0].joint_name))
+    animator.add_animation(baked, 1, 0, -1, 1)
+    for clip in (run, baked):
+        with pytest.raises(ValueError):
+            animator.add_animation(clip, 1, 0, -1, 1)
+        with pytest.raises(ValueError):
+            animator.transition(clip, 0.2)
+    assert len(animator.animations) == 1
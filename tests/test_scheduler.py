@@ -0,0 +1,38 @@
+import numpy as np
+
+import skeleton
+import clip_file
+import lin_al as la
+from transform import Transform
+from crowd import CrowdAnimator
+from scheduler import AnimationScheduler
+from clock import GAME_CLOCK
+from characters import Character
+
+
+def test_scheduler_batches_only_the_chosen_renderers_through_its_crowd():
+    GAME_CLOCK.begin()
+    GAME_CLOCK.increment(0.4)
+    target_skeleton = skeleton.create_skeleton('robot')
+    run = clip_file.load_clips("resources/poses/animations/robot_motion.json", 'run')
+
+    crowd = CrowdAnimator()
+    scheduler = AnimationScheduler(budget_ms=1, crowd=crowd)
+    characters = []
+    for scale in (1, 4, 2):
+        character = Character(target_skeleton)
+        character.transform = Transform(la.Vec2(400, 300), la.Vec2(scale, scale), 0)
+        character.animator.add_animation(run, 1, scale * 0.1, -1, 0.5)
+        scheduler.register(character)
+        characters.append(character)
+    assert all(character.crowd is crowd for character in characters)
+
+    # Pretend the last batch was slow, so only the largest character fits into the budget.
+    scheduler.renderer_cost = 0.002
+    scheduler.update()
+
+    small, large, medium = characters
+    np.testing.assert_allclose(large.palette, large.animator.get_palette(), atol=1e-5)
+    assert small.palette is None and medium.palette is None
+    assert (scheduler.evaluated_count, scheduler.deferred_count) == (1, 2)
+    assert scheduler.renderer_cost != 0.002  # measured from the batch
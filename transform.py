@@ -18,5 +18,8 @@ class Transform:
     def to_matrix(self):
         return la.Matrix33.all_matrix(self.position, self.scale, self.rotation)
 
+    def to_affine(self):
+        return la.Affine2.all_matrix(self.position, self.scale, self.rotation)
+
     def to_inverse(self):
         return la.Matrix33.inverse_all_matrix(self.position, self.scale, self.rotation)